@@ -5,8 +5,17 @@ Calculate and assess the estimated arrival time with different baseline algorith
 
 # import modules
 import pandas as pd
+import numpy as np
 import os
-from datetime import timedelta, datetime
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'preprocess'))
+import partition_store
+import gtfs_index
+import history_filter
+import context_features
+import epoch_time
+import schema
+import db_io
 
 
 #################################################################################################################
@@ -18,33 +27,13 @@ def filter_single_history(single_history, stop_sequence):
     """
     Filter the history file with only one day and one stop sequence to remove abnormal record
 
+    The records are kept if the total_distance is larger than the running maximum of the previous records. See history_filter.filter_single_history.
+
     :param single_history: dataframe for history table with only one day
     :param stop_sequence: list of stop id
     :return: dataframe for filtered history table
     """
-    current_history = single_history[
-        (single_history.next_stop_id.isin(stop_sequence)) & (single_history.dist_along_route > 0)]
-    if len(current_history) < 3:
-        return None
-    tmp_history = pd.DataFrame(columns=current_history.columns)
-    i = 1
-    prev_record = current_history.iloc[0]
-    while i < len(current_history):
-        next_record = current_history.iloc[i]
-        prev_distance = float(prev_record.total_distance)
-        next_distance = float(next_record.total_distance)
-        while prev_distance >= next_distance:
-            i += 1
-            if i == len(current_history):
-                break
-            next_record = current_history.iloc[i]
-            next_distance = float(next_record.total_distance)
-        tmp_history.loc[len(tmp_history)] = prev_record
-        prev_record = next_record
-        i += 1
-    if float(prev_record.total_distance) > float(tmp_history.iloc[-1].total_distance):
-        tmp_history.loc[len(tmp_history)] = prev_record
-    return tmp_history
+    return history_filter.filter_single_history(single_history, stop_sequence)
 
 
 def calculate_arrival_time(stop_dist, prev_dist, next_dist, prev_timestamp, next_timestamp):
@@ -63,16 +52,16 @@ def calculate_arrival_time(stop_dist, prev_dist, next_dist, prev_timestamp, next
     :param stop_dist: the distance of the target stop between the prev and next tuple
     :param prev_dist: the distance of the location of the bus at the previous record
     :param next_dist: the distance of the location of the bus at the next record
-    :param prev_timestamp: the timestamp of the bus at the previous record
-    :param next_timestamp: the timestamp of the bus at the next record
-    :return result: the timestamp of the bus arrival the target stop
+    :param prev_timestamp: the timestamp of the bus at the previous record in epoch microseconds
+    :param next_timestamp: the timestamp of the bus at the next record in epoch microseconds
+    :return result: the timestamp of the bus arrival the target stop in epoch microseconds
     """
     distance_prev_next = next_dist - prev_dist
     distance_prev_stop = stop_dist - prev_dist
     ratio = float(distance_prev_stop) / float(distance_prev_next)
-    duration_prev_next = next_timestamp - prev_timestamp
-    duration_prev_stop = ratio * duration_prev_next.total_seconds()
-    duration_prev_stop = timedelta(0, duration_prev_stop)
+    duration_prev_next = (next_timestamp - prev_timestamp) / 1000000.0
+    duration_prev_stop = ratio * duration_prev_next
+    duration_prev_stop = int(epoch_time.seconds_to_microseconds([duration_prev_stop])[0])
     stop_timestamp = prev_timestamp + duration_prev_stop
     return stop_timestamp
 
@@ -96,11 +85,11 @@ def calculate_arrival_distance(time_of_day, prev_dist, next_dist, prev_timestamp
     :param prev_timestamp: the timestamp of the bus for the previous record in historical data
     :param next_timestamp: the timestamp of the bus for the next record in historical data
     :return result: dist_along_route for the bus at the given time_of_day
+
+    All the time are in epoch seconds.
     """
-    duration_prev_next = next_timestamp - prev_timestamp
-    duration_prev_time = time_of_day - prev_timestamp
-    duration_prev_next = duration_prev_next.total_seconds()
-    duration_prev_time = duration_prev_time.total_seconds()
+    duration_prev_next = float(next_timestamp - prev_timestamp)
+    duration_prev_time = float(time_of_day - prev_timestamp)
     ratio = duration_prev_time / duration_prev_next
     distance_prev_next = next_dist - prev_dist
     distance_prev_time = distance_prev_next * ratio
@@ -141,309 +130,571 @@ def calculate_time_from_stop(segment_df, dist_along_route, prev_record, next_rec
     return time_from_stop
 
 
+def obtain_shape_stop_dict(route_stop_dist):
+    """
+    Build the arrays of the stops and their distances for each shape id
+
+    :param route_stop_dist: dataframe of the route_stop_dist.csv file
+    :return: dictionary from the shape id to the tuple of (array of the stop ids, array of the dist_along_route in float64) in the order of the route_stop_dist table
+    """
+    shape_stop_dict = {}
+    stop_array = route_stop_dist['stop_id'].values
+    dist_array = route_stop_dist['dist_along_route'].values.astype(float)
+    for shape_id, index in route_stop_dist.groupby(np.asarray(route_stop_dist['shape_id'])).indices.iteritems():
+        index = np.sort(index)
+        shape_stop_dict[shape_id] = (stop_array[index], dist_array[index])
+    return shape_stop_dict
+
+
+def locate_vehicle(stop_array, dist_array, dist_along_route, target_stop, at_stop=True):
+    """
+    Find the (prev, next) stop tuple of the current location and the index of the target stop for many records of the same shape id
+
+    Algorithm:
+    if at_stop:
+        prev_index = the last stop whose dist_along_route <= the current location, found by searchsorted
+        if the bus is at the prev stop, next_index = prev_index, otherwise next_index = prev_index + 1
+        the bus should be before the last stop
+    else:
+        next_index = the first stop whose dist_along_route >= the current location, found by searchsorted
+        prev_index = next_index - 1
+        the bus should be after the first stop
+    the record is valid if the (prev, next) tuple is found, the target stop is in the stop sequence and the bus hasn't passed the target stop
+
+    :param stop_array: array of the stop ids of the shape
+    :param dist_array: array of the dist_along_route of the stops
+    :param dist_along_route: array of the current location of the bus
+    :param target_stop: array of the target stop id
+    :param at_stop: whether the bus at a stop is regarded as parking at that stop. It is True for baseline1 and baseline2 and False for baseline3
+    :return: tuple of (valid, prev_index, next_index, target_index) arrays
+    """
+    dist_along_route = np.asarray(dist_along_route, dtype=float)
+    order = np.argsort(stop_array, kind='mergesort')
+    position = np.clip(np.searchsorted(stop_array[order], target_stop), 0, len(stop_array) - 1)
+    target_index = order[position]
+    valid = stop_array[target_index] == target_stop
+    if at_stop:
+        prev_index = np.searchsorted(dist_array, dist_along_route, side='right') - 1
+        valid &= (prev_index >= 0) & (dist_along_route < dist_array[-1])
+        prev_index = np.clip(prev_index, 0, len(stop_array) - 1)
+        next_index = np.where(dist_array[prev_index] == dist_along_route, prev_index, prev_index + 1)
+    else:
+        next_index = np.searchsorted(dist_array, dist_along_route, side='left')
+        valid &= (next_index >= 1) & (next_index < len(stop_array))
+        next_index = np.clip(next_index, 1, max(len(stop_array) - 1, 1))
+        prev_index = next_index - 1
+    valid &= target_index >= next_index
+    return valid, prev_index, next_index, target_index
+
+
+def obtain_duration_array(stop_array, segment_duration, average_travel_duration):
+    """
+    Obtain the travel duration of each segment in a stop sequence and their prefix sums
+
+    :param stop_array: array of the stop ids of the shape
+    :param segment_duration: series of the travel duration indexed by (segment_start, segment_end)
+    :param average_travel_duration: the travel duration of the segments which are not in segment_duration
+    :return: tuple of (duration_array, cumulative_array). duration_array[j] is the travel duration from the stop j to the stop j + 1 and cumulative_array[j] is the total travel duration from the first stop to the stop j
+    """
+    segment_index = pd.MultiIndex.from_arrays([stop_array[:-1], stop_array[1:]])
+    duration_array = segment_duration.reindex(segment_index).values.astype(float)
+    duration_array[np.isnan(duration_array)] = average_travel_duration
+    cumulative_array = np.concatenate([[0.0], np.cumsum(duration_array)])
+    return duration_array, cumulative_array
+
+
+def obtain_time_bin(seconds_array, bin_width, bin_count):
+    """
+    Obtain the index of the time bin for the seconds of day
+
+    :param seconds_array: array of the seconds of day
+    :param bin_width: width of the time bins in seconds. If it is None, all the records are in the bin 0
+    :param bin_count: number of the time bins
+    :return: array of the index of the time bin
+    """
+    seconds_array = np.asarray(seconds_array, dtype=np.int64)
+    if bin_width is None:
+        return np.zeros(len(seconds_array), dtype=int)
+    return np.clip(seconds_array // int(bin_width), 0, bin_count - 1)
+
+
+def obtain_cube_duration(travel_time_cube, stop_array, cell_array):
+    """
+    Gather the travel duration of each segment in a stop sequence for several cells of the travel time cube
+
+    :param travel_time_cube: the travel time cube from preprocess_baseline2
+    :param stop_array: array of the stop ids of the shape
+    :param cell_array: array of the flat index of the (weather, rush_hour, time bin) cells
+    :return: matrix of the travel duration, one row for each cell and one column for each segment in the stop sequence. The segments which are not in the segment table use the average travel duration of the cell
+    """
+    segment_code = travel_time_cube['segment_index'].get_indexer(pd.MultiIndex.from_arrays([stop_array[:-1], stop_array[1:]]))
+    duration = travel_time_cube['duration']
+    duration = duration.reshape(duration.shape[0], -1)
+    average_array = travel_time_cube['average'].ravel()[cell_array]
+    if len(duration) == 0:
+        return np.repeat(average_array[:, np.newaxis], len(segment_code), axis=1)
+    duration_matrix = duration[np.maximum(segment_code, 0)][:, cell_array].T
+    return np.where(segment_code >= 0, duration_matrix, average_array[:, np.newaxis])
+
+
+def calculate_estimated_time(duration_matrix, row_index, dist_array, dist_along_route, prev_index, next_index, target_index):
+    """
+    Calculate the estimated travel time to the target stop for many records of the same shape id
+
+    Algorithm:
+    calculate the prefix sums of each row of the travel duration matrix
+    time_from_stop = travel duration of (prev, next) * (next_dist - dist_along_route) / (next_dist - prev_dist), 0 if the bus is at the prev stop
+    estimated time = prefix_sum[target_index] - prefix_sum[next_index] + time_from_stop
+
+    :param duration_matrix: matrix of the travel duration of each segment in the stop sequence, see obtain_cube_duration
+    :param row_index: array of the row of duration_matrix used by each record
+    :param dist_array: array of the dist_along_route of the stops
+    :param dist_along_route: array of the current location of the bus
+    :param prev_index: array of the index of the prev stop from locate_vehicle
+    :param next_index: array of the index of the next stop from locate_vehicle
+    :param target_index: array of the index of the target stop from locate_vehicle
+    :return: array of the estimated travel time in seconds
+    """
+    cumulative_matrix = np.concatenate([np.zeros((len(duration_matrix), 1)), np.cumsum(duration_matrix, axis=1)], axis=1)
+    at_stop = prev_index == next_index
+    segment_index = np.minimum(prev_index + 1, len(dist_array) - 1)
+    ratio = (dist_array[segment_index] - dist_along_route) / np.where(at_stop, 1.0, dist_array[segment_index] - dist_array[prev_index])
+    time_from_stop = np.where(at_stop, 0.0, duration_matrix[row_index, np.minimum(prev_index, duration_matrix.shape[1] - 1)] * ratio)
+    return cumulative_matrix[row_index, target_index] - cumulative_matrix[row_index, next_index] + time_from_stop
+
+
+def obtain_leave_one_out_duration(segment_statistics, shape_id, stop_array, date_array, trip_array):
+    """
+    Calculate the average travel duration of each segment in a stop sequence without the given trips
+
+    Algorithm:
+    get the sum and the count of each segment in the stop sequence for the shape id
+    get the own sum and the own count of each segment for each (service date, trip id)
+    average travel duration = (sum - own sum) / (count - own count)
+    if count - own count = 0, use (total sum - own total sum) / (total count - own total count) of all the segments of the shape id
+
+    :param segment_statistics: the sufficient statistics from preprocess_baseline3
+    :param shape_id: the shape id
+    :param stop_array: array of the stop ids of the shape
+    :param date_array: array of the service dates of the trips to leave out
+    :param trip_array: array of the trip ids of the trips to leave out
+    :return: matrix of the travel duration, one row for each (service date, trip id) and one column for each segment in the stop sequence
+    """
+    segment_count = len(stop_array) - 1
+    pair_count = len(date_array)
+    if shape_id not in segment_statistics['shape'].index:
+        return np.full((pair_count, segment_count), np.nan)
+    start_array = stop_array[:-1]
+    end_array = stop_array[1:]
+    total = segment_statistics['segment'].loc[shape_id].reindex(pd.MultiIndex.from_arrays([start_array, end_array])).fillna(0.0)
+    own_index = pd.MultiIndex.from_arrays([np.repeat(date_array, segment_count), np.repeat(trip_array, segment_count), np.tile(start_array, pair_count), np.tile(end_array, pair_count)])
+    own = segment_statistics['trip_segment'].loc[shape_id].reindex(own_index).fillna(0.0)
+    own_shape = segment_statistics['trip_shape'].loc[shape_id].reindex(pd.MultiIndex.from_arrays([date_array, trip_array])).fillna(0.0)
+    shape_sum, shape_count = segment_statistics['shape'].loc[shape_id, ['sum', 'count']]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average_array = (shape_sum - own_shape['sum'].values) / (shape_count - own_shape['count'].values)
+        count_matrix = total['count'].values - own['count'].values.reshape(pair_count, segment_count)
+        sum_matrix = total['sum'].values - own['sum'].values.reshape(pair_count, segment_count)
+        duration_matrix = sum_matrix / count_matrix
+    return np.where(count_matrix > 0, duration_matrix, average_array[:, np.newaxis])
+
+
+def build_estimated_result(api_data, gtfs, position_list, count_list, estimated_list):
+    """
+    Build the table of the estimated arrival time from the arrays of the estimators
+
+    :param api_data: dataframe for the api_data.csv with the epoch_time and seconds_of_day columns
+    :param gtfs: the GTFSIndex
+    :param position_list: list of the arrays of the positions of the estimated records in api_data
+    :param count_list: list of the arrays of the number of the stops between the next stop and the target stop
+    :param estimated_list: list of the arrays of the estimated arrival time
+    :return: dataframe to store the result including the esitmated arrival time in the order of api_data, indexed by the index of the api data
+    """
+    column_list = ['trip_id', 'route_id', 'stop_id', 'vehicle_id', 'time_of_day', 'service_date', 'dist_along_route', 'stop_num_from_call', 'estimated_arrival_time', 'shape_id', 'epoch_time', 'seconds_of_day']
+    if position_list == []:
+        return pd.DataFrame(columns=column_list)
+    position = np.concatenate(position_list)
+    order = np.argsort(position, kind='mergesort')
+    position = position[order]
+    selected_api_data = api_data.iloc[position]
+    trip_array = np.asarray(selected_api_data['trip_id'])
+    route_dict = dict([(trip_id, gtfs.route_id(trip_id)) for trip_id in set(trip_array)])
+    result = pd.DataFrame({
+        'trip_id': trip_array,
+        'route_id': [route_dict[trip_id] for trip_id in trip_array],
+        'stop_id': selected_api_data['stop_id'].values,
+        'vehicle_id': np.asarray(selected_api_data['vehicle_id']),
+        'time_of_day': selected_api_data['time_of_day'].values,
+        'service_date': selected_api_data['date'].values,
+        'dist_along_route': selected_api_data['dist_along_route'].values,
+        'stop_num_from_call': np.concatenate(count_list)[order] + 1,
+        'estimated_arrival_time': np.concatenate(estimated_list)[order],
+        'shape_id': np.asarray(selected_api_data['shape_id']),
+        'epoch_time': selected_api_data['epoch_time'].values,
+        'seconds_of_day': selected_api_data['seconds_of_day'].values}, index=selected_api_data.index, columns=column_list)
+    return result
+
+
 #################################################################################################################
 #                                           estimator functions                                                 #
 #################################################################################################################
 
 
-def generate_estimated_arrival_time(api_data, preprocessed_segment_data, route_stop_dist, trips):
+def generate_estimated_arrival_time(api_data, preprocessed_segment_data, route_stop_dist, trips, shape_stop_dict=None):
     """
     Predict the estimated arrival time according to the api data
 
+    All the records of the same shape id are estimated at once with the arrays of the stop sequence, the dist_along_route of the stops and the prefix sums of the travel duration of the segments.
+
     Algorithm:
-    Build the empty dataframe
-    for row in api_data:
-        get the route_id according to the trip id and the trips.txt file
-        get the stop sequence and the dist_along_route according to the route id
-        get the end_index according to the stop id
-        get the (prev, next) stop tuple according to the dist_along_route in the record
-        get the count = end_index - next_index
-        if count < 0:
-            the bus has passed
-            continue to next row
-        if count = 0, the next stop is the target stop:
-            calcualte the time_from_stop for (prev, next) tuple
-            save the result as the estimated time
-        if count > 0:
-            get the stop list from next_stop to target_stop
-            sum the travel duration for all of them
-            calculate the time_from_stop for (prev, next) tuple
-            add the total travel duration with the time_from_stop(prev, next)
-            save the result as the estimated time
-        save the result into the dataframe
+    get the travel duration of each (segment_start, segment_end) from the preprocessed segment data
+    for each shape id in api_data:
+        get the stop sequence and the dist_along_route according to the shape id
+        get the travel duration of each segment in the stop sequence, use the average travel duration for the missing segments
+        calculate the prefix sums of the travel duration
+        find the (prev, next) stop tuple and the index of the target stop for all the records, see locate_vehicle
+        remove the records whose bus has passed the target stop
+        time_from_stop = travel duration of (prev, next) * (next_dist - dist_along_route) / (next_dist - prev_dist), 0 if the bus is at the prev stop
+        estimated time = prefix_sum[target_index] - prefix_sum[next_index] + time_from_stop
+    save the result in the order of api_data
+
+    The stop sequence is obtained by the shape id of the record instead of the route id, because a route can have several shapes in the route_stop_dist table.
 
     :param api_data: dataframe for the api_data.csv
     :param preprocessed_segment_data: dataframe for the preprocessed final_segment.csv file according to different baseline algorithm
     :param route_stop_dist: dataframe of the route_stop_dist.csv file
-    :param trips: dataframe for the trips.txt file
-    :return: dataframe to store the result including the esitmated arrival time
+    :param trips: dataframe for the trips.txt file or the GTFSIndex
+    :param shape_stop_dict: the stop arrays of each shape id from obtain_shape_stop_dict. If it is None, it is built from route_stop_dist
+    :return: dataframe to store the result including the esitmated arrival time, indexed by the index of the api data
     """
-    result = pd.DataFrame(
-        columns=['trip_id', 'route_id', 'stop_id', 'vehicle_id', 'time_of_day', 'service_date', 'dist_along_route',
-                 'stop_num_from_call', 'estimated_arrival_time', 'shape_id'])
+    gtfs = gtfs_index.obtain_gtfs_index(trips)
+    api_data = epoch_time.ensure_time_columns(api_data, 'time_of_day')
     print "length of the api data is: ", len(api_data)
     average_travel_duration = preprocessed_segment_data['travel_duration'].mean()
-    for i in xrange(len(api_data)):
-        if i % 1000 == 0:
-            print i
-        item = api_data.iloc[i]
-        trip_id = item.get('trip_id')
-        route_id = trips[trips.trip_id == trip_id].iloc[0].route_id
-        single_route_stop_dist = route_stop_dist[route_stop_dist.route_id == route_id]
-        stop_sequence = list(single_route_stop_dist.stop_id)
-        target_stop = item.get('stop_id')
-        target_index = stop_sequence.index(target_stop)
-        dist_along_route = item.get('dist_along_route')
-        vehicle_id = item.get('vehicle_id')
-        time_of_day = item.get('time_of_day')
-        service_date = item.get('date')
-        shape_id = item.get('shape_id')
-        if dist_along_route >= single_route_stop_dist.iloc[-1].dist_along_route:
-            continue
-        for j in range(1, len(stop_sequence)):
-            if single_route_stop_dist.iloc[j - 1].dist_along_route < dist_along_route < single_route_stop_dist.iloc[j].dist_along_route:
-                prev_record = single_route_stop_dist.iloc[j - 1]
-                next_record = single_route_stop_dist.iloc[j]
-                break
-            elif single_route_stop_dist.iloc[j - 1].dist_along_route == dist_along_route:
-                prev_record = single_route_stop_dist.iloc[j - 1]
-                next_record = prev_record
-                break
-            else:
-                continue
-        next_index = stop_sequence.index(next_record.get('stop_id'))
-        count = target_index - next_index
-        if count < 0:
+    segment_duration = preprocessed_segment_data.drop_duplicates(['segment_start', 'segment_end']).set_index(['segment_start', 'segment_end'])['travel_duration']
+    if shape_stop_dict is None:
+        shape_stop_dict = obtain_shape_stop_dict(route_stop_dist)
+    dist_along_route = api_data['dist_along_route'].values.astype(float)
+    stop_id = api_data['stop_id'].values
+    position_list = []
+    count_list = []
+    estimated_list = []
+    for shape_id, index in api_data.groupby(np.asarray(api_data['shape_id'])).indices.iteritems():
+        if shape_id not in shape_stop_dict:
             continue
-        elif count == 0:
-            total_travel_duration = calculate_time_from_stop(preprocessed_segment_data, dist_along_route, prev_record,
-                                                             next_record)
-        else:
-            total_travel_duration = 0.0
-            for j in xrange(next_index, target_index):
-                segment_start = stop_sequence[j]
-                segment_end = stop_sequence[j + 1]
-                segment_record = preprocessed_segment_data[
-                    (preprocessed_segment_data.segment_start == segment_start) & (
-                        preprocessed_segment_data.segment_end == segment_end)]
-                if len(segment_record) == 0:
-                    single_travel_duration = average_travel_duration
-                else:
-                    single_travel_duration = segment_record.iloc[0]['travel_duration']
-                total_travel_duration += single_travel_duration
-            time_from_stop = calculate_time_from_stop(preprocessed_segment_data, dist_along_route, prev_record,
-                                                      next_record)
-            total_travel_duration += time_from_stop
-        result.loc[len(result)] = [trip_id, route_id, target_stop, vehicle_id, time_of_day, service_date,
-                                   dist_along_route, count + 1, total_travel_duration, shape_id]
-    return result
+        stop_array, dist_array = shape_stop_dict[shape_id]
+        duration_array, cumulative_array = obtain_duration_array(stop_array, segment_duration, average_travel_duration)
+        valid, prev_index, next_index, target_index = locate_vehicle(stop_array, dist_array, dist_along_route[index], stop_id[index])
+        index, prev_index, next_index, target_index = index[valid], prev_index[valid], next_index[valid], target_index[valid]
+        position_list.append(index)
+        count_list.append(target_index - next_index)
+        estimated_list.append(calculate_estimated_time(duration_array[np.newaxis, :], np.zeros(len(index), dtype=int), dist_array, dist_along_route[index], prev_index, next_index, target_index))
+    return build_estimated_result(api_data, gtfs, position_list, count_list, estimated_list)
 
 
-def generate_estimated_arrival_time_baseline3(api_data, full_segment_data, route_stop_dist, trips):
+def generate_estimated_arrival_time_baseline3(api_data, full_segment_data, route_stop_dist, trips, segment_statistics=None, shape_stop_dict=None):
     """
-    Calculate the estimated arrival time based on the baseline 3. Use the segment data according to the specific trip and the date to predict the result
+    Calculate the estimated arrival time based on the baseline 3. Use the segment data except the trip of the record on the same service date to predict the result
+
+    The average travel duration of each segment without the current trip is calculated from the sufficient statistics in preprocess_baseline3: (sum - own sum) / (count - own count), so the segment table is not filtered and grouped for each record.
 
     Algorithm
 
-    For row in api data:
-        extract the trip id and the service date of that row
-        extract the single segment data according to the trip id and the service date
-        divide the single segment data through groupby(segment start, segment end)
-        calculate the average value for each one in the groupby function
-        calculate the estimated arrival time for this row according to the result
-        save the result
-    concatenate the result
+    For each shape id in api data:
+        get the stop sequence and the dist_along_route according to the shape id
+        get the sum and the count of the travel duration of each segment in the stop sequence for the shape id
+        for each (service date, trip id) in the api data of the shape id:
+            get the sum and the count of the travel duration of each segment for that trip
+            average travel duration of each segment = (sum - own sum) / (count - own count)
+            use the average travel duration of all the segments without that trip for the missing segments
+            calculate the prefix sums of the travel duration
+        find the (prev, next) stop tuple and the index of the target stop for all the records, see locate_vehicle
+        remove the records whose bus has passed the target stop
+        estimated time = prefix_sum[target_index] - prefix_sum[next_index] + travel duration of (prev, next) * (next_dist - dist_along_route) / (next_dist - prev_dist)
+    save the result in the order of api_data
 
     :param api_data: dataframe for the api_data.csv
-    :param segment_data: dataframe for the preprocessed final_segment.csv file according to different baseline algorithm
+    :param full_segment_data: dataframe for the segment table. It is not used if segment_statistics is provided
     :param route_stop_dist: dataframe of the route_stop_dist.csv file
-    :param trips: dataframe for the trips.txt file
-    :return: dataframe to store the result including the esitmated arrival time
-    """
-    def helper(preprocessed_segment_data, average_travel_duration, dist_along_route, prev_record, next_record):
-        segment_start = prev_record.get('stop_id')
-        segment_end = next_record.get('stop_id')
-        if segment_start == segment_end:
-            return 0.0
-        distance_stop_stop = next_record.get('dist_along_route') - prev_record.get('dist_along_route')
-        distance_bus_stop = next_record.get('dist_along_route') - dist_along_route
-        ratio = float(distance_bus_stop) / float(distance_stop_stop)
-        assert ratio < 1
-        travel_duration = preprocessed_segment_data.get((segment_start, segment_end), average_travel_duration)
-        time_from_stop = travel_duration * ratio
-        return time_from_stop
-
-    result = pd.DataFrame(
-        columns=['trip_id', 'route_id', 'stop_id', 'vehicle_id', 'time_of_day', 'service_date', 'dist_along_route',
-                 'stop_num_from_call', 'estimated_arrival_time', 'shape_id'])
-    for i in xrange(len(api_data)):
-        item = api_data.iloc[i]
-        trip_id = item.get('trip_id')
-        shape_id = item.get('shape_id')
-        route_id = trips[trips.trip_id == trip_id].iloc[0].route_id
-        single_route_stop_dist = route_stop_dist[route_stop_dist.shape_id == shape_id]
-        stop_sequence = list(single_route_stop_dist.stop_id)
-        target_stop = item.get('stop_id')
-        target_index = stop_sequence.index(target_stop)
-        dist_along_route = item.get('dist_along_route')
-        vehicle_id = item.get('vehicle_id')
-        time_of_day = item.get('time_of_day')
-        service_date = item.get('date')
-        # preprocess the segment data according to the trip id and the service date
-        segment_data = full_segment_data[(full_segment_data.service_date != service_date) | (full_segment_data.trip_id != trip_id)]
-        trip_list = set(trips[trips.shape_id == shape_id].trip_id)
-        single_segment_data = segment_data[(segment_data.trip_id.isin(trip_list))]
-        grouped = single_segment_data.groupby(['segment_start', 'segment_end'])
-        preprocessed_segment_data = grouped['travel_duration'].mean()
-        average_travel_duration = single_segment_data['travel_duration'].mean()
-        # find the segment containing the current location of the api data
-        prev_route_stop_dist = single_route_stop_dist[single_route_stop_dist.dist_along_route < dist_along_route]
-        next_route_stop_dist = single_route_stop_dist[single_route_stop_dist.dist_along_route >= dist_along_route]
-        if len(prev_route_stop_dist) == 0 or len(next_route_stop_dist) == 0:
+    :param trips: dataframe for the trips.txt file or the GTFSIndex
+    :param segment_statistics: the sufficient statistics of the segment table from preprocess_baseline3. If it is None, it is calculated from full_segment_data
+    :param shape_stop_dict: the stop arrays of each shape id from obtain_shape_stop_dict. If it is None, it is built from route_stop_dist
+    :return: dataframe to store the result including the esitmated arrival time, indexed by the index of the api data
+    """
+    gtfs = gtfs_index.obtain_gtfs_index(trips)
+    if segment_statistics is None:
+        segment_statistics = preprocess_baseline3(full_segment_data, gtfs)
+    api_data = epoch_time.ensure_time_columns(api_data, 'time_of_day')
+    if shape_stop_dict is None:
+        shape_stop_dict = obtain_shape_stop_dict(route_stop_dist)
+    dist_along_route = api_data['dist_along_route'].values.astype(float)
+    stop_id = api_data['stop_id'].values
+    date_array = api_data['date'].values.astype('int64')
+    trip_array = np.asarray(api_data['trip_id'])
+    position_list = []
+    count_list = []
+    estimated_list = []
+    for shape_id, index in api_data.groupby(np.asarray(api_data['shape_id'])).indices.iteritems():
+        if shape_id not in shape_stop_dict:
             continue
-        next_index = len(prev_route_stop_dist)
-        count = target_index - next_index
-        # check how many stops between the current location and the target stop
-        prev_record = prev_route_stop_dist.iloc[-1]
-        next_record = next_route_stop_dist.iloc[0]
-        if count < 0:
+        stop_array, dist_array = shape_stop_dict[shape_id]
+        valid, prev_index, next_index, target_index = locate_vehicle(stop_array, dist_array, dist_along_route[index], stop_id[index], at_stop=False)
+        index, prev_index, next_index, target_index = index[valid], prev_index[valid], next_index[valid], target_index[valid]
+        if len(index) == 0:
             continue
-        elif count == 0:
-            total_travel_duration = helper(preprocessed_segment_data, average_travel_duration, dist_along_route, prev_record, next_record)
-        else:
-            total_travel_duration = 0.0
-            for j in xrange(next_index, target_index):
-                segment_start = stop_sequence[j]
-                segment_end = stop_sequence[j + 1]
-                single_travel_duration = preprocessed_segment_data.get((segment_start, segment_end), average_travel_duration)
-                total_travel_duration += single_travel_duration
-            time_from_stop = helper(preprocessed_segment_data, average_travel_duration, dist_along_route, prev_record, next_record)
-            total_travel_duration += time_from_stop
-        result.loc[len(result)] = [trip_id, route_id, target_stop, vehicle_id, time_of_day, service_date,
-                                   dist_along_route, count + 1, total_travel_duration, shape_id]
-    return result
+        # the leave-one-out travel duration for each (service date, trip id) of the records
+        pair_index, pair_array = pd.factorize(pd.Series(zip(date_array[index], trip_array[index])))
+        pair_date_array, pair_trip_array = [np.asarray(item) for item in zip(*pair_array)]
+        duration_matrix = obtain_leave_one_out_duration(segment_statistics, shape_id, stop_array, pair_date_array, pair_trip_array)
+        position_list.append(index)
+        count_list.append(target_index - next_index)
+        estimated_list.append(calculate_estimated_time(duration_matrix, pair_index, dist_array, dist_along_route[index], prev_index, next_index, target_index))
+    return build_estimated_result(api_data, gtfs, position_list, count_list, estimated_list)
 
 
-def generate_actual_arrival_time(full_history, segment_df, route_stop_dist):
+def generate_estimated_arrival_time_baseline2(api_data, segment_df, route_stop_dist, trips, rush_hour, weather_df, shape_stop_dict=None, bin_width=None, travel_time_cube=None):
     """
-    Calculate the actual arrival time from the dataset
+    Calculate the estimated arrival time based on the baseline 2. Use the average travel duration of the segments with the same weather, rush hour and time bin
+
+    The travel duration of all the api data is gathered from the travel time cube of preprocess_baseline2 at once, instead of estimating each (service date, rush hour) group of the api data separately.
 
     Algorithm:
-    Build the empty dataframe
-    for row in segment_df:
-        get trip_id, route_id, target_stop, service_date, etc
-        get single_history data according to the trip id and the service date
-        get single_route_stop_dist according to the route_id
-        get stop_sequence from single_route_stop_dist
-        get the dist_along_route for the target_stop from the single_route_stop_dist
-        set prev_index, next_index = stop_sequence.index(target_stop)
-        while stop_sequence(prev_index) not in set(single_history.next_stop_id):
-            prev_index -= 1
-            if prev_index == -1:
-                break
-        if prev_index == -1:
+    Preprocess the segment data into the travel time cube with preprocess_baseline2
+    get the weather of the service date, the rush hour and the time bin of each record in api data, and find the cell in the travel time cube
+    remove the records whose (weather, rush_hour) doesn't have any segment data
+    for each shape id in api data:
+        get the stop sequence and the dist_along_route according to the shape id
+        gather the travel duration of each segment in the stop sequence for the cells of the records
+        find the (prev, next) stop tuple and the index of the target stop for all the records, see locate_vehicle
+        remove the records whose bus has passed the target stop
+        estimated time = prefix_sum[target_index] - prefix_sum[next_index] + time_from_stop, see calculate_estimated_time
+    save the result in the order of (service date, rush hour first, api_data)
+
+    :param api_data: dataframe for the api_data.csv
+    :param segment_df: dataframe for the segment table. It is not used if travel_time_cube is provided
+    :param route_stop_dist: dataframe of the route_stop_dist.csv file
+    :param trips: dataframe for the trips.txt file or the GTFSIndex
+    :param rush_hour: tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples
+    :param weather_df: the dataframe for the weather table
+    :param shape_stop_dict: the stop arrays of each shape id from obtain_shape_stop_dict. If it is None, it is built from route_stop_dist
+    :param bin_width: width of the time bins in seconds, example: 3600 for the hour of day. If it is None, the time of day is not considered
+    :param travel_time_cube: the travel time cube from preprocess_baseline2. If it is None, it is calculated from segment_df with bin_width
+    :return: dataframe to store the result including the esitmated arrival time, indexed by the index of the api data
+    """
+    gtfs = gtfs_index.obtain_gtfs_index(trips)
+    if shape_stop_dict is None:
+        shape_stop_dict = obtain_shape_stop_dict(route_stop_dist)
+    if travel_time_cube is None:
+        travel_time_cube = preprocess_baseline2(segment_df, rush_hour, bin_width)
+    api_data = epoch_time.ensure_time_columns(api_data, 'time_of_day')
+    print "length of the api data is: ", len(api_data)
+    seconds_array = api_data['seconds_of_day'].values.astype('int64')
+    rush_hour_array = context_features.add_rush_hour(pd.DataFrame({'seconds_of_day': seconds_array}), rush_hour, inclusive=False, seconds_column='seconds_of_day')['rush_hour'].values.astype(int)
+    date_array = api_data['date'].values.astype('int64')
+    # find the cell of each record in the travel time cube
+    weather_series = context_features.obtain_weather_series(weather_df)
+    weather = weather_series.reindex(date_array).values
+    weather_array = travel_time_cube['weather']
+    weather_code = np.clip(np.searchsorted(weather_array, weather), 0, max(len(weather_array) - 1, 0))
+    in_cube = np.zeros(len(api_data), dtype=bool)
+    if len(weather_array) > 0:
+        in_cube = pd.notnull(weather) & (weather_array[weather_code] == weather)
+        in_cube &= travel_time_cube['count'][weather_code, rush_hour_array] > 0
+    cell_shape = travel_time_cube['average'].shape
+    bin_code = obtain_time_bin(seconds_array, travel_time_cube['bin_width'], cell_shape[2])
+    cell_array = np.ravel_multi_index((weather_code, rush_hour_array, bin_code), cell_shape, mode='clip')
+    dist_along_route = api_data['dist_along_route'].values.astype(float)
+    stop_id = api_data['stop_id'].values
+    position_list = []
+    count_list = []
+    estimated_list = []
+    for shape_id, index in api_data.groupby(np.asarray(api_data['shape_id'])).indices.iteritems():
+        if shape_id not in shape_stop_dict:
             continue
-        prev_stop = stop_sequence(prev_index)
-        next_index += 1
-        while stop_sequence(next_index) not in set(single_history.next_stop_id):
-            next_index += 1
-            if next_index == len(stop_sequence):
-                break
-        if next_index == len(stop_sequence):
+        index = index[in_cube[index]]
+        stop_array, dist_array = shape_stop_dict[shape_id]
+        valid, prev_index, next_index, target_index = locate_vehicle(stop_array, dist_array, dist_along_route[index], stop_id[index])
+        index, prev_index, next_index, target_index = index[valid], prev_index[valid], next_index[valid], target_index[valid]
+        if len(index) == 0:
             continue
-        next_stop = stop_sequence(next_itndex)
-        prev_record = single_history[single_history.next_stop_id == prev_stop].iloc[-1]
-        prev_time = prev_record.get('timestamp')
-        if prev_record.dist_from_stop == 0:
-            actual_arrival_time = prev_time - time_of_day
-            save the record
-            continue to next row
-        next_record = single_history[single_history.next_stop_id == next_stop].iloc[-1]
-        next_time = next_record.get('timestamp')
-        travel_duration = next_time - prev_time
-        prev_distance = prev_record.get('dist_along_route') - prev_record.get('dist_from_stop')
-        next_distance = prev_record.get('dist_along_route') - prev_record.get('dist_from_stop')
-        distance_prev_next = next_distance - prev_distance
-        distance_prev_stop = single_route_stop_dist[single_route_stop_dist.stop_id == target_stop].iloc[0]['dist_along_route'] - prev_distance
-        ratio = distance_prev_stop / distance_prev_next
-        time_from_stop = ratio * travel_duration
-        arrival_time = time_from_stop + prev_time
-        actual_arrival_time = arrival_time - time_of_day
-        save the record
-
-    :param full_history: dataframe for the historical data
-    :param segment_df: dataframe for the preprocessed average travel duration for the segmet data
-    :param route_stop_dist: dataframe for the route_stop_dist.csv file
-    :return: dataframe including both of the estimated arrival time and actual arrival time
+        row_index, shape_cell_array = pd.factorize(cell_array[index])
+        duration_matrix = obtain_cube_duration(travel_time_cube, stop_array, shape_cell_array)
+        position_list.append(index)
+        count_list.append(target_index - next_index)
+        estimated_list.append(calculate_estimated_time(duration_matrix, row_index, dist_array, dist_along_route[index], prev_index, next_index, target_index))
+    result = build_estimated_result(api_data, gtfs, position_list, count_list, estimated_list)
+    if position_list == []:
+        return result
+    # keep the order of the records grouped by the service date and the rush hour
+    position = np.sort(np.concatenate(position_list))
+    order = np.lexsort((position, 1 - rush_hour_array[position], date_array[position]))
+    return result.iloc[order]
+
+
+def generate_stop_arrival_table(full_history, route_stop_dist, shape_stop_dict=None):
     """
+    Calculate the actual arrival time at every stop of each trip
 
-    result = pd.DataFrame(
-        columns=['trip_id', 'route_id', 'stop_id', 'vehicle_id', 'time_of_day', 'service_date', 'dist_along_route', 'stop_num_from_call', 'estimated_arrival_time', 'actual_arrival_time', 'shape_id'])
-    grouped_list = list(segment_df.groupby(['service_date', 'trip_id', 'stop_id']))
-    print 'length of the segment_df is: ', len(grouped_list)
-    for i in xrange(len(grouped_list)):
-        if i % 1000 == 0:
-            print i
-        name, item = grouped_list[i]
-        service_date, trip_id, target_stop = name
-        route_id = item.iloc[0]['route_id']
-        shape_id = item.iloc[0]['shape_id']
-        single_route_stop_dist = route_stop_dist[route_stop_dist.shape_id == shape_id]
-        stop_sequence = list(single_route_stop_dist.stop_id)
-        # stop_sequence_str = [str(int(stop_id)) for stop_id in stop_sequence]
-        target_index = stop_sequence.index(target_stop)
-        dist_along_route = single_route_stop_dist[single_route_stop_dist.stop_id == target_stop].iloc[0][
-            'dist_along_route']
-        vehicle_id = item.iloc[0]['vehicle_id']
-        single_history = full_history[(full_history.service_date == service_date) & (full_history.trip_id == trip_id)]
-        single_history = filter_single_history(single_history, stop_sequence)
-        if single_history is None:
-            continue
-        prev_index, next_index = target_index, target_index + 1
-        while stop_sequence[prev_index] not in set(single_history.next_stop_id):
-            prev_index -= 1
-            if prev_index == -1:
-                break
-        if prev_index == -1:
-            continue
-        prev_stop = stop_sequence[prev_index]
-        while stop_sequence[next_index] not in set(single_history.next_stop_id):
-            next_index += 1
-            if next_index == len(stop_sequence):
-                break
-        if next_index == len(stop_sequence):
-            continue
-        next_stop = stop_sequence[next_index]
-        if prev_stop == next_stop:
-            print "error"
+    Algorithm:
+    keep the last record of each (service_date, trip_id, next_stop_id) in the filtered history table
+    for each shape id:
+        build the matrix of the last records with one row for each (service_date, trip_id) and one column for each stop in the stop sequence
+        for each stop:
+            prev stop = the last stop at or before the stop with a record, found by the running maximum
+            next stop = the first stop after the stop with a record, found by the running minimum from the end
+            if the prev stop is the stop and the dist_from_stop of its record is 0:
+                the arrival time is the time of the prev record
+            else:
+                interpolate the arrival time between the prev record and the next record by the total_distance, see calculate_arrival_time
+    remove the stops without the prev stop or the next stop, and the stops whose prev stop and next stop are the same stop id
+
+    If a stop id appears several times in the stop sequence, the record of that stop id is used in all of its columns and only the arrival time at its first column is kept, the same as stop_sequence.index(stop_id). So there is at most one record for each (service_date, trip_id, stop_id).
+
+    :param full_history: dataframe for the filtered history table with the epoch_time column, see history_filter.filter_history
+    :param route_stop_dist: dataframe for the route_stop_dist.csv file
+    :param shape_stop_dict: the stop arrays of each shape id from obtain_shape_stop_dict. If it is None, it is built from route_stop_dist
+    :return: dataframe with the columns service_date, trip_id, stop_id and arrival_time in epoch microseconds
+    """
+    column_list = ['service_date', 'trip_id', 'stop_id', 'arrival_time']
+    last_history = full_history.drop_duplicates(['service_date', 'trip_id', 'next_stop_id'], keep='last')
+    if shape_stop_dict is None:
+        shape_stop_dict = obtain_shape_stop_dict(route_stop_dist)
+    date_array = last_history['service_date'].values.astype('int64')
+    trip_array = np.asarray(last_history['trip_id'], dtype=object)
+    next_stop_array = last_history['next_stop_id'].values
+    time_array = last_history['epoch_time'].values.astype('int64') * 1000000
+    total_distance_array = last_history['total_distance'].values.astype(float)
+    dist_from_stop_array = last_history['dist_from_stop'].values.astype(float)
+    result_list = []
+    for shape_id, index in last_history.groupby(np.asarray(last_history['shape_id'])).indices.iteritems():
+        if shape_id not in shape_stop_dict:
             continue
-        prev_record = single_history[single_history.next_stop_id == prev_stop].iloc[-1]
-        prev_time = prev_record.get('timestamp')
-        prev_time = datetime.strptime(prev_time, '%Y-%m-%dT%H:%M:%SZ')
-        if prev_record.dist_from_stop == 0 and prev_record.next_stop_id == target_stop:
-            timestamp = prev_time
-        else:
-            next_record = single_history[single_history.next_stop_id == next_stop].iloc[-1]
-            next_time = next_record.get('timestamp')
-            next_time = datetime.strptime(next_time, '%Y-%m-%dT%H:%M:%SZ')
-            prev_distance = float(prev_record.get('total_distance'))
-            next_distance = float(next_record.get('total_distance'))
-            timestamp = calculate_arrival_time(dist_along_route, prev_distance, next_distance, prev_time, next_time)
-        for j in xrange(len(item)):
-            single_record = item.iloc[j]
-            time_of_day = single_record.get('time_of_day')
-            stop_num_from_call = single_record.get('stop_num_from_call')
-            estimated_arrival_time = single_record.get('estimated_arrival_time')
-            time_of_day = datetime.strptime(time_of_day, '%Y-%m-%d %H:%M:%S')
-            actual_arrival_time = timestamp - time_of_day
-            actual_arrival_time = actual_arrival_time.total_seconds()
-            dist_along_route = single_record.get('dist_along_route')
-            result.loc[len(result)] = [trip_id, route_id, target_stop, vehicle_id, str(time_of_day), service_date, dist_along_route, stop_num_from_call, estimated_arrival_time, actual_arrival_time, shape_id]
-    return result
+        stop_array, dist_array = shape_stop_dict[shape_id]
+        stop_count = len(stop_array)
+        # a stop id can appear several times in the stop sequence, so the records are stored by the stop id and copied to every column of that stop id
+        unique_stop_array, stop_code = np.unique(stop_array, return_inverse=True)
+        position = np.clip(np.searchsorted(unique_stop_array, next_stop_array[index]), 0, len(unique_stop_array) - 1)
+        in_sequence = unique_stop_array[position] == next_stop_array[index]
+        index, code_index = index[in_sequence], position[in_sequence]
+        row_index, pair_array = pd.factorize(pd.Series(zip(date_array[index], trip_array[index])))
+        row_count = len(pair_array)
+        observed_matrix = np.zeros((row_count, len(unique_stop_array)), dtype=bool)
+        observed_matrix[row_index, code_index] = True
+        time_matrix = np.zeros((row_count, len(unique_stop_array)), dtype='int64')
+        time_matrix[row_index, code_index] = time_array[index]
+        total_distance_matrix = np.zeros((row_count, len(unique_stop_array)))
+        total_distance_matrix[row_index, code_index] = total_distance_array[index]
+        dist_from_stop_matrix = np.full((row_count, len(unique_stop_array)), np.nan)
+        dist_from_stop_matrix[row_index, code_index] = dist_from_stop_array[index]
+        observed_matrix, time_matrix = observed_matrix[:, stop_code], time_matrix[:, stop_code]
+        total_distance_matrix, dist_from_stop_matrix = total_distance_matrix[:, stop_code], dist_from_stop_matrix[:, stop_code]
+        # the prev stop and the next stop with a record for each stop
+        stop_index = np.arange(stop_count)
+        prev_matrix = np.maximum.accumulate(np.where(observed_matrix, stop_index, -1), axis=1)
+        next_matrix = np.minimum.accumulate(np.where(observed_matrix, stop_index, stop_count)[:, ::-1], axis=1)[:, ::-1]
+        next_matrix = np.concatenate([next_matrix[:, 1:], np.full((row_count, 1), stop_count, dtype=next_matrix.dtype)], axis=1)
+        valid_matrix = (prev_matrix >= 0) & (next_matrix < stop_count)
+        row_matrix = np.repeat(np.arange(row_count)[:, np.newaxis], stop_count, axis=1)
+        prev_matrix = np.clip(prev_matrix, 0, stop_count - 1)
+        next_matrix = np.clip(next_matrix, 0, stop_count - 1)
+        prev_time = time_matrix[row_matrix, prev_matrix]
+        next_time = time_matrix[row_matrix, next_matrix]
+        prev_distance = total_distance_matrix[row_matrix, prev_matrix]
+        next_distance = total_distance_matrix[row_matrix, next_matrix]
+        at_stop = (prev_matrix == stop_index) & (dist_from_stop_matrix[row_matrix, prev_matrix] == 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = (dist_array - prev_distance) / (next_distance - prev_distance)
+            duration_prev_stop = ratio * ((next_time - prev_time) / 1000000.0)
+        valid_matrix &= at_stop | np.isfinite(duration_prev_stop)
+        # the prev stop and the next stop should be different stop ids, and only the first column of each stop id is kept
+        valid_matrix &= stop_array[prev_matrix] != stop_array[next_matrix]
+        first_column = np.zeros(stop_count, dtype=bool)
+        first_column[np.unique(stop_array, return_index=True)[1]] = True
+        valid_matrix &= first_column
+        duration_prev_stop[~np.isfinite(duration_prev_stop)] = 0.0
+        arrival_matrix = np.where(at_stop, prev_time, prev_time + epoch_time.seconds_to_microseconds(duration_prev_stop))
+        row_index, column_index = np.nonzero(valid_matrix)
+        pair_date_array, pair_trip_array = [np.asarray(item) for item in zip(*pair_array)]
+        result_list.append(pd.DataFrame({'service_date': pair_date_array[row_index], 'trip_id': pair_trip_array[row_index], 'stop_id': stop_array[column_index], 'arrival_time': arrival_matrix[row_index, column_index]}, columns=column_list))
+    if result_list == []:
+        return pd.DataFrame(columns=column_list)
+    return pd.concat(result_list, ignore_index=True)
+
+
+def prepare_stop_arrival_table(full_history, date_list, shape_list, route_stop_dist, shape_stop_dict=None):
+    """
+    Read and filter the history table, and calculate the actual arrival time at every stop of each trip
+
+    :param full_history: dataframe for the historical data, the path of the partitioned history store or the db_io.DatabaseTable of the history table
+    :param date_list: the service dates to read
+    :param shape_list: the shape ids to read
+    :param route_stop_dist: dataframe for the route_stop_dist.csv file
+    :param shape_stop_dict: the stop arrays of each shape id from obtain_shape_stop_dict. If it is None, it is built from route_stop_dist
+    :return: dataframe of the arrival time at every stop, see generate_stop_arrival_table
+    """
+    full_history = partition_store.select_table(full_history, date_list, shape_list)
+    # filter the history data of all the trips at once
+    full_history = history_filter.filter_history(full_history, route_stop_dist, key_column='shape_id')
+    full_history = epoch_time.ensure_time_columns(full_history)
+    return generate_stop_arrival_table(full_history, route_stop_dist, shape_stop_dict)
 
 
+def generate_actual_arrival_time(full_history, segment_df, route_stop_dist, stop_arrival_table=None):
+    """
+    Calculate the actual arrival time from the dataset
 
+    Algorithm:
+    Filter the history data of all the trips
+    Calculate the actual arrival time at every stop of each trip once, see generate_stop_arrival_table
+    Sort the estimated records by (service_date, trip_id, stop_id)
+    Merge the estimated records with the arrival time by (service_date, trip_id, stop_id)
+    actual_arrival_time = arrival time at the target stop - time_of_day of the record
 
+    :param full_history: dataframe for the historical data, the path of the partitioned history store or the db_io.DatabaseTable of the history table
+    :param segment_df: dataframe for the preprocessed average travel duration for the segmet data
+    :param route_stop_dist: dataframe for the route_stop_dist.csv file
+    :param stop_arrival_table: the arrival time at every stop from prepare_stop_arrival_table. If it is None, it is calculated from full_history
+    :return: dataframe including both of the estimated arrival time and actual arrival time
+    """
+    column_list = ['trip_id', 'route_id', 'stop_id', 'vehicle_id', 'time_of_day', 'service_date', 'dist_along_route', 'stop_num_from_call', 'estimated_arrival_time', 'actual_arrival_time', 'shape_id', 'epoch_time', 'seconds_of_day']
+    if stop_arrival_table is None:
+        stop_arrival_table = prepare_stop_arrival_table(full_history, set(segment_df.service_date), set(segment_df.shape_id), route_stop_dist)
+    segment_df = epoch_time.ensure_time_columns(segment_df, 'time_of_day')
+    print 'length of the segment_df is: ', len(segment_df)
+
+    # the records are in the order of (service_date, trip_id, stop_id), and the route id, the shape id and the vehicle id are the same for each (service_date, trip_id, stop_id)
+    estimated_table = pd.DataFrame({'service_date': segment_df['service_date'].values, 'trip_id': np.asarray(segment_df['trip_id'], dtype=object), 'stop_id': segment_df['stop_id'].values})
+    estimated_table = estimated_table.sort_values(['service_date', 'trip_id', 'stop_id'], kind='mergesort')
+    segment_df = segment_df.iloc[estimated_table.index.values]
+    key_table = pd.DataFrame({'service_date': segment_df['service_date'].values.astype('int64'), 'trip_id': np.asarray(segment_df['trip_id'], dtype=object), 'stop_id': segment_df['stop_id'].values.astype('int64')})
+    first_table = key_table.drop_duplicates().copy()
+    for column in ['route_id', 'shape_id', 'vehicle_id']:
+        first_table[column] = np.asarray(segment_df[column], dtype=object)[first_table.index.values]
+    stop_arrival_table = pd.DataFrame({'service_date': stop_arrival_table['service_date'].values.astype('int64'), 'trip_id': stop_arrival_table['trip_id'].values, 'stop_id': stop_arrival_table['stop_id'].values.astype('int64'), 'arrival_time': stop_arrival_table['arrival_time'].values})
+    key_table = key_table.merge(first_table, how='left', on=['service_date', 'trip_id', 'stop_id'])
+    key_table = key_table.merge(stop_arrival_table, how='left', on=['service_date', 'trip_id', 'stop_id'])
+    if len(key_table) != len(segment_df):
+        # generate_stop_arrival_table keeps at most one arrival time for each (service_date, trip_id, stop_id)
+        raise ValueError("the stop arrival table has several arrival times for the same stop of a trip")
+    selected = key_table['arrival_time'].notnull().values
+    segment_df = segment_df[selected]
+    key_table = key_table[selected]
+    current_time = segment_df['epoch_time'].values.astype('int64')
+    result = pd.DataFrame({
+        'trip_id': segment_df['trip_id'].values,
+        'route_id': key_table['route_id'].values,
+        'stop_id': segment_df['stop_id'].values,
+        'vehicle_id': key_table['vehicle_id'].values,
+        'time_of_day': segment_df['time_of_day'].values,
+        'service_date': segment_df['service_date'].values,
+        'dist_along_route': segment_df['dist_along_route'].values,
+        'stop_num_from_call': segment_df['stop_num_from_call'].values,
+        'estimated_arrival_time': segment_df['estimated_arrival_time'].values,
+        'actual_arrival_time': (key_table['arrival_time'].values.astype('int64') - current_time * 1000000) / 1000000.0,
+        'shape_id': key_table['shape_id'].values,
+        'epoch_time': current_time,
+        'seconds_of_day': current_time % 86400}, columns=column_list)
+    return result
 
 
 #################################################################################################################
@@ -469,30 +720,106 @@ def preprocess_baseline1(segment_df):
     return result
 
 
-def preprocess_baseline2(segment_df, rush_hour):
+def preprocess_baseline2(segment_df, rush_hour, bin_width=None):
     """
-    Preprocess the segment data considering the weather and the rush hour
+    Preprocess the segment data considering the weather, the rush hour and the time of day
+
+    The average travel duration is stored in a dense array indexed by (segment, weather, rush_hour, time bin), so the travel duration of all the api data can be gathered at once. The time of day is split into bins of bin_width seconds. When a cell is empty, the average travel duration of the coarser cell is used.
 
     Algorithm:
     Preprocess segment_df to add a new column of rush hour
-    split the dataframe with groupby(segment_start, segment_end, weather, rush_hour)
-    Define the new dataframe
-    For name, item in grouped:
-        calcualte the average travel duration
-        save the record into the new dataframe
+    number the (segment_start, segment_end) tuples and the weathers, and calculate the time bin from the seconds of day
+    calculate the sum and the count of the travel duration of each (segment, weather, rush_hour, time bin) cell
+    for each empty cell:
+        use the average travel duration of (segment, weather, rush_hour) over all the time bins
+        if it is also empty, use the average of the average travel duration of all the segments with (weather, rush_hour)
+    the (weather, rush_hour) without any segment data is not filled
 
     :param segment_df: dataframe after adding the rush hour from final_segment.csv file
-    :param rush_hour: tuple to express which is the rush hour, example: ('17:00:00', '20:00:00')
-    :return: dataframe for the baseline2
-    """
-    # Preprocess segment_df to add a new column of rush hour
-    rush_hour_column = segment_df['timestamp'].apply(lambda x: x[11:19] < rush_hour[1] and x[11:19] > rush_hour[0])
-    new_segment_df = segment_df
-    new_segment_df['rush_hour'] = rush_hour_column
-    grouped = new_segment_df.groupby(['segment_start', 'segment_end', 'weather', 'rush_hour'])
-    result = grouped['travel_duration'].mean()
-    result = result.reset_index()
-    return result
+    :param rush_hour: tuple to express which is the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples
+    :param bin_width: width of the time bins in seconds, example: 3600 for the hour of day. If it is None, the time of day is not considered
+    :return: dictionary of the travel time cube:
+        'segment_index': MultiIndex of the (segment_start, segment_end) tuples
+        'weather': array of the weathers
+        'bin_width': the width of the time bins
+        'duration': array of the average travel duration with the shape (segment, weather, rush_hour, time bin), nan for the (weather, rush_hour) without any segment data
+        'average': array of the average travel duration of the segments which are not in segment_index with the shape (weather, rush_hour, time bin)
+        'count': array of the number of the segment records with the shape (weather, rush_hour)
+    """
+    segment_df = epoch_time.ensure_time_columns(segment_df, 'timestamp')
+    segment_df = segment_df[segment_df['travel_duration'].notnull()]
+    rush_hour_array = context_features.add_rush_hour(pd.DataFrame({'seconds_of_day': segment_df['seconds_of_day'].values}), rush_hour, inclusive=False, seconds_column='seconds_of_day')['rush_hour'].values.astype(int)
+    segment_index = segment_df.groupby(['segment_start', 'segment_end']).size().index
+    segment_code = segment_index.get_indexer(pd.MultiIndex.from_arrays([segment_df['segment_start'].values, segment_df['segment_end'].values]))
+    weather_array = np.unique(segment_df['weather'].values)
+    weather_code = np.searchsorted(weather_array, segment_df['weather'].values)
+    bin_count = 1 if bin_width is None else int(np.ceil(86400.0 / bin_width))
+    bin_code = obtain_time_bin(segment_df['seconds_of_day'].values, bin_width, bin_count)
+    shape = (len(segment_index), len(weather_array), 2, bin_count)
+    flat_index = np.ravel_multi_index((segment_code, weather_code, rush_hour_array, bin_code), shape)
+    duration_array = segment_df['travel_duration'].values.astype(float)
+    size = int(np.prod(shape))
+    sum_cube = np.bincount(flat_index, weights=duration_array, minlength=size).reshape(shape)
+    count_cube = np.bincount(flat_index, minlength=size).reshape(shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # average travel duration of (segment, weather, rush_hour) over all the time bins
+        segment_count = count_cube.sum(axis=3)
+        segment_average = sum_cube.sum(axis=3) / segment_count
+        # average of the segment averages of (weather, rush_hour)
+        cell_average = np.where(segment_count > 0, segment_average, 0.0).sum(axis=0) / (segment_count > 0).sum(axis=0)
+        duration_cube = sum_cube / count_cube
+    fallback = np.where(segment_count > 0, segment_average, cell_average[np.newaxis, :, :])
+    duration_cube = np.where(count_cube > 0, duration_cube, fallback[:, :, :, np.newaxis])
+    travel_time_cube = {
+        'segment_index': segment_index,
+        'weather': weather_array,
+        'bin_width': bin_width,
+        'duration': duration_cube,
+        'average': np.repeat(cell_average[:, :, np.newaxis], bin_count, axis=2),
+        'count': segment_count.sum(axis=0)
+    }
+    return travel_time_cube
+
+
+def preprocess_baseline3(segment_df, trips):
+    """
+    Calculate the sufficient statistics of the travel duration for baseline3
+
+    Baseline3 uses the average travel duration of the segments without the trip to predict on the same service date. With the sum and the count of the travel duration of every (shape id, service date, trip id, segment), the average without any trip is (sum - own sum) / (count - own count), see obtain_leave_one_out_duration.
+
+    Algorithm:
+    get the shape id of each record in segment_df by the trip id
+    split the dataframe with groupby(shape_id, service_date, trip_id, segment_start, segment_end)
+    calculate the sum and the count of the travel duration
+    sum them up by (shape_id, segment_start, segment_end), (shape_id, service_date, trip_id) and shape_id
+
+    :param segment_df: dataframe for the segment table
+    :param trips: dataframe for the trips.txt file or the GTFSIndex
+    :return: dictionary of the dataframes with the columns sum and count:
+        'trip_segment': indexed by (shape_id, service_date, trip_id, segment_start, segment_end)
+        'segment': indexed by (shape_id, segment_start, segment_end)
+        'trip_shape': indexed by (shape_id, service_date, trip_id)
+        'shape': indexed by shape_id
+    """
+    gtfs = gtfs_index.obtain_gtfs_index(trips)
+    trip_array = np.asarray(segment_df['trip_id'], dtype=object)
+    shape_dict = dict([(trip_id, gtfs.shape_dict.get(trip_id)) for trip_id in set(trip_array)])
+    table = pd.DataFrame({'shape_id': [shape_dict[trip_id] for trip_id in trip_array],
+                          'service_date': segment_df['service_date'].values.astype('int64'),
+                          'trip_id': trip_array,
+                          'segment_start': segment_df['segment_start'].values,
+                          'segment_end': segment_df['segment_end'].values,
+                          'travel_duration': segment_df['travel_duration'].values.astype(float)})
+    table = table[table['shape_id'].notnull()]
+    grouped = table.groupby(['shape_id', 'service_date', 'trip_id', 'segment_start', 'segment_end'])['travel_duration']
+    trip_segment = pd.DataFrame({'sum': grouped.sum().fillna(0.0), 'count': grouped.count()}, columns=['sum', 'count'])
+    segment_statistics = {
+        'trip_segment': trip_segment.sort_index(),
+        'segment': trip_segment.groupby(level=[0, 3, 4]).sum().sort_index(),
+        'trip_shape': trip_segment.groupby(level=[0, 1, 2]).sum().sort_index(),
+        'shape': trip_segment.groupby(level=0).sum().sort_index()
+    }
+    return segment_statistics
 
 
 #################################################################################################################
@@ -511,11 +838,11 @@ def obtain_baseline1(segment_df, api_data, route_stop_dist, trips, full_history,
     :param segment_df: the dataframe for the segment table
     :param api_data: the dataframe for the api_data table
     :param route_stop_dist: the dataframe for the route_stop_dist table
-    :param trips: the dataframe for the trips table
-    :param full_history: the dataframe for the history table
+    :param trips: the dataframe for the trips table or the GTFSIndex
+    :param full_history: the dataframe for the history table, the path of the partitioned history store or the db_io.DatabaseTable of the history table
     :param save_path: path of a csv file to store the baseline1 result
     :param engine: database connect engine
-    :return: the dataframe for baseline1 result
+    :return: the dataframe for baseline1 result with the compact dtypes in schema.py
     """
     preprocessed_segment_data = preprocess_baseline1(segment_df)
     segment_df = generate_estimated_arrival_time(api_data, preprocessed_segment_data, route_stop_dist, trips)
@@ -525,52 +852,37 @@ def obtain_baseline1(segment_df, api_data, route_stop_dist, trips, full_history,
             os.mkdir(save_path)
         baseline_result.to_csv(save_path + tablename + '.csv')
     if engine is not None:
-        baseline_result.to_sql(name=tablename, con=engine, if_exists='replace', index_label='id')
-    return baseline_result
+        db_io.export_table(baseline_result, tablename, engine)
+    return schema.apply_schema(baseline_result, 'baseline')
 
 
 
 # baseline2
-def obtain_baseline2(segment_df, api_data, route_stop_dist, trips, full_history, rush_hour, weather_df, tablename=None, save_path=None, engine=None):
+def obtain_baseline2(segment_df, api_data, route_stop_dist, trips, full_history, rush_hour, weather_df, tablename=None, save_path=None, engine=None, bin_width=None):
     """
     Generate the predicted arrival time and actual arrival time with baseline2
     
     :param segment_df: the dataframe for the segment table
     :param api_data: the dataframe for the api_data table
     :param route_stop_dist: the dataframe for the route_stop_dist table
-    :param trips: the dataframe for the trips table
-    :param full_history: the dataframe for the history table
-    :param rush_hour: tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00')
+    :param trips: the dataframe for the trips table or the GTFSIndex
+    :param full_history: the dataframe for the history table, the path of the partitioned history store or the db_io.DatabaseTable of the history table
+    :param rush_hour: tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples
+    :param weather_df: the dataframe for the weather table
     :param save_path: path of a csv file to store the baseline1 result
     :param engine: database connect engine
-    :return: the dataframe for baseline2 result
-    """
-    preprocessed_segment_data = preprocess_baseline2(segment_df, rush_hour)
-    api_data['rush_hour'] = api_data['time_of_day'].apply(lambda x: rush_hour[1] > x[11:19] > rush_hour[0])
-    grouped_segment_df = preprocessed_segment_data.groupby(['weather', 'rush_hour'])
-    keys = grouped_segment_df.groups.keys()
-    grouped_api_data = api_data.groupby(['date', 'rush_hour'])
-    test_date_list = sorted(list(set(api_data['date'])))
-    estimated_result_list = []
-    for current_date in test_date_list:
-        weather = weather_df[weather_df.date == current_date].iloc[0]['weather']
-        # rush hour
-        if (weather, True) in keys:
-            current_result = generate_estimated_arrival_time(grouped_api_data.get_group((current_date, True)), grouped_segment_df.get_group((weather, True)), route_stop_dist, trips)
-            estimated_result_list.append(current_result)
-        # non rush hour
-        if (weather, False) in keys:
-            current_result = generate_estimated_arrival_time(grouped_api_data.get_group((current_date, False)), grouped_segment_df.get_group((weather, False)), route_stop_dist, trips)
-            estimated_result_list.append(current_result)
-    segment_df = pd.concat(estimated_result_list, ignore_index=True)
+    :param bin_width: width of the time bins in seconds, example: 3600 for the hour of day. If it is None, the time of day is not considered
+    :return: the dataframe for baseline2 result with the compact dtypes in schema.py
+    """
+    segment_df = generate_estimated_arrival_time_baseline2(api_data, segment_df, route_stop_dist, trips, rush_hour, weather_df, bin_width=bin_width)
     baseline_result = generate_actual_arrival_time(full_history, segment_df, route_stop_dist)
     if save_path is not None:
         if not os.path.exists(save_path):
             os.mkdir(save_path)
         baseline_result.to_csv(save_path + tablename + '.csv')
     if engine is not None:
-        baseline_result.to_sql(name=tablename, con=engine, if_exists='replace', index_label='id')
-    return baseline_result
+        db_io.export_table(baseline_result, tablename, engine)
+    return schema.apply_schema(baseline_result, 'baseline')
 
 
 # baseline3
@@ -581,21 +893,126 @@ def obtain_baseline3(segment_df, api_data, route_stop_dist, trips, full_history,
     :param segment_df: the dataframe for the segment table
     :param api_data: the dataframe for the api_data table
     :param route_stop_dist: the dataframe for the route_stop_dist table
-    :param trips: the dataframe for the trips table
-    :param full_history: the dataframe for the history table
+    :param trips: the dataframe for the trips table or the GTFSIndex
+    :param full_history: the dataframe for the history table, the path of the partitioned history store or the db_io.DatabaseTable of the history table
     :param save_path: path of a csv file to store the baseline1 result
     :param engine: database connect engine
-    :return: the dataframe for baseline3 result
+    :return: the dataframe for baseline3 result with the compact dtypes in schema.py
     """
-    segment_df = generate_estimated_arrival_time_baseline3(api_data, segment_df, route_stop_dist, trips)
+    segment_statistics = preprocess_baseline3(segment_df, trips)
+    segment_df = generate_estimated_arrival_time_baseline3(api_data, segment_df, route_stop_dist, trips, segment_statistics)
     baseline_result = generate_actual_arrival_time(full_history, segment_df, route_stop_dist)
     if save_path is not None:
         if not os.path.exists(save_path):
             os.mkdir(save_path)
         baseline_result.to_csv(save_path + tablename + '.csv')
     if engine is not None:
-        baseline_result.to_sql(name=tablename, con=engine, if_exists='replace', index_label='id')
-    return baseline_result
+        db_io.export_table(baseline_result, tablename, engine)
+    return schema.apply_schema(baseline_result, 'baseline')
 
 
 
+
+
+# evaluate several baselines together
+def evaluate_baselines(segment_df, api_data, route_stop_dist, trips, full_history, baseline_list=None, rush_hour=None, weather_df=None, tablename='baseline_evaluation', save_path=None, engine=None, bin_width=None):
+    """
+    Generate the predicted arrival time of several baselines and compare them with the same actual arrival time
+
+    The stop arrays of the shapes and the actual arrival time at every stop are calculated once and shared by all the baselines, so running the three baselines together costs little more than running one of them.
+
+    Algorithm:
+    build the stop arrays of each shape id from route_stop_dist
+    for each baseline in baseline_list:
+        estimate the arrival time of the api data with the shared stop arrays
+    calculate the actual arrival time at every stop of each trip from the history table once
+    merge the estimates of all the baselines by the api data record, and merge the actual arrival time by (service_date, trip_id, stop_id)
+    for each baseline:
+        calculate the MSE and the MAE of the arrival time, and the MSE of the ratio actual_arrival_time / estimated_arrival_time against 1
+
+    :param segment_df: the dataframe for the segment table
+    :param api_data: the dataframe for the api_data table
+    :param route_stop_dist: the dataframe for the route_stop_dist table
+    :param trips: the dataframe for the trips table or the GTFSIndex
+    :param full_history: the dataframe for the history table, the path of the partitioned history store or the db_io.DatabaseTable of the history table
+    :param baseline_list: list of the baselines to run: 'baseline1', 'baseline2' and 'baseline3'. If it is None, all of them are run
+    :param rush_hour: tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples. It is required by baseline2
+    :param weather_df: the dataframe for the weather table. It is required by baseline2
+    :param tablename: the table name for exporting the result. The summary is exported with the table name tablename + '_summary'
+    :param save_path: path of a directory to store the result and the summary in csv files
+    :param engine: database connect engine
+    :param bin_width: width of the time bins of baseline2 in seconds, example: 3600 for the hour of day. If it is None, the time of day is not considered
+    :return: tuple of (result, summary). result is the dataframe with one column of the estimated arrival time for each baseline, named by the baseline, and the actual_arrival_time column. summary is the dataframe with the columns baseline, count, mse_time, mae_time and mse_ratio
+    """
+    if baseline_list is None:
+        baseline_list = ['baseline1', 'baseline2', 'baseline3']
+    for baseline_name in baseline_list:
+        if baseline_name not in ('baseline1', 'baseline2', 'baseline3'):
+            raise ValueError("unknown baseline: " + str(baseline_name))
+    if 'baseline2' in baseline_list and (rush_hour is None or weather_df is None):
+        raise ValueError("rush_hour and weather_df are required by baseline2")
+    gtfs = gtfs_index.obtain_gtfs_index(trips)
+    api_data = epoch_time.ensure_time_columns(api_data, 'time_of_day').reset_index(drop=True)
+    shape_stop_dict = obtain_shape_stop_dict(route_stop_dist)
+    estimated_dict = {}
+    for baseline_name in baseline_list:
+        print "estimate the arrival time with", baseline_name
+        if baseline_name == 'baseline1':
+            estimated_dict[baseline_name] = generate_estimated_arrival_time(api_data, preprocess_baseline1(segment_df), route_stop_dist, gtfs, shape_stop_dict)
+        elif baseline_name == 'baseline2':
+            estimated_dict[baseline_name] = generate_estimated_arrival_time_baseline2(api_data, segment_df, route_stop_dist, gtfs, rush_hour, weather_df, shape_stop_dict, bin_width)
+        else:
+            estimated_dict[baseline_name] = generate_estimated_arrival_time_baseline3(api_data, segment_df, route_stop_dist, gtfs, preprocess_baseline3(segment_df, gtfs), shape_stop_dict)
+
+    # the actual arrival time is calculated once for all the baselines
+    stop_arrival_table = prepare_stop_arrival_table(full_history, set(api_data['date']), set(api_data['shape_id']), route_stop_dist, shape_stop_dict)
+    position = np.unique(np.concatenate([np.asarray(estimated_dict[baseline_name].index, dtype=int) for baseline_name in baseline_list]))
+    selected_api_data = api_data.iloc[position]
+    trip_array = np.asarray(selected_api_data['trip_id'], dtype=object)
+    route_dict = dict([(trip_id, gtfs.route_id(trip_id)) for trip_id in set(trip_array)])
+    epoch_array = selected_api_data['epoch_time'].values.astype('int64')
+    result = pd.DataFrame({
+        'trip_id': trip_array,
+        'route_id': [route_dict[trip_id] for trip_id in trip_array],
+        'stop_id': selected_api_data['stop_id'].values,
+        'vehicle_id': np.asarray(selected_api_data['vehicle_id']),
+        'time_of_day': selected_api_data['time_of_day'].values,
+        'service_date': selected_api_data['date'].values,
+        'dist_along_route': selected_api_data['dist_along_route'].values,
+        'shape_id': np.asarray(selected_api_data['shape_id']),
+        'epoch_time': epoch_array,
+        'seconds_of_day': epoch_array % 86400}, index=position,
+        columns=['trip_id', 'route_id', 'stop_id', 'vehicle_id', 'time_of_day', 'service_date', 'dist_along_route', 'shape_id', 'epoch_time', 'seconds_of_day'])
+    stop_num_from_call = pd.Series(np.nan, index=position)
+    for baseline_name in baseline_list:
+        estimated_result = estimated_dict[baseline_name]
+        result[baseline_name] = estimated_result['estimated_arrival_time'].astype(float)
+        stop_num_from_call = stop_num_from_call.combine_first(estimated_result['stop_num_from_call'].astype(float))
+    result['stop_num_from_call'] = stop_num_from_call.reindex(position).values
+    key_table = pd.DataFrame({'service_date': result['service_date'].values.astype('int64'), 'trip_id': trip_array, 'stop_id': result['stop_id'].values.astype('int64')})
+    stop_arrival_table = pd.DataFrame({'service_date': stop_arrival_table['service_date'].values.astype('int64'), 'trip_id': stop_arrival_table['trip_id'].values, 'stop_id': stop_arrival_table['stop_id'].values.astype('int64'), 'arrival_time': stop_arrival_table['arrival_time'].values})
+    arrival_time = key_table.merge(stop_arrival_table, how='left', on=['service_date', 'trip_id', 'stop_id'])['arrival_time'].values
+    if len(arrival_time) != len(result):
+        # generate_stop_arrival_table keeps at most one arrival time for each (service_date, trip_id, stop_id)
+        raise ValueError("the stop arrival table has several arrival times for the same stop of a trip")
+    result['actual_arrival_time'] = (arrival_time - epoch_array * 1000000) / 1000000.0
+    result = result[result['actual_arrival_time'].notnull()]
+    result = result.sort_values(['service_date', 'trip_id', 'stop_id'], kind='mergesort').reset_index(drop=True)
+
+    # the error summary of each baseline
+    summary_list = []
+    for baseline_name in baseline_list:
+        single_result = result[result[baseline_name].notnull()]
+        error = single_result['actual_arrival_time'] - single_result[baseline_name]
+        ratio = single_result['actual_arrival_time'] / single_result[baseline_name]
+        summary_list.append((baseline_name, len(single_result), (error ** 2).mean(), error.abs().mean(), ((ratio - 1.0) ** 2).mean()))
+    summary = pd.DataFrame(summary_list, columns=['baseline', 'count', 'mse_time', 'mae_time', 'mse_ratio'])
+    if save_path is not None:
+        if not os.path.exists(save_path):
+            os.mkdir(save_path)
+        result.to_csv(save_path + tablename + '.csv')
+        summary.to_csv(save_path + tablename + '_summary.csv')
+    if engine is not None:
+        db_io.export_table(result, tablename, engine)
+        db_io.export_table(summary, tablename + '_summary', engine)
+    return schema.apply_schema(result, 'baseline'), summary
@@ -5,8 +5,15 @@ predict the estimated arrival time based on the
 # import module
 import baseline
 import os
+import sys
 import pandas as pd
-from datetime import datetime, timedelta
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'preprocess'))
+import gtfs_index
+import context_features
+import epoch_time
+import schema
+import db_io
 
 #################################################################################################################
 #                                    build dataset                                                              #
@@ -34,18 +41,20 @@ def generate_complete_dateset(api_data, segment_df, route_stop_dist, trips, full
     :param route_stop_idst:
     :param trips:
     :param full_history:
+    :param weather_df: the dataframe for the weather table
+    :param rush_hour: tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples
     :return:
     """
     print "start to export the result of the dataset"
-    weather_df['date'] = pd.to_numeric(weather_df['date'])
     result = baseline.obtain_baseline3(segment_df, api_data, route_stop_dist, trips, full_history)
     result['service_date'] = pd.to_numeric(result['service_date'])
-    result['weather'] = result['service_date'].apply(lambda x: weather_df[weather_df.date == x].iloc[0]['weather'])
-    result['rush_hour'] = result['time_of_day'].apply(lambda x: 1 if rush_hour[1] >= x[11:19] >= rush_hour[0] else 0)
+    result = context_features.add_weather(result, weather_df)
+    result = context_features.add_rush_hour(result, rush_hour, time_column='time_of_day', seconds_column='seconds_of_day')
+    result['rush_hour'] = result['rush_hour'].astype(int)
     return result
 
 
-def generate_feature_api(single_segment, dist_along_route, target_dist, time_of_day, single_route_stop_dist):
+def generate_feature_api(single_segment, dist_along_route, target_dist, time_of_day, single_route_stop_dist, current_time):
     """
     Generate the api list for calculating the average delay
 
@@ -59,6 +68,7 @@ def generate_feature_api(single_segment, dist_along_route, target_dist, time_of_
     :param target_dist:
     :param time_of_day:
     :param single_route_stop_dist:
+    :param current_time: the time_of_day in epoch seconds
     :return:
     """
     feature_api = pd.DataFrame(columns=['actual_arrival_time'])
@@ -93,6 +103,8 @@ def generate_feature_api(single_segment, dist_along_route, target_dist, time_of_
     feature_api['date'] = current_segment['service_date']
     feature_api['dist_along_route'] = dist_along_route
     feature_api['shape_id'] = single_route_stop_dist.iloc[0]['shape_id']
+    feature_api['epoch_time'] = current_time
+    feature_api['seconds_of_day'] = current_time % 86400
 
     return feature_api
 
@@ -114,12 +126,11 @@ def obtain_prev_trip(single_segment, stop_id, time_of_day):
 
     :param single_segment:
     :param stop_id:
-    :param time_of_day:
+    :param time_of_day: the time of day in epoch seconds
     :return:
     """
     # divide the single_history through groupby([trip id, service date])
     grouped = single_segment.groupby(['trip_id', 'service_date'])
-    time_of_day = datetime.strptime(time_of_day, '%Y-%m-%d %H:%M:%S')
     result = []
     for name, item in grouped:
         # obtain trip id and service date from name
@@ -129,8 +140,7 @@ def obtain_prev_trip(single_segment, stop_id, time_of_day):
         single_record = item[item['segment_start'] == stop_id]
         if len(single_record) == 0:
             continue
-        arrival_time = single_record.iloc[0]['timestamp']
-        arrival_time = datetime.strptime(arrival_time[:19], '%Y-%m-%d %H:%M:%S')
+        arrival_time = single_record.iloc[0]['epoch_time']
 
         # compare the arrival time and the time_of_day to obtain the maximum available arrival time
         if arrival_time <= time_of_day:
@@ -153,14 +163,14 @@ def obtain_time_of_day(single_segment, dist_along_route, single_route_stop_dist)
     :param single_segment:
     :param dist_along_route:
     :param single_route_stop_dist:
-    :return:
+    :return: the time of day in epoch microseconds
     """
     # use the dist_along_route find the corresponding segment pair
     flag = 0
     for i in xrange(len(single_segment)):
         prev_stop = single_segment.iloc[i]['segment_start']
         next_stop = single_segment.iloc[i]['segment_end']
-        prev_timestamp = single_segment.iloc[i]['timestamp']
+        prev_timestamp = single_segment.iloc[i]['epoch_time']
         travel_duration = single_segment.iloc[i]['travel_duration']
         prev_distance = single_route_stop_dist[single_route_stop_dist['stop_id'] == prev_stop].iloc[0]['dist_along_route']
         next_distance = single_route_stop_dist[single_route_stop_dist['stop_id'] == next_stop].iloc[0]['dist_along_route']
@@ -173,16 +183,16 @@ def obtain_time_of_day(single_segment, dist_along_route, single_route_stop_dist)
         return None
 
     # calculate the time_of_day according to the dist_along_route within that segment pair
-    prev_timestamp = datetime.strptime(prev_timestamp[:19], '%Y-%m-%d %H:%M:%S')
-    travel_duration = timedelta(0, travel_duration)
+    prev_timestamp = int(prev_timestamp) * 1000000
+    travel_duration = int(epoch_time.seconds_to_microseconds([travel_duration])[0])
     next_timestamp = prev_timestamp + travel_duration
     time_of_day = baseline.calculate_arrival_time(dist_along_route, prev_distance, next_distance, prev_timestamp, next_timestamp)
 
-    return str(time_of_day)
+    return time_of_day
 
 
 
-def calculate_average_delay(feature_api, segment_df, route_stop_dist, trips):
+def calculate_average_delay(feature_api, segment_df, route_stop_dist, trips, segment_statistics=None):
     """
     calculate the average arrival time
 
@@ -195,12 +205,13 @@ def calculate_average_delay(feature_api, segment_df, route_stop_dist, trips):
     :param segment_df:
     :param route_stop_dist:
     :param trips:
+    :param segment_statistics: the sufficient statistics of the segment table from baseline.preprocess_baseline3. If it is None, it is calculated from segment_df
     :return:
 
     'trip_id', 'vehicle_id', 'route_id', 'stop_id', 'time_of_day', 'date', 'dist_along_route'
     """
     # run baseline3 algorithm for the estimated arrival time
-    result = baseline.generate_estimated_arrival_time_baseline3(feature_api, segment_df, route_stop_dist, trips)
+    result = baseline.generate_estimated_arrival_time_baseline3(feature_api, segment_df, route_stop_dist, trips, segment_statistics)
     feature_api.reset_index(inplace=True)
     result['actual_arrival_time'] = feature_api['actual_arrival_time']
 
@@ -294,7 +305,10 @@ def preprocess_dataset(total_baseline_result, segment_df, route_stop_dist, trips
     :param trips:
     :return:
     """
-    grouped = total_baseline_result.groupby(['shape_id'])
+    gtfs = gtfs_index.obtain_gtfs_index(trips)
+    # the sufficient statistics for the average delay of baseline3 are calculated once for all the records
+    segment_statistics = baseline.preprocess_baseline3(segment_df, gtfs)
+    grouped = total_baseline_result.groupby(np.asarray(total_baseline_result['shape_id']))
     result_list = []
     for shape_id, baseline_result in grouped:
         print "length of the baseline_result table: ", len(baseline_result)
@@ -312,28 +326,30 @@ def preprocess_dataset(total_baseline_result, segment_df, route_stop_dist, trips
             stop_id = single_record.get('stop_id')
             dist_along_route = single_record.get('dist_along_route')
             time_of_day = single_record.get('time_of_day')
+            current_time = single_record.get('epoch_time')
             single_route_stop_dist = route_stop_dist[route_stop_dist['shape_id'] == shape_id]
 
             # generate delay of the current trip
             single_segment = segment_df[(segment_df.trip_id == trip_id) & (segment_df.service_date.isin([service_date]))]
-            single_segment = single_segment[single_segment['timestamp'] <= time_of_day]
+            single_segment = single_segment[single_segment['epoch_time'] <= current_time]
             if len(single_segment) == 0:
                 continue
             current_time_of_day = single_segment.iloc[0]['timestamp']
+            current_epoch_time = single_segment.iloc[0]['epoch_time']
             target_dist = dist_along_route
             initial_dist = single_route_stop_dist[single_route_stop_dist['stop_id'] == single_segment.iloc[1]['segment_start']].iloc[0]['dist_along_route']
             if initial_dist >= target_dist:
                 continue
-            feature_api = generate_feature_api(single_segment, initial_dist, target_dist, current_time_of_day, single_route_stop_dist)
+            feature_api = generate_feature_api(single_segment, initial_dist, target_dist, current_time_of_day, single_route_stop_dist, current_epoch_time)
             if feature_api is None:
                 continue
-            delay_current_trip, ratio_current_trip = calculate_average_delay(feature_api[-1:], segment_df, route_stop_dist, trips)
+            delay_current_trip, ratio_current_trip = calculate_average_delay(feature_api[-1:], segment_df, route_stop_dist, gtfs, segment_statistics)
             # print delay_current_trip
 
             # generate the delay of the previous trip
-            trip_list = list(trips[trips['shape_id'] == shape_id]['trip_id'])
+            trip_list = list(gtfs.trip_set(shape_id))
             single_segment = segment_df[(segment_df.trip_id.isin(trip_list)) & (segment_df.service_date.isin([service_date - 1, service_date]))]
-            prev_trip_list = obtain_prev_trip(single_segment, stop_id, time_of_day)
+            prev_trip_list = obtain_prev_trip(single_segment, stop_id, current_time)
             if prev_trip_list == []:
                 continue
             current_segment = single_segment
@@ -344,11 +360,13 @@ def preprocess_dataset(total_baseline_result, segment_df, route_stop_dist, trips
                     break
             if current_time_of_day is None:
                 continue
+            current_epoch_time = current_time_of_day // 1000000
+            current_time_of_day = epoch_time.format_timestamp([current_time_of_day])[0]
             target_dist = single_route_stop_dist[single_route_stop_dist['stop_id'] == stop_id].iloc[0]['dist_along_route']
-            feature_api = generate_feature_api(single_segment, dist_along_route, target_dist, current_time_of_day, single_route_stop_dist)
+            feature_api = generate_feature_api(single_segment, dist_along_route, target_dist, current_time_of_day, single_route_stop_dist, current_epoch_time)
             if feature_api is None:
                 continue
-            delay_prev_trip, ratio_prev_trip = calculate_average_delay(feature_api[-1:], segment_df, route_stop_dist, trips)
+            delay_prev_trip, ratio_prev_trip = calculate_average_delay(feature_api[-1:], segment_df, route_stop_dist, gtfs, segment_statistics)
             # print delay_prev_trip
 
             # generate the prev_arrival_time
@@ -373,7 +391,7 @@ def preprocess_dataset(total_baseline_result, segment_df, route_stop_dist, trips
             # calculate the prev_arrival_time
             filtered_segment = segment_df[segment_df.service_date.isin([service_date - 1, service_date])]
             filtered_segment = filtered_segment[(filtered_segment.segment_start.isin(filtered_stop_sequence[:-1])) & (filtered_segment.segment_end.isin(filtered_stop_sequence[1:]))]
-            filtered_segment = filtered_segment[filtered_segment['timestamp'].apply(lambda x: datetime.strptime(x[:19], '%Y-%m-%d %H:%M:%S') <= datetime.strptime(time_of_day, '%Y-%m-%d %H:%M:%S'))]
+            filtered_segment = filtered_segment[filtered_segment['epoch_time'] <= current_time]
             prev_arrival_time = calculate_prev_arrival_time(filtered_segment, segment_list, dist_along_route, single_route_stop_dist)
 
             # 'weather', 'rush_hour', 'baseline_result', 'delay_current_trip', 'delay_prev_trip', 'prev_arrival_time', 'delay_neighbor_stops',
@@ -396,15 +414,17 @@ def obtain_dataset(startdate, api_data, segment_df, route_stop_dist, trips, full
     :param api_data: the dataframe for the api_data table
     :param segment_df: the dataframe for the segment table
     :param route_stop_dist: the dataframe for the route_stop_dist table
-    :param trips: the dataframe for the trips.txt file in the GTFS dataset
-    :param full_history: the dataframe for the history table
+    :param trips: the dataframe for the trips.txt file in the GTFS dataset or the GTFSIndex
+    :param full_history: the dataframe for the history table, the path of the partitioned history store or the db_io.DatabaseTable of the history table
     :param weather_df: the dataframe for the weather table
-    :param rush_hour: the tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00')
+    :param rush_hour: the tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples for several rush hour windows
     :param tablename: the table name for exporting the file
     :param save_path: path of a csv file to store the baseline1 result
     :param engine: database connector
-    :return: the dataframe for the dataset table
+    :return: the dataframe for the dataset table with the compact dtypes in schema.py
     """
+    trips = gtfs_index.obtain_gtfs_index(trips)
+    segment_df = epoch_time.ensure_time_columns(segment_df)
     # generate the complete dataset
     print "generate the complete dataset"
     # api_data, segment_df, route_stop_dist, trips, full_history, weather_df, rush_hour
@@ -419,9 +439,9 @@ def obtain_dataset(startdate, api_data, segment_df, route_stop_dist, trips, full
             os.mkdir(save_path)
         dataset.to_csv(save_path+tablename + '.csv')
     if engine is not None and tablename is not None:
-        dataset.to_sql(name=tablename, con=engine, if_exists='replace', index_label='id')
+        db_io.export_table(dataset, tablename, engine)
 
-    return dataset
+    return schema.apply_schema(dataset, 'dataset')
 
 
 
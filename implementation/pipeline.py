@@ -0,0 +1,442 @@
+"""
+Run the stages from the history table to the dataset table with a cache of the results
+
+Each stage is declared with the function to call, the results of other stages used as its inputs and its parameters. The key of a stage is the md5 of its name, version, function, parameters and the keys of its input stages, so it is changed when anything upstream is changed. The result of each stage is saved in the cache directory by its key:
+
+    cache_path/
+        route_stop_dist/
+            <key>.pkl
+        segment/
+            <key>.pkl
+        ...
+
+When the pipeline is run again, the stages whose keys are in the cache are not run, and their results are only read when they are required by a stage to run or returned to the user. The stages whose inputs are ready are run at the same time by a pool of threads.
+
+The parameters are hashed by their content: the dataframes by their values, the GTFSIndex by its version and the files or directories wrapped by FileInput by the content of the files. A dataframe or FileInput shared by several stages is hashed once in each run. Other strings are hashed as strings, so the path of the output directory doesn't change the key when the files in it are changed. The db_io.DatabaseTable is hashed by the url and the table name, so the version of the stage should be changed when the table in the database is changed.
+
+list of functions:
+
+* Stage: declare a stage of the pipeline
+* FileInput: a file or directory parameter hashed by its content
+* run_pipeline: run the stages and reuse the cached results
+* obtain_pipeline: the stages from route_stop_dist to the dataset table
+"""
+
+# import modules
+import pandas as pd
+import numpy as np
+import os
+import sys
+import time
+import hashlib
+import cPickle as pickle
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'preprocess'))
+import data_collection
+import gtfs_index
+import db_io
+import schema
+import baseline
+import build_dataset
+
+
+class Stage(object):
+    """
+    A stage of the pipeline
+    """
+
+    def __init__(self, name, function, inputs=None, params=None, version=1):
+        """
+        :param name: the name of the stage, which is also the name of the directory of its results in the cache
+        :param function: the function to run the stage. It is called with the results of the input stages and the parameters as the keyword arguments
+        :param inputs: dictionary from the name of the argument to the name of the input stage, example: {'route_stop_dist': 'route_stop_dist'}
+        :param params: dictionary from the name of the argument to the value, example: {'stop_num': 3}
+        :param version: the version of the stage. Change it when the code of the function is changed, so the cached results are not used
+        """
+        self.name = name
+        self.function = function
+        self.inputs = {} if inputs is None else dict(inputs)
+        self.params = {} if params is None else dict(params)
+        self.version = version
+
+
+class FileInput(object):
+    """
+    A file or directory given to a stage as a parameter. The stage receives the path, and the key of the stage is calculated from the content of the files.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the file or the directory
+        """
+        self.path = path
+
+
+#################################################################################################################
+#                                    helper function                                                            #
+#################################################################################################################
+
+
+def hash_file(path, md5):
+    """
+    Update the md5 with the content of a file or all the files in a directory
+
+    :param path: path of the file or the directory
+    :param md5: the md5 object
+    :return: None
+    """
+    if os.path.isdir(path):
+        for root, dir_list, file_list in os.walk(path):
+            dir_list.sort()
+            for filename in sorted(file_list):
+                filepath = os.path.join(root, filename)
+                md5.update(repr(os.path.relpath(filepath, path)))
+                hash_file(filepath, md5)
+        return
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), ''):
+            md5.update(block)
+
+
+def hash_array(array, md5):
+    """
+    Update the md5 with the dtype and the values of an array
+
+    :param array: the numpy array
+    :param md5: the md5 object
+    :return: None
+    """
+    md5.update(str(array.dtype) + repr(array.shape))
+    if array.dtype == object:
+        md5.update('\x00'.join([repr(value) for value in array.tolist()]))
+    else:
+        md5.update(np.ascontiguousarray(array).tobytes())
+
+
+def hash_content(value, md5):
+    """
+    Update the md5 with the content of a dataframe or the files of a FileInput
+
+    :param value: the dataframe or the FileInput
+    :param md5: the md5 object
+    :return: None
+    """
+    if isinstance(value, pd.DataFrame):
+        md5.update(repr(list(value.columns)))
+        hash_array(np.asarray(value.index), md5)
+        for column in value.columns:
+            hash_value(value[column], md5)
+    else:
+        hash_file(value.path, md5)
+
+
+def hash_value(value, md5, digest_dict=None):
+    """
+    Update the md5 with the content of a parameter
+
+    The dataframes and the FileInput objects are hashed into a digest first. If digest_dict is provided, the digest of the same object is calculated once, so a large history table or file shared by several stages is only read once.
+
+    :param value: the value of the parameter
+    :param md5: the md5 object
+    :param digest_dict: dictionary from the id of the dataframes and the FileInput objects to their digests
+    :return: None
+    """
+    if isinstance(value, (pd.DataFrame, FileInput)):
+        if digest_dict is None:
+            digest_dict = {}
+        if id(value) not in digest_dict:
+            value_md5 = hashlib.md5()
+            hash_content(value, value_md5)
+            digest_dict[id(value)] = value_md5.hexdigest()
+        md5.update(type(value).__name__ + digest_dict[id(value)])
+    elif isinstance(value, pd.Series):
+        if str(value.dtype) == 'category':
+            # the categorical column is hashed by its values, so it has the same key as the column of strings
+            hash_array(np.asarray(value, dtype=object), md5)
+        else:
+            hash_array(value.values, md5)
+    elif isinstance(value, np.ndarray):
+        hash_array(value, md5)
+    elif isinstance(value, gtfs_index.GTFSIndex):
+        md5.update('GTFSIndex' + value.version())
+    elif isinstance(value, db_io.DatabaseTable):
+        md5.update('DatabaseTable' + repr((str(value.url), value.tablename, value.table_name)))
+    elif isinstance(value, dict):
+        md5.update('dict')
+        for key in sorted(value):
+            md5.update(repr(key))
+            hash_value(value[key], md5, digest_dict)
+    elif isinstance(value, (list, tuple)):
+        md5.update(type(value).__name__ + str(len(value)))
+        for item in value:
+            hash_value(item, md5, digest_dict)
+    elif isinstance(value, (set, frozenset)):
+        md5.update('set' + repr(sorted(value)))
+    elif callable(value):
+        md5.update('function' + repr((getattr(value, '__module__', None), getattr(value, '__name__', None))))
+    elif value is None or isinstance(value, (basestring, bool, int, long, float, np.generic)):
+        md5.update(type(value).__name__ + repr(value))
+    else:
+        md5.update(pickle.dumps(value, 2))
+
+
+def sort_stage(stage_list):
+    """
+    Sort the stages so that every stage is after its input stages
+
+    :param stage_list: list of the Stage objects
+    :return: list of the sorted Stage objects
+    """
+    stage_dict = {}
+    for stage in stage_list:
+        if stage.name in stage_dict:
+            raise ValueError("duplicated stage: " + stage.name)
+        stage_dict[stage.name] = stage
+    for stage in stage_list:
+        for input_name in stage.inputs.values():
+            if input_name not in stage_dict:
+                raise ValueError("unknown input stage of %s: %s" % (stage.name, input_name))
+    result = []
+    visited = {}
+
+    def visit(stage):
+        if visited.get(stage.name) == 'done':
+            return
+        if visited.get(stage.name) == 'visiting':
+            raise ValueError("the pipeline has a cycle at the stage: " + stage.name)
+        visited[stage.name] = 'visiting'
+        for input_name in sorted(stage.inputs.values()):
+            visit(stage_dict[input_name])
+        visited[stage.name] = 'done'
+        result.append(stage)
+
+    for stage in stage_list:
+        visit(stage)
+    return result
+
+
+def obtain_stage_key(stage, key_dict, digest_dict=None):
+    """
+    Calculate the key of a stage
+
+    :param stage: the Stage object
+    :param key_dict: dictionary from the name of the stage to the key of the input stages
+    :param digest_dict: dictionary of the digests of the dataframes and the FileInput objects shared by the stages, see hash_value
+    :return: the md5 string of the stage
+    """
+    md5 = hashlib.md5()
+    md5.update(repr((stage.name, stage.version)))
+    hash_value(stage.function, md5)
+    for argument in sorted(stage.params):
+        md5.update('param' + repr(argument))
+        hash_value(stage.params[argument], md5, digest_dict)
+    for argument in sorted(stage.inputs):
+        md5.update('input' + repr((argument, key_dict[stage.inputs[argument]])))
+    return md5.hexdigest()
+
+
+def obtain_artifact_path(cache_path, stage_name, key):
+    """
+    :param cache_path: path of the cache directory
+    :param stage_name: the name of the stage
+    :param key: the key of the stage
+    :return: path of the cached result
+    """
+    return os.path.join(cache_path, stage_name, key + '.pkl')
+
+
+def load_artifact(path):
+    """
+    Read the cached result of a stage
+
+    :param path: path of the cached result
+    :return: the result of the stage
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_artifact(result, path):
+    """
+    Save the result of a stage into the cache. The result is written into a temporary file first, so an incomplete file is never read as a cached result.
+
+    :param result: the result of the stage
+    :param path: path of the cached result
+    :return: None
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    temp_path = path + '.%d.tmp' % os.getpid()
+    with open(temp_path, 'wb') as f:
+        pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, path)
+
+
+def execute_stage(args):
+    """
+    Run a stage or read its cached result. It is used by the threads in run_pipeline.
+
+    :param args: tuple of (stage, input_dict, path, run). input_dict is the dictionary from the name of the argument to the result of the input stage. If run is False, the cached result in path is read
+    :return: tuple of (name of the stage, result, whether the stage is run, running time in seconds). If the stage fails, the result is the exception information from sys.exc_info and the third item is None
+    """
+    stage, input_dict, path, run = args
+    start_time = time.time()
+    try:
+        if not run:
+            return stage.name, load_artifact(path), False, time.time() - start_time
+        kwargs = dict(stage.params)
+        for argument, value in stage.params.iteritems():
+            if isinstance(value, FileInput):
+                kwargs[argument] = value.path
+        kwargs.update(input_dict)
+        result = stage.function(**kwargs)
+        if path is not None:
+            save_artifact(result, path)
+        return stage.name, result, True, time.time() - start_time
+    except Exception:
+        return stage.name, sys.exc_info(), None, time.time() - start_time
+
+
+#################################################################################################################
+#                                    main function                                                              #
+#################################################################################################################
+
+
+def run_pipeline(stage_list, cache_path=None, targets=None, threads=4, force_list=None):
+    """
+    Run the stages of the pipeline and reuse the cached results
+
+    Algorithm:
+    sort the stages so that every stage is after its input stages
+    calculate the key of each stage from its name, version, function, parameters and the keys of its input stages
+    from the last stage to the first stage:
+        if the result of the stage is required and its key is not in the cache, the results of its input stages are also required
+    while there is any required stage which is not finished:
+        for each required stage whose input stages are finished:
+            if its key is in the cache, read the cached result in a thread
+            else run the stage in a thread and save the result into the cache
+        wait for a thread to finish
+
+    :param stage_list: list of the Stage objects
+    :param cache_path: path of the cache directory. If it is None, all the stages are run and the results are not saved
+    :param targets: list of the names of the stages to return. If it is None, the stages which are not the input of any other stage are returned
+    :param threads: number of the stages running at the same time
+    :param force_list: list of the names of the stages to run even if their results are in the cache
+    :return: dictionary from the name of the target stage to its result
+    """
+    stage_list = sort_stage(stage_list)
+    stage_dict = dict([(stage.name, stage) for stage in stage_list])
+    if targets is None:
+        input_set = set([input_name for stage in stage_list for input_name in stage.inputs.values()])
+        targets = [stage.name for stage in stage_list if stage.name not in input_set]
+    force_set = set([] if force_list is None else force_list)
+
+    # calculate the keys and check the cache
+    key_dict = {}
+    path_dict = {}
+    run_dict = {}
+    digest_dict = {}
+    for stage in stage_list:
+        key_dict[stage.name] = obtain_stage_key(stage, key_dict, digest_dict)
+        if cache_path is None:
+            path_dict[stage.name] = None
+            run_dict[stage.name] = True
+        else:
+            path_dict[stage.name] = obtain_artifact_path(cache_path, stage.name, key_dict[stage.name])
+            run_dict[stage.name] = stage.name in force_set or not os.path.exists(path_dict[stage.name])
+
+    # only the stages to run and the required results are processed
+    required_set = set(targets)
+    for stage in reversed(stage_list):
+        if stage.name in required_set and run_dict[stage.name]:
+            required_set.update(stage.inputs.values())
+    required_list = [stage.name for stage in stage_list if stage.name in required_set]
+
+    result_dict = {}
+    pending_list = list(required_list)
+    running_set = set()
+    finished_queue = Queue()
+    pool = ThreadPool(threads)
+    error = None
+    try:
+        while pending_list != [] or running_set:
+            if error is None:
+                for stage_name in list(pending_list):
+                    stage = stage_dict[stage_name]
+                    if not run_dict[stage_name] or all([input_name in result_dict for input_name in stage.inputs.values()]):
+                        input_dict = {}
+                        if run_dict[stage_name]:
+                            input_dict = dict([(argument, result_dict[input_name]) for argument, input_name in stage.inputs.iteritems()])
+                        pending_list.remove(stage_name)
+                        running_set.add(stage_name)
+                        pool.apply_async(execute_stage, ((stage, input_dict, path_dict[stage_name], run_dict[stage_name]),), callback=finished_queue.put)
+            elif not running_set:
+                break
+            stage_name, result, run, running_time = finished_queue.get()
+            running_set.discard(stage_name)
+            if run is None:
+                # stop running the other stages and raise the exception after the running stages are finished
+                print "stage: %s failed" % stage_name
+                error = result
+                continue
+            result_dict[stage_name] = result
+            print "stage: %s %s %.1f seconds" % (stage_name, 'run' if run else 'cached', running_time)
+    finally:
+        pool.close()
+        pool.join()
+    if error is not None:
+        raise error[0], error[1], error[2]
+    return dict([(stage_name, result_dict[stage_name]) for stage_name in targets])
+
+
+def obtain_pipeline(trips, stop_times, full_history, weather_df, training_date_list, api_date_list, time_list, stop_num, rush_hour, startdate, seed=1, stop_mode='random', processes=None):
+    """
+    Declare the stages from the route_stop_dist table to the dataset table
+
+    stages and their inputs:
+        route_stop_dist: history table
+        segment: route_stop_dist
+        api_data: route_stop_dist
+        baseline1, baseline2, baseline3: segment, api_data, route_stop_dist
+        dataset: segment, api_data, route_stop_dist
+
+    Other stages like the model selection can be appended to the list with the dataset stage as the input.
+
+    :param trips: the dataframe storing the table from trips.txt file in GTFS dataset or the GTFSIndex
+    :param stop_times: the dataframe storing the table from stop_times.txt file in GTFS dataset
+    :param full_history: the dataframe for the history table, the path of the csv file or the partitioned history store, or the db_io.DatabaseTable of the history table. The csv file is read into a dataframe once with the compact dtypes. The path of the partitioned store is given to the stages and hashed by the content of the files
+    :param weather_df: the dataframe for the weather table
+    :param training_date_list: the list of dates to generate the segment table
+    :param api_date_list: the list of dates to generate the api_data table
+    :param time_list: the list of strings to represent the time for generating api data
+    :param stop_num: the number of target stop for each shape id
+    :param rush_hour: the tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples
+    :param startdate: the start date for obtaining the dataset
+    :param seed: the master seed to choose the target stops. It should not be None, otherwise the cached api_data table is not reproducible
+    :param stop_mode: the way to choose the target stops, see obtain_api_data
+    :param processes: number of worker processes to generate the segment table and the api_data table
+    :return: list of the Stage objects
+    """
+    gtfs = gtfs_index.obtain_gtfs_index(trips, stop_times)
+    if isinstance(full_history, basestring):
+        if os.path.isdir(full_history):
+            full_history = FileInput(full_history)
+        else:
+            # the stages only accept the dataframe, the partitioned store or the DatabaseTable for the history table
+            full_history = schema.read_table(full_history, 'history')
+    history_params = {'trips': gtfs, 'full_history': full_history}
+    table_inputs = {'segment_df': 'segment', 'api_data': 'api_data', 'route_stop_dist': 'route_stop_dist'}
+    stage_list = [
+        Stage('route_stop_dist', data_collection.obtain_route_stop_dist,
+              params={'trips': gtfs, 'stop_times': stop_times, 'history_file': full_history}),
+        Stage('segment', data_collection.obtain_segment, inputs={'route_stop_dist': 'route_stop_dist'},
+              params=dict(history_params, weather_df=weather_df, stop_times=None, training_date_list=list(training_date_list), processes=processes)),
+        Stage('api_data', data_collection.obtain_api_data, inputs={'route_stop_dist': 'route_stop_dist'},
+              params={'full_history': full_history, 'date_list': list(api_date_list), 'time_list': list(time_list), 'stop_num': stop_num, 'seed': seed, 'stop_mode': stop_mode, 'processes': processes}),
+        Stage('baseline1', baseline.obtain_baseline1, inputs=table_inputs, params=history_params),
+        Stage('baseline2', baseline.obtain_baseline2, inputs=table_inputs, params=dict(history_params, rush_hour=rush_hour, weather_df=weather_df)),
+        Stage('baseline3', baseline.obtain_baseline3, inputs=table_inputs, params=history_params),
+        Stage('dataset', build_dataset.obtain_dataset, inputs=table_inputs, params=dict(history_params, startdate=startdate, weather_df=weather_df, rush_hour=rush_hour))
+    ]
+    return stage_list
@@ -0,0 +1,161 @@
+"""
+Attach the context features like weather, rush hour and calendar to a table
+
+All the functions here work on the whole column instead of each row, so the features of a large table like the segment table or the baseline result can be attached in one pass:
+
+* weather: the weather of the service date from the weather table
+* rush_hour: whether the time of day is in one of the rush hour windows
+* day_of_week: the day of week of the service date, Monday is 0
+* seconds_of_day: the number of seconds since the midnight of the time of day
+"""
+
+# import module
+import pandas as pd
+import numpy as np
+
+
+#################################################################################################################
+#                                    helper function                                                            #
+#################################################################################################################
+
+
+def obtain_weather_series(weather_df):
+    """
+    Build the lookup series from the service date to the weather
+
+    :param weather_df: the dataframe for the weather table
+    :return: series of the weather indexed by the service date in integer. The first record is used for the duplicated dates
+    """
+    weather_series = pd.Series(weather_df['weather'].values, index=pd.to_numeric(weather_df['date']).values)
+    return weather_series[~weather_series.index.duplicated()]
+
+
+def obtain_seconds_of_day(time_series):
+    """
+    Calculate the number of seconds since the midnight for a column of time
+
+    :param time_series: series of the time string, example: '2016-01-05 17:00:00' or '2016-01-05T17:00:00Z'
+    :return: array of the number of seconds in integer
+    """
+    if len(time_series) == 0:
+        return np.array([], dtype=np.int64)
+    time_array = pd.to_datetime(time_series).values.astype('datetime64[s]').astype(np.int64)
+    return time_array % 86400
+
+
+def parse_time(time_string):
+    """
+    Convert the time string into the number of seconds since the midnight
+
+    :param time_string: string of the time, example: '17:00:00'
+    :return: the number of seconds in integer
+    """
+    hour, minute, second = time_string.split(':')
+    return int(hour) * 3600 + int(minute) * 60 + int(second)
+
+
+def parse_rush_hour(rush_hour):
+    """
+    Convert the rush hour into the list of windows in seconds
+
+    :param rush_hour: tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples for several windows, example: [('07:00:00', '09:30:00'), ('17:00:00', '20:00:00')]
+    :return: list of the windows, example: [(61200, 72000)]
+    """
+    if isinstance(rush_hour[0], basestring):
+        rush_hour = [rush_hour]
+    return [(parse_time(start), parse_time(end)) for start, end in rush_hour]
+
+
+#################################################################################################################
+#                                    main function                                                              #
+#################################################################################################################
+
+
+def add_weather(table, weather_df, date_column='service_date', column='weather'):
+    """
+    Add the weather column into the table according to the service date
+
+    :param table: the dataframe with the service date column
+    :param weather_df: the dataframe for the weather table
+    :param date_column: the name of the service date column
+    :param column: the name of the new column
+    :return: the dataframe with the weather column
+    """
+    table[column] = pd.to_numeric(table[date_column]).map(obtain_weather_series(weather_df))
+    return table
+
+
+def add_day_of_week(table, date_column='service_date', column='day_of_week'):
+    """
+    Add the day of week column into the table according to the service date
+
+    :param table: the dataframe with the service date column
+    :param date_column: the name of the service date column
+    :param column: the name of the new column
+    :return: the dataframe with the day of week column
+    """
+    date_series = pd.to_numeric(table[date_column])
+    date_list = date_series.unique()
+    weekday_list = pd.to_datetime(date_list.astype(str), format='%Y%m%d').weekday
+    table[column] = date_series.map(pd.Series(weekday_list, index=date_list))
+    return table
+
+
+def add_seconds_of_day(table, time_column='timestamp', column='seconds_of_day'):
+    """
+    Add the seconds of day column into the table according to the time of day
+
+    :param table: the dataframe with the time column
+    :param time_column: the name of the time column
+    :param column: the name of the new column
+    :return: the dataframe with the seconds of day column
+    """
+    table[column] = obtain_seconds_of_day(table[time_column])
+    return table
+
+
+def add_rush_hour(table, rush_hour, time_column='timestamp', column='rush_hour', inclusive=True, seconds_column=None):
+    """
+    Add the rush hour column into the table according to the time of day
+
+    :param table: the dataframe with the time column
+    :param rush_hour: tuple of string to represent the rush hour, example: ('17:00:00', '20:00:00'), or the list of such tuples
+    :param time_column: the name of the time column
+    :param column: the name of the new column
+    :param inclusive: whether the start and the end of the windows are in the rush hour
+    :param seconds_column: the name of the integer seconds of day column of the time column, example: 'seconds_of_day'. If it is provided and in the table, the time column is not parsed
+    :return: the dataframe with the rush hour column in boolean
+    """
+    if seconds_column is not None and seconds_column in table.columns:
+        seconds_array = table[seconds_column].values.astype(np.int64)
+    else:
+        seconds_array = obtain_seconds_of_day(table[time_column])
+    result = np.zeros(len(table), dtype=bool)
+    for start, end in parse_rush_hour(rush_hour):
+        if inclusive:
+            result |= (seconds_array >= start) & (seconds_array <= end)
+        else:
+            result |= (seconds_array > start) & (seconds_array < end)
+    table[column] = result
+    return table
+
+
+def add_context_features(table, weather_df=None, rush_hour=None, date_column='service_date', time_column='timestamp', inclusive=True):
+    """
+    Add the weather, rush_hour, day_of_week and seconds_of_day columns into the table
+
+    :param table: the dataframe with the service date column and the time column
+    :param weather_df: the dataframe for the weather table. If it is None, the weather column is not added
+    :param rush_hour: tuple of string to represent the rush hour or the list of such tuples. If it is None, the rush_hour column is not added
+    :param date_column: the name of the service date column
+    :param time_column: the name of the time column
+    :param inclusive: whether the start and the end of the rush hour windows are in the rush hour
+    :return: the dataframe with the context features
+    """
+    if weather_df is not None:
+        table = add_weather(table, weather_df, date_column)
+    if rush_hour is not None:
+        table = add_rush_hour(table, rush_hour, time_column, inclusive=inclusive)
+    table = add_day_of_week(table, date_column)
+    table = add_seconds_of_day(table, time_column)
+    return table
@@ -4,12 +4,29 @@ Preprocess the dataset
 
 # import module
 import pandas as pd
+import numpy as np
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 from dateutil.rrule import rrule, DAILY
 import requests
 import random
-import urllib
+import time
+import json
+import csv
+import shutil
+import tempfile
+import cPickle as pickle
+import threading
+import hashlib
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import partition_store
+import gtfs_index
+import history_filter
+import context_features
+import epoch_time
+import schema
+import db_io
 
 
 #################################################################################################################
@@ -20,8 +37,6 @@ Helper functions for generating api data, segment data and even the arrival time
 
 list of helper functions:
 
-* calculate_arrival_time
-* calculate_arrival_distance
 * extract_time
 * calculate_time_span
 * calculate_time_from_stop
@@ -30,49 +45,6 @@ list of helper functions:
 """
 
 
-def calculate_arrival_time(stop_dist, prev_dist, next_dist, prev_timestamp, next_timestamp):
-    """
-     Calculate the arrival time according to the given tuple (prev_dist, next_dist), the current location, the timestamp of the prev location, and the timestamp of the next location
-
-    :param stop_dist: the distance of the target stop between the prev and next tuple
-    :param prev_dist: the distance of the location of the bus at the previous record
-    :param next_dist: the distance of the location of the bus at the next record
-    :param prev_timestamp: the timestamp of the bus at the previous record
-    :param next_timestamp: the timestamp of the bus at the next record
-    :return result: the timestamp of the bus arrival the target stop
-    """
-    distance_prev_next = next_dist - prev_dist
-    distance_prev_stop = stop_dist - prev_dist
-    ratio = float(distance_prev_stop) / float(distance_prev_next)
-    duration_prev_next = next_timestamp - prev_timestamp
-    duration_prev_stop = ratio * duration_prev_next.total_seconds()
-    duration_prev_stop = timedelta(0, duration_prev_stop)
-    stop_timestamp = prev_timestamp + duration_prev_stop
-    return stop_timestamp
-
-
-def calculate_arrival_distance(time_of_day, prev_dist, next_dist, prev_timestamp, next_timestamp):
-    """
-    calculate arrival distance according to the given input: time_of_day, prev_dist, next_dist, prev_timestamp, next_timestamp
-
-    :param time_of_day: the given time for calculating the dist_along_route
-    :param prev_dist: the distance of the location of the bus for the previous record in historical data
-    :param next_dist: the distance of the location of the bus for the next record in historical data
-    :param prev_timestamp: the timestamp of the bus for the previous record in historical data
-    :param next_timestamp: the timestamp of the bus for the next record in historical data
-    :return result: dist_along_route for the bus at the given time_of_day
-    """
-    duration_prev_next = next_timestamp - prev_timestamp
-    duration_prev_time = time_of_day - prev_timestamp
-    duration_prev_next = duration_prev_next.total_seconds()
-    duration_prev_time = duration_prev_time.total_seconds()
-    ratio = duration_prev_time / duration_prev_next
-    distance_prev_next = next_dist - prev_dist
-    distance_prev_time = distance_prev_next * ratio
-    dist_along_route = prev_dist + distance_prev_time
-    return dist_along_route
-
-
 def extract_time(time):
     """
     Convert the string into datetime format.
@@ -133,33 +105,13 @@ def filter_single_history(single_history, stop_sequence):
     """
     Filter the history file with only one day and one stop sequence to remove abnormal record
 
+    The records are kept if the total_distance is larger than the running maximum of the previous records. See history_filter.filter_single_history.
+
     :param single_history: dataframe for history table with only one day
     :param stop_sequence: list of stop id
     :return: dataframe for filtered history table
     """
-    current_history = single_history[
-        (single_history.next_stop_id.isin(stop_sequence)) & (single_history.dist_along_route > 0)]
-    if len(current_history) < 3:
-        return None
-    tmp_history = pd.DataFrame(columns=current_history.columns)
-    i = 1
-    prev_record = current_history.iloc[0]
-    while i < len(current_history):
-        next_record = current_history.iloc[i]
-        prev_distance = float(prev_record.total_distance)
-        next_distance = float(next_record.total_distance)
-        while prev_distance >= next_distance:
-            i += 1
-            if i == len(current_history):
-                break
-            next_record = current_history.iloc[i]
-            next_distance = float(next_record.total_distance)
-        tmp_history.loc[len(tmp_history)] = prev_record
-        prev_record = next_record
-        i += 1
-    if float(prev_record.total_distance) > float(tmp_history.iloc[-1].total_distance):
-        tmp_history.loc[len(tmp_history)] = prev_record
-    return tmp_history
+    return history_filter.filter_single_history(single_history, stop_sequence)
 
 
 #################################################################################################################
@@ -167,18 +119,19 @@ def filter_single_history(single_history, stop_sequence):
 #################################################################################################################
 
 
-def get_precip(gooddate, api_token):
+def get_precip(gooddate, api_token, base_url='http://api.wunderground.com/api/'):
     """
     Download the weather information for a specific date
     :param gooddate: date for downloading
     :param api_token: the token for api interface
+    :param base_url: url of the api interface. It can be replaced by the url of a local server for testing
     :return: list of the data
     """
-    urlstart = 'http://api.wunderground.com/api/' + api_token + '/history_'
+    urlstart = base_url + api_token + '/history_'
     urlend = '/q/NY/New_York.json'
 
     url = urlstart + str(gooddate) + urlend
-    data = requests.get(url).json()
+    data = requests.get(url, timeout=60).json()
     result = None
     for summary in data['history']['dailysummary']:
         rain = summary['rain']
@@ -193,14 +146,102 @@ def get_precip(gooddate, api_token):
     return result
 
 
-def download_weather(date_start, date_end, api_token):
+def read_weather_cache(cache_path, date_list):
+    """
+    Read the cached weather information
+
+    The cache is a directory with one json file for each date, example: cache_path/20160101.json
+
+    :param cache_path: path of the directory for the cache
+    :param date_list: list of the dates, string, ex: ['20160101', '20160102']
+    :return: dictionary from the date to the list of the data
+    """
+    result = {}
+    for date in date_list:
+        filename = os.path.join(cache_path, date + '.json')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                result[date] = json.load(f)
+    return result
+
+
+def write_weather_cache(cache_path, date, current_data):
+    """
+    Save the weather information of a date into the cache
+
+    :param cache_path: path of the directory for the cache
+    :param date: the date, string, ex: '20160101'
+    :param current_data: list of the data from get_precip
+    :return: None
+    """
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    filename = os.path.join(cache_path, date + '.json')
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(current_data, f)
+    os.rename(filename + '.tmp', filename)
+
+
+def fetch_weather(date_list, source, processes=4, rate_limit=10, retry=3):
+    """
+    Download the weather information of the dates with a pool of worker threads
+
+    Algorithm:
+    for each date in the worker threads:
+        wait until the next request is allowed by the rate limit
+        download the weather information with the source
+        if it fails, wait and retry
+
+    :param date_list: list of the dates, string, ex: ['20160101', '20160102']
+    :param source: function to download the weather information of a date, ex: get_precip with the api token
+    :param processes: number of worker threads
+    :param rate_limit: maximum number of requests per minute. If it is None, the requests are not limited
+    :param retry: number of retries for each date
+    :return: list of the data for each date. The data is None if it fails
+    """
+    lock = threading.Lock()
+    next_time = [0.0]
+    interval = 60.0 / rate_limit if rate_limit else 0.0
+
+    def wait():
+        with lock:
+            now = time.time()
+            wait_time = next_time[0] - now
+            next_time[0] = max(now, next_time[0]) + interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def fetch(date):
+        for attempt in xrange(retry + 1):
+            if attempt > 0:
+                time.sleep(2 ** (attempt - 1))
+            wait()
+            try:
+                return source(date)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print "error when downloading the weather of ", date, ": ", e
+        return None
+
+    pool = ThreadPool(processes)
+    try:
+        result = pool.map(fetch, date_list)
+    finally:
+        pool.terminate()
+    return result
+
+
+def download_weather(date_start, date_end, api_token, cache_path=None, processes=4, rate_limit=10, source=None):
     """
     download the weather information for a date range
     
     :param date_start: start date, string, ex: '20160101'
     :param date_end: similar to date_start
     :param api_token: the token for api interface
-    :return: dataframe for weather table
+    :param cache_path: path of the directory to cache the weather information of each date. Only the dates not in the cache are downloaded
+    :param processes: number of worker threads for downloading
+    :param rate_limit: maximum number of requests per minute
+    :param source: function to download the weather information of a date. If it is None, get_precip with the api_token is used
+    :return: dataframe for weather table. ValueError is raised if the weather of any date can't be downloaded after the retries, and the downloaded dates are kept in the cache
     weather = 2: snow
     weather = 1: rain
     weather = 0: sunny
@@ -208,14 +249,28 @@ def download_weather(date_start, date_end, api_token):
 
     a = datetime.strptime(date_start, '%Y%m%d')
     b = datetime.strptime(date_end, '%Y%m%d')
-
-    result = pd.DataFrame(columns=['date', 'rain', 'snow', 'weather'])
-    for dt in rrule(DAILY, dtstart=a, until=b):
-        current_data = get_precip(dt.strftime("%Y%m%d"), api_token)
-        if current_data is None:
-            continue
-        else:
-            result.loc[len(result)] = current_data
+    date_list = [dt.strftime("%Y%m%d") for dt in rrule(DAILY, dtstart=a, until=b)]
+
+    if source is None:
+        source = lambda date: get_precip(date, api_token)
+    weather_dict = {}
+    if cache_path is not None:
+        weather_dict = read_weather_cache(cache_path, date_list)
+    missing_date_list = [date for date in date_list if date not in weather_dict]
+    if missing_date_list != []:
+        data_list = fetch_weather(missing_date_list, source, processes, rate_limit)
+        failed_date_list = []
+        for date, current_data in zip(missing_date_list, data_list):
+            if current_data is None:
+                failed_date_list.append(date)
+                continue
+            weather_dict[date] = current_data
+            if cache_path is not None:
+                write_weather_cache(cache_path, date, current_data)
+        if failed_date_list != []:
+            # a partial weather table gives NaN weather to the missing dates in the later tables
+            raise ValueError("failed to download the weather of the dates: " + ', '.join(failed_date_list))
+    result = pd.DataFrame([weather_dict[date] for date in date_list], columns=['date', 'rain', 'snow', 'weather'])
     return result
 
 
@@ -230,59 +285,60 @@ Use the stop_times.txt and trips.txt file to obtain the stop sequence for each r
 """
 
 
-def calculate_stop_distance(stop_times, history, direction_id=0):
+def calculate_stop_distance(stop_times, history, direction_id=0, aggregation='mean', fill_missing=False):
     """
     Calculate the distance of each stop with its initial stop. Notice that the dist_along_route is the distance between the next_stop and the initial stop
     
     Algorithm:
-    split the history and stop_times table according to the route id and shape id
-    for each subset of the divided history table:
-        get the route id and shape id for the subset
-        get the corresponding subset of the stop_times table
-        get the stop sequence from this subset
-        define a new dataframe based on the stop sequence for that shape id
-        find the distance from history data for the corresponding stop and shape id
-        save the result for this subset
-    concatenate all the results
+    aggregate the dist_along_route of the history table by (route_id, shape_id, next_stop_id)
+    find the representative trip of each (route_id, shape_id): the first trip in the stop_times table
+    merge the stop sequences of the representative trips with the aggregated distance
+    if fill_missing:
+        calculate the ratio between dist_along_route and shape_dist_traveled for each shape with the stops in the history
+        fill the missing stops with shape_dist_traveled multiplied by the median ratio of the shape
+    remove the shapes with any missing stop
         
-    :param stop_times: the stop_times table read from stop_times.txt file in GTFS
+    :param stop_times: the stop_times table read from stop_times.txt file in GTFS, with the route_id and shape_id columns
     :param history: the history table from preprocessed history.csv file
     :param direction_id: the direction id which can be 0 or 1
+    :param aggregation: the way to aggregate the dist_along_route of a stop in the history table, 'mean' or 'median'
+    :param fill_missing: whether to fill the stops which are not in the history table with the shape_dist_traveled column of the stop_times table. If it is False, the shapes with any missing stop are removed
     :return: the route_stop_dist table in dataframe
     """
-    route_grouped_history = history.groupby(['route_id', 'shape_id'])
-    route_grouped_stop_times = stop_times.groupby(['route_id', 'shape_id'])
-    result_list = []
-    for name, single_route_history in route_grouped_history:
-        route_id, shape_id = name
-        flag = 0
-        current_result = pd.DataFrame()
-        single_stop_times = route_grouped_stop_times.get_group((route_id, shape_id))
-        trip_id = single_stop_times.iloc[0]['trip_id']
-        single_stop_times = single_stop_times[single_stop_times.trip_id == trip_id]
-        single_stop_times.reset_index(inplace=True)
-        current_result['stop_id'] = single_stop_times['stop_id']
-        current_result['route_id'] = route_id
-        current_result['shape_id'] = shape_id
-        current_result['direction_id'] = direction_id
-        stop_grouped = single_route_history.groupby(['next_stop_id']).mean()
-        stop_grouped.reset_index(inplace=True)
-        stop_grouped['next_stop_id'] = pd.to_numeric(stop_grouped['next_stop_id'])
-        stop_set = set(stop_grouped['next_stop_id'])
-        for i in xrange(len(current_result)):
-            next_stop_id = current_result.iloc[i]['stop_id']
-            if next_stop_id not in stop_set:
-                print route_id, shape_id
-                flag = 1
-                break
-            else:
-                dist_along_route = stop_grouped[stop_grouped.next_stop_id == next_stop_id].iloc[0]['dist_along_route']
-                current_result.set_value(i, 'dist_along_route', dist_along_route)
-        if flag == 1:
-            continue
-        else:
-            result_list.append(current_result)
-    result = pd.concat(result_list, ignore_index=True)
+    if aggregation not in ('mean', 'median'):
+        raise ValueError("aggregation should be 'mean' or 'median'")
+    history = history[['route_id', 'shape_id', 'next_stop_id', 'dist_along_route']].copy()
+    history['next_stop_id'] = pd.to_numeric(history['next_stop_id'])
+    stop_dist = history.groupby(['route_id', 'shape_id', 'next_stop_id'])['dist_along_route'].agg(aggregation).reset_index()
+    stop_dist['stop_key'] = stop_dist['next_stop_id'].astype(float)
+    # the stop sequence of the representative trip for each (route_id, shape_id) in the history table
+    trip_table = stop_times.drop_duplicates(['route_id', 'shape_id'])[['route_id', 'shape_id', 'trip_id']]
+    trip_table = trip_table.merge(history[['route_id', 'shape_id']].drop_duplicates(), on=['route_id', 'shape_id'])
+    column_list = ['stop_id', 'route_id', 'shape_id']
+    if fill_missing:
+        column_list.append('shape_dist_traveled')
+    result = stop_times[stop_times.trip_id.isin(trip_table.trip_id)][column_list]
+    result = result.sort_values(['route_id', 'shape_id'], kind='mergesort')
+    result['stop_key'] = result['stop_id'].astype(float)
+    result = result.merge(stop_dist[['route_id', 'shape_id', 'stop_key', 'dist_along_route']], on=['route_id', 'shape_id', 'stop_key'], how='left')
+    if fill_missing:
+        # calibrate the shape_dist_traveled to the dist_along_route for each shape
+        calibration = result[result.dist_along_route.notnull() & (result.shape_dist_traveled > 0)]
+        ratio = (calibration['dist_along_route'] / calibration['shape_dist_traveled']).groupby([calibration['route_id'], calibration['shape_id']]).median()
+        ratio.name = 'ratio'
+        result = result.merge(ratio.reset_index(), on=['route_id', 'shape_id'], how='left')
+        missing = result.dist_along_route.isnull()
+        result.loc[missing, 'dist_along_route'] = result.loc[missing, 'shape_dist_traveled'] * result.loc[missing, 'ratio']
+        print "fill the missing stops: ", (missing & result.dist_along_route.notnull()).sum()
+    # remove the shapes with any missing stop
+    missing_table = result[result.dist_along_route.isnull()][['route_id', 'shape_id']].drop_duplicates()
+    for route_id, shape_id in missing_table.values:
+        print route_id, shape_id
+    missing_key = set(zip(missing_table.route_id, missing_table.shape_id))
+    result = result[[(route_id, shape_id) not in missing_key for route_id, shape_id in zip(result.route_id, result.shape_id)]]
+    result['direction_id'] = direction_id
+    result = result[['stop_id', 'route_id', 'shape_id', 'direction_id', 'dist_along_route']]
+    result.reset_index(drop=True, inplace=True)
     return result
 
 
@@ -294,7 +350,7 @@ generate the segment table
 """
 
 
-def generate_original_segment(full_history_var, weather, stop_times_var):
+def generate_original_segment(full_history_var, weather, gtfs):
     """
     Generate the original segment data
     
@@ -308,15 +364,15 @@ def generate_original_segment(full_history_var, weather, stop_times_var):
     
     :param full_history_var: the historical data after filtering
     :param weather: the dataframe for the weather information
-    :param stop_times_var: the dataframe from stop_times.txt
+    :param gtfs: the GTFSIndex built from trips.txt and stop_times.txt
     :return: dataframe for the original segment
     format:
-    segment_start, segment_end, timestamp, travel_duration, weather, service date, day_of_week, trip_id, vehicle_id
+    segment_start, segment_end, timestamp, travel_duration, weather, service date, day_of_week, trip_id, vehicle_id, epoch_time, seconds_of_day
     """
-    full_history_var = full_history_var[full_history_var.total_distance > 0]
+    full_history_var = epoch_time.ensure_time_columns(full_history_var[full_history_var.total_distance > 0])
     grouped = list(full_history_var.groupby(['service_date', 'trip_id']))
     result_list = []
-    step_count = range(0, len(grouped), len(grouped) / 10)
+    step_count = range(0, len(grouped), max(len(grouped) / 10, 1))
     for index in range(len(grouped)):
         name, single_history = grouped[index]
         if index in step_count:
@@ -324,24 +380,16 @@ def generate_original_segment(full_history_var, weather, stop_times_var):
         service_date, trip_id = name
         if service_date <= 20160103:
             continue
-        grouped_vehicle_id = list(single_history.groupby(['vehicle_id']))
-        majority_length = -1
-        majority_vehicle = -1
-        majority_history = single_history
-        for vehicle_id, item in grouped_vehicle_id:
-            if len(item) > majority_length:
-                majority_length = len(item)
-                majority_history = item
-                majority_vehicle = vehicle_id
-        stop_sequence = [item for item in list(stop_times_var[stop_times_var.trip_id == trip_id].stop_id)]
+        # the vehicle with the most records, the first vehicle id in order is used for the tie
+        vehicle_array = np.asarray(single_history['vehicle_id'])
+        vehicle_list, count_array = np.unique(vehicle_array, return_counts=True)
+        majority_vehicle = vehicle_list[np.argmax(count_array)]
+        majority_history = single_history[vehicle_array == majority_vehicle]
+        stop_sequence = gtfs.stop_sequence(trip_id)
         current_segment_df = generate_original_segment_single_history(majority_history, stop_sequence)
         if current_segment_df is None:
             continue
-        current_weather = weather[weather.date == service_date].iloc[0]['weather']
-        current_segment_df['weather'] = current_weather
-        day_of_week = datetime.strptime(str(service_date), '%Y%m%d').weekday()
         current_segment_df['service_date'] = service_date
-        current_segment_df['day_of_week'] = day_of_week
         current_segment_df['trip_id'] = trip_id
         current_segment_df['vehicle_id'] = majority_vehicle
         result_list.append(current_segment_df)
@@ -349,7 +397,10 @@ def generate_original_segment(full_history_var, weather, stop_times_var):
         result = pd.concat(result_list, ignore_index=True)
     else:
         return None
-    return result
+    # add the weather and day_of_week columns for all the trips at once
+    result = context_features.add_weather(result, weather)
+    result = context_features.add_day_of_week(result)
+    return result[['segment_start', 'segment_end', 'timestamp', 'travel_duration', 'weather', 'service_date', 'day_of_week', 'trip_id', 'vehicle_id', 'epoch_time', 'seconds_of_day']]
 
 
 def generate_original_segment_single_history(history, stop_sequence):
@@ -358,184 +409,368 @@ def generate_original_segment_single_history(history, stop_sequence):
     
     Algorithm:
     Filter the historical data with the stop sequence here
-    arrival_time_list = []
-    i = 0
-    while i < len(history):
-        use prev and the next to mark the record:
-            prev = history[i - 1]
-            next = history[i]
-        check whether the prev stop is the same as the next stop:
-            if yes, skip this row and continue to next row
-        prev_distance = prev.dist_along_route - prev.dist_from_stop
-        next_distance = next.dist_along_route - next.dist_from_stop
-        if prev_distance == next_distance:
-            continue to next row
-        elif prev.dist_from_stop = 0:
+    Keep the last record for each stop and sort the records by the timestamp
+    Convert the timestamp, total_distance, and the index of the stop in the stop sequence into arrays
+    Obtain the chain of the records used for the arrival time:
+        a record is in the chain if its stop index is larger than the stop index of all the previous records in the chain
+        if its total_distance is the same as the previous record in the chain, the bus didn't move yet: remove it and obtain the chain again
+    For all the records in the chain except the last one at the same time:
+        prev = the record, next = the next record in the chain
+        prev_distance = prev.total_distance
+        next_distance = next.total_distance
+        if prev.dist_from_stop = 0:
             current_arrival_time = prev.timestamp
         else:
-            current_arrival_duration = calcualte_arrival_time(prev.dist_along_route, prev_distance, next_distance, prev_timestamp, next_timestamp)
-        arrival_time_list.append((prev.next_stop_id, current_arrival_time))
-    result = pd.Dataframe
-    for i in range(1, len(arrival_time_list)):
-        prev = arrival_time_list[i - 1]
-        next = arrival_time_list[i]
+            current_arrival_time = prev.timestamp + (prev.dist_along_route - prev_distance) / (next_distance - prev_distance) * (next.timestamp - prev.timestamp)
+    For the neighboring arrival times:
         segment_start, segment_end obtained
-        travel_duration = next[1] - prev[1]
-        timestamp = prev[1]
-        save the record to result
+        travel_duration = next arrival time - prev arrival time
+        timestamp = prev arrival time
 
-    :param history: single historical data
+    :param history: single historical data with the epoch_time column
     :param stop_sequence: stop sequence for the corresponding trip id
     :return: the dataframe of the origianl segment dataset
     format:
-    segment_start, segment_end, timestamp, travel_duration
+    segment_start, segment_end, timestamp, travel_duration, epoch_time, seconds_of_day
     """
     single_history = filter_single_history(history, stop_sequence)
     if single_history is None or len(single_history) < 3:
         return None
-    arrival_time_list = []
-    grouped_list = list(single_history.groupby('next_stop_id'))
-    if len(grouped_list) < 3:
+    # keep the last record for each stop and sort them by the timestamp
+    stop_array = single_history['next_stop_id'].values
+    unique_index = len(stop_array) - 1 - np.unique(stop_array[::-1], return_index=True)[1]
+    if len(unique_index) < 3:
         return None
-    history = pd.DataFrame(columns=single_history.columns)
-    for i in xrange(len(grouped_list)):
-        history.loc[len(history)] = grouped_list[i][1].iloc[-1]
-    history.sort_values(by='timestamp', inplace=True)
-    if history.iloc[0]['total_distance'] < 1:
-        prev_record = history.iloc[1]
-        i = 2
-    else:
-        prev_record = history.iloc[0]
-        i = 1
-    while i < len(history):
-        next_record = history.iloc[i]
-        while stop_sequence.index(prev_record.next_stop_id) >= stop_sequence.index(next_record.next_stop_id):
-            i += 1
-            if i == len(history):
-                break
-            next_record = history.iloc[i]
-        if i == len(history):
+    time_array = single_history['epoch_time'].values.astype(np.int64) * 1000000
+    record_array = unique_index[np.argsort(time_array[unique_index], kind='mergesort')]
+    distance_array = single_history['total_distance'].values.astype(float)
+    if distance_array[record_array[0]] < 1:
+        record_array = record_array[1:]
+    stop_index_dict = {}
+    for i, stop_id in enumerate(stop_sequence):
+        stop_index_dict.setdefault(stop_id, i)
+    stop_array = stop_array[record_array]
+    index_array = np.array([stop_index_dict[stop_id] for stop_id in stop_array])
+    distance_array = distance_array[record_array]
+    time_array = time_array[record_array]
+    stop_distance_array = single_history['dist_along_route'].values[record_array].astype(float)
+    dist_from_stop_array = single_history['dist_from_stop'].values[record_array]
+    # obtain the chain of the records
+    candidate_array = np.arange(len(record_array))
+    while True:
+        current_index_array = index_array[candidate_array]
+        mask = np.ones(len(candidate_array), dtype=bool)
+        mask[1:] = current_index_array[1:] > np.maximum.accumulate(current_index_array)[:-1]
+        chain_array = candidate_array[mask]
+        same_distance = np.flatnonzero(distance_array[chain_array[1:]] == distance_array[chain_array[:-1]])
+        if len(same_distance) == 0:
             break
-        prev_distance = float(prev_record.total_distance)
-        next_distance = float(next_record.total_distance)
-        prev_timestamp = datetime.strptime(prev_record.timestamp, '%Y-%m-%dT%H:%M:%SZ')
-        next_timestamp = datetime.strptime(next_record.timestamp, '%Y-%m-%dT%H:%M:%SZ')
-        if prev_distance == next_distance:
-            # the bus didn't move yet
-            i += 1
-            continue
-        if prev_record.dist_from_stop == 0:
-            # if prev.dist_from_stop is 0, the bus is 0, then save result into timestamp
-            current_arrival_time = prev_timestamp
-        else:
-            stop_dist = prev_record.dist_along_route
-            current_arrival_time = calculate_arrival_time(stop_dist, prev_distance, next_distance, prev_timestamp,
-                                                          next_timestamp)
-        arrival_time_list.append((prev_record.next_stop_id, current_arrival_time))
-        prev_record = next_record
-        i += 1
-    result = pd.DataFrame(columns=['segment_start', 'segment_end', 'timestamp', 'travel_duration'])
-    for i in range(1, len(arrival_time_list)):
-        prev_record = arrival_time_list[i - 1]
-        next_record = arrival_time_list[i]
-        segment_start, segment_end = prev_record[0], next_record[0]
-        timestamp = prev_record[1]
-        travel_duration = next_record[1] - prev_record[1]
-        travel_duration = travel_duration.total_seconds()
-        result.loc[len(result)] = [segment_start, segment_end, str(timestamp), travel_duration]
-    return result
-
-
-def improve_dataset_unit(segment_df, stop_sequence):
-    """
-    improve the dataset for a specific trip_id at a specific date: add the skipped segments back into the dataframe
-    
-    Algorithm:
-    define result_df
-    For each row in segment_df:
-        obtain segment_start, segment_end, timestamp, travel_duration from the current row
-        start_index: index of segment_start in stop_sequence
-        end_index: ...
-        count = end_index - start_index
-        if count is 1, save the current row and continue to next row
-        average_travel_duration = travel_duration / count
-        For index in range(start_index, end_index):
-            current_segment_start = stop_sequence[index]
-            current_segment_end = stop_sequence[index + 1]
-            save the new row with the timestamp, average_travel_duration, current_segment_start, and current_segment_end into result_df
-            timestamp = timestamp + average_travel_duration
-    return result_df
-
-    :param segment_df: a subset of segment table with one trip id and service date
-    :param stop_sequence: stop sequence for the corresponding trip id
-    :return: dataframe for improved segment table
-
-    return format:
-    segment_start, segment_end, timestamp, travel_duration
-    """
-    result = pd.DataFrame(columns=['segment_start', 'segment_end', 'timestamp', 'travel_duration'])
-    for i in xrange(len(segment_df)):
-        segment_start = segment_df.iloc[i]['segment_start']
-        segment_end = segment_df.iloc[i]['segment_end']
-        timestamp = segment_df.iloc[i]['timestamp']
-        travel_duration = segment_df.iloc[i]['travel_duration']
-        start_index = stop_sequence.index(segment_start)
-        end_index = stop_sequence.index(segment_end)
-        count = end_index - start_index
-        if count <= 0:
-            print "error"
-            continue
-        average_travel_duration = float(travel_duration) / float(count)
-        for j in range(start_index, end_index):
-            current_segment_start = stop_sequence[j]
-            current_segment_end = stop_sequence[j + 1]
-            result.loc[len(result)] = [current_segment_start, current_segment_end, timestamp, average_travel_duration]
-            timestamp = datetime.strptime(timestamp[:19], '%Y-%m-%d %H:%M:%S') + timedelta(0, average_travel_duration)
-            timestamp = str(timestamp)
-    return result
-
-
-def improve_dataset(segment_df, stop_times, weather_df):
+        candidate_array = candidate_array[candidate_array != chain_array[same_distance[0] + 1]]
+    # calculate the arrival time for all the records in the chain except the last one
+    prev_array, next_array = chain_array[:-1], chain_array[1:]
+    prev_distance = distance_array[prev_array]
+    next_distance = distance_array[next_array]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (stop_distance_array[prev_array] - prev_distance) / (next_distance - prev_distance)
+    duration = (time_array[next_array] - time_array[prev_array]) / 1000000.0
+    arrival_time_array = time_array[prev_array] + epoch_time.seconds_to_microseconds(np.where(dist_from_stop_array[prev_array] == 0, 0.0, ratio * duration))
+    result = pd.DataFrame({'segment_start': stop_array[prev_array][:-1], 'segment_end': stop_array[prev_array][1:],
+                           'timestamp': epoch_time.format_timestamp(arrival_time_array[:-1]),
+                           'travel_duration': (arrival_time_array[1:] - arrival_time_array[:-1]) / 1000000.0},
+                          columns=['segment_start', 'segment_end', 'timestamp', 'travel_duration'])
+    return epoch_time.set_time_columns(result, arrival_time_array[:-1])
+
+
+def improve_dataset(segment_df, gtfs, weather_df):
     """
     Improve the segment table by adding the skipped stops and other extra columns like weather, day_of_week, etc.
     
+    A segment which skips some stops is split into the segments between the consecutive stops, and its travel duration is divided equally. All the segments of all the trips are expanded at once.
+
     algorithm:
-    split the segment dataframe by groupby(service_date, trip_id)
-    result_list = []
-    for name, item in grouped_segment:
-        obtained the improved segment data for the item
-        add the columns:  weather, service date, day_of_week, trip_id, vehicle_id
-        save the result into result_list
-    concatenate the dataframe in the result_list
+    sort the segment dataframe by (service_date, trip_id) and keep the order of the segments in each trip
+    concatenate the stop sequences of all the trips into one array
+    obtain the index of segment_start and segment_end in the stop sequence of the trip
+    count = end_index - start_index, remove the segments with count <= 0
+    repeat each segment for count times:
+        the k-th record is (stop_sequence[start_index + k], stop_sequence[start_index + k + 1])
+        travel_duration = travel_duration / count
+        the timestamp of the first record is the original timestamp
+        the timestamp of the k-th record is the timestamp of the (k-1)-th record in seconds plus the travel_duration
+    add the columns:  weather, service date, day_of_week, trip_id, vehicle_id, epoch_time, seconds_of_day
 
     :param segment_df: the dataframe of segment table
-    :param stop_times: the dataframe of the stop_times.txt file in GTFS dataset
+    :param gtfs: the GTFSIndex built from trips.txt and stop_times.txt
     :param weather_df: the dataframe of the weather information
     :return: the dataframe of the improved segment table
     """
-    grouped_list = list(segment_df.groupby(['service_date', 'trip_id']))
+    if segment_df is None or len(segment_df) == 0:
+        return None
+    segment_df = epoch_time.ensure_time_columns(segment_df).sort_values(['service_date', 'trip_id'], kind='mergesort')
+    # the vehicle id of each trip is from the first segment
+    start_array = np.zeros(len(segment_df), dtype=bool)
+    start_array[0] = True
+    for column in ['service_date', 'trip_id']:
+        value_array = segment_df[column].values
+        start_array[1:] |= value_array[1:] != value_array[:-1]
+    vehicle_array = segment_df['vehicle_id'].values[np.flatnonzero(start_array)][np.cumsum(start_array) - 1]
+    # concatenate the stop sequences
+    trip_list = pd.unique(segment_df['trip_id'].values)
+    stop_sequence_list = [gtfs.stop_sequence(trip_id) for trip_id in trip_list]
+    length_array = np.array([len(stop_sequence) for stop_sequence in stop_sequence_list], dtype=np.int64)
+    sequence_stop_array = np.array([stop_id for stop_sequence in stop_sequence_list for stop_id in stop_sequence])
+    sequence_trip_array = np.repeat(trip_list, length_array)
+    # obtain the index of segment_start and segment_end in the stop sequence, the first index is used for the duplicated stops
+    trip_array = segment_df['trip_id'].values
+    segment_code, sequence_code = history_filter.obtain_pair_code(
+        np.concatenate([trip_array, trip_array]),
+        np.concatenate([segment_df['segment_start'].values, segment_df['segment_end'].values]),
+        sequence_trip_array, sequence_stop_array)
+    unique_code, first_index = np.unique(sequence_code, return_index=True)
+    code_index = np.minimum(np.searchsorted(unique_code, segment_code), max(len(unique_code) - 1, 0))
+    if len(unique_code) == 0 or (unique_code[code_index] != segment_code).any():
+        raise ValueError('the segment_start or segment_end is not in the stop sequence of the trip')
+    index_array = first_index[code_index]
+    start_index, end_index = index_array[:len(segment_df)], index_array[len(segment_df):]
+    count_array = end_index - start_index
+    if (count_array <= 0).any():
+        print "error: ", (count_array <= 0).sum(), "segments with the wrong order are removed"
+        count_array = np.maximum(count_array, 0)
+    # repeat the segments for the skipped stops
+    row_array = np.repeat(np.arange(len(segment_df)), count_array)
+    step_array = np.arange(len(row_array)) - np.repeat(np.cumsum(count_array) - count_array, count_array)
+    sequence_index = start_index[row_array] + step_array
+    travel_duration = segment_df['travel_duration'].values.astype(float) / np.maximum(count_array, 1).astype(float)
+    # the timestamp of the k-th record is the first timestamp in seconds plus (k - 1) times the travel_duration in seconds plus the travel_duration
+    timestamp_array = segment_df['timestamp'].values
+    second_array = segment_df['epoch_time'].values.astype(np.int64) * 1000000
+    duration_array = epoch_time.seconds_to_microseconds(travel_duration)
+    time_array = second_array[row_array] + (step_array - 1) * (duration_array[row_array] // 1000000 * 1000000) + duration_array[row_array]
+    time_string_array = np.array(epoch_time.format_timestamp(time_array), dtype=object)
+    time_string_array[step_array == 0] = timestamp_array[row_array[step_array == 0]]
+    # the first record keeps the original timestamp
+    time_array[step_array == 0] = second_array[row_array[step_array == 0]]
+    # the stop ids are saved in float like the original table
+    if sequence_stop_array.dtype.kind in 'iu':
+        sequence_stop_array = sequence_stop_array.astype(float)
+    result = pd.DataFrame({'segment_start': sequence_stop_array[sequence_index], 'segment_end': sequence_stop_array[sequence_index + 1],
+                           'timestamp': time_string_array, 'travel_duration': travel_duration[row_array],
+                           'service_date': segment_df['service_date'].values[row_array], 'trip_id': trip_array[row_array],
+                           'vehicle_id': vehicle_array[row_array]})
+    result = epoch_time.set_time_columns(result, time_array)
+    # add the weather and day_of_week columns for all the trips at once
+    result = context_features.add_weather(result, weather_df)
+    result = context_features.add_day_of_week(result)
+    return result[['segment_start', 'segment_end', 'timestamp', 'travel_duration', 'weather', 'service_date', 'day_of_week', 'trip_id', 'vehicle_id', 'epoch_time', 'seconds_of_day']]
+
+
+def process_segment_shard(args):
+    """
+    Generate the segment table for a single shard. It is used by the worker processes in obtain_segment.
+
+    :param args: tuple of (shard, full_history, date_list, shape_list, weather_df, gtfs). full_history is the history table of the shard, or the path of the partitioned history store or the db_io.DatabaseTable to read the shard by date_list and shape_list
+    :return: tuple of (shard, segment table of the shard, running time in seconds)
+    """
+    shard, full_history, date_list, shape_list, weather_df, gtfs = args
+    start_time = time.time()
+    full_history = partition_store.select_table(full_history, date_list, shape_list)
+    segment_df = generate_original_segment(full_history, weather_df, gtfs)
+    if segment_df is not None:
+        segment_df = improve_dataset(segment_df, gtfs, weather_df)
+    return shard, segment_df, time.time() - start_time
+
+
+def generate_segment_parallel(weather_df, gtfs, shape_list, full_history, date_list, processes, shard_by='service_date'):
+    """
+    Generate the segment table with a pool of worker processes
+
+    Algorithm:
+    split the history table into shards by the service date or the shape id
+    for each shard:
+        send the history table of the shard and the GTFSIndex of the trips in the shard to a worker process
+        if the history table is the partitioned store or the database table, the worker process reads the shard by itself
+    the worker processes generate the segment table of each shard
+    concatenate the segment tables and sort them by (service_date, trip_id) so the order is the same as the result without worker processes
+
+    :param weather_df: the dataframe of the weather information
+    :param gtfs: the GTFSIndex built from trips.txt and stop_times.txt
+    :param shape_list: the set of the shape ids in route_stop_dist table
+    :param full_history: the dataframe storing the history table, the path of the partitioned history store or the db_io.DatabaseTable of the history table
+    :param date_list: the list of dates to generate the segments from history table
+    :param processes: number of worker processes
+    :param shard_by: the column to split the history table, 'service_date' or 'shape_id'
+    :return: the dataframe of the segment table
+    """
+    if shard_by not in ('service_date', 'shape_id'):
+        raise ValueError("shard_by should be 'service_date' or 'shape_id'")
+    task_list = []
+    if isinstance(full_history, (basestring, db_io.DatabaseTable)):
+        if shard_by == 'service_date':
+            date_set = set([int(date) for date in date_list])
+            if isinstance(full_history, basestring):
+                shard_list = [date for date in partition_store.obtain_date_list(full_history) if date in date_set]
+            else:
+                shard_list = [date for date in full_history.distinct('service_date') if int(date) in date_set]
+            trip_set = set().union(*[gtfs.trip_set(shape_id) for shape_id in shape_list])
+            for shard in shard_list:
+                task_list.append((shard, full_history, [shard], shape_list, weather_df, gtfs.subset(trip_set)))
+        else:
+            for shard in sorted(shape_list):
+                task_list.append((shard, full_history, date_list, [shard], weather_df, gtfs.subset(gtfs.trip_set(shard))))
+    else:
+        full_history = partition_store.select_table(full_history, date_list, shape_list)
+        for shard, item in full_history.groupby(np.asarray(full_history[shard_by])):
+            task_list.append((shard, item, None, None, weather_df, gtfs.subset(set(item.trip_id))))
     result_list = []
-    for i in xrange(len(grouped_list)):
-        name, item = grouped_list[i]
-        service_date, trip_id = name
-        stop_sequence = list(stop_times[stop_times.trip_id == trip_id].stop_id)
-        current_segment = improve_dataset_unit(item, stop_sequence)
-        if current_segment is None:
-            continue
-        # add the other columns
-        current_segment['weather'] = weather_df[weather_df.date == service_date].iloc[0].weather
-        current_segment['service_date'] = service_date
-        current_segment['day_of_week'] = datetime.strptime(str(service_date), '%Y%m%d').weekday()
-        current_segment['trip_id'] = trip_id
-        current_segment['vehicle_id'] = item.iloc[0].vehicle_id
-        result_list.append(current_segment)
+    pool = Pool(processes)
+    try:
+        for i, (shard, segment_df, running_time) in enumerate(pool.imap_unordered(process_segment_shard, task_list)):
+            segment_count = 0 if segment_df is None else len(segment_df)
+            print "shard: ", str(i + 1) + '/' + str(len(task_list)), shard_by, shard, segment_count, "segments", "%.1f" % running_time, "seconds"
+            if segment_df is not None:
+                result_list.append(segment_df)
+    finally:
+        pool.terminate()
     if result_list == []:
-        result = None
-    else:
-        result = pd.concat(result_list, ignore_index=True)
+        return None
+    result = pd.concat(result_list, ignore_index=True)
+    result = result.sort_values(['service_date', 'trip_id'], kind='mergesort')
+    result.reset_index(drop=True, inplace=True)
     return result
 
 
+def load_watermark(watermark_path):
+    """
+    Load the watermark of the processed service dates
+
+    :param watermark_path: path of the json file
+    :return: dictionary from the service date string to the version of GTFS data, example: {'20160104': 'a1b2c3'}
+    """
+    if not os.path.exists(watermark_path):
+        return {}
+    with open(watermark_path) as f:
+        return json.load(f)
+
+
+def save_watermark(watermark_path, watermark):
+    """
+    Save the watermark of the processed service dates
+
+    :param watermark_path: path of the json file
+    :param watermark: dictionary from the service date string to the version of GTFS data
+    :return: None
+    """
+    with open(watermark_path + '.tmp', 'w') as f:
+        json.dump(watermark, f, indent=4, sort_keys=True)
+    os.rename(watermark_path + '.tmp', watermark_path)
+
+
+def obtain_last_record(save_path, block_size=65536):
+    """
+    Read the last record in a csv file without reading the whole file
+
+    :param save_path: path of the csv file with the index in the first column
+    :param block_size: number of bytes to read from the end of the file
+    :return: the list of the values in string of the last record with the index as the first value, None if the file doesn't have any record
+    """
+    with open(save_path, 'rb') as f:
+        f.seek(0, 2)
+        f.seek(max(f.tell() - block_size, 0))
+        line_list = [line for line in f.read().splitlines() if line.strip() != '']
+    if line_list == []:
+        return None
+    record = next(csv.reader([line_list[-1]]))
+    try:
+        int(record[0])
+    except ValueError:
+        # only the header is in the file
+        return None
+    return record
+
+
+def upsert_csv(table, save_path, date_list, date_column='service_date', order_columns=None, append=False):
+    """
+    Replace the records of the given service dates in a csv file
+
+    Algorithm:
+    if append and the service date of the last record in the file is before the given dates:
+        sort the new records by order_columns and append them at the end of the file, the index continues from the last record
+    else:
+        read the csv file in string so the other records are written back without any change
+        remove the records of the given service dates
+        append the new records and sort all the records by order_columns
+        write the csv file with the new index
+
+    :param table: the dataframe of the new records
+    :param save_path: path of the csv file
+    :param date_list: the list of service dates to replace
+    :param date_column: the name of the column for the service date
+    :param order_columns: the list of columns to sort the records. If it is None, [date_column, 'trip_id'] is used
+    :param append: whether the records can be appended in place. It should be True only if all the given dates are after the dates in the file, so the nightly refresh only writes the new records. If the last record in the file is not before the given dates, example: a previous run has appended the records, the file is rewritten instead
+    :return: None
+    """
+    if order_columns is None:
+        order_columns = [date_column, 'trip_id']
+    if not os.path.exists(save_path):
+        append = False
+    if append:
+        column_list = list(pd.read_csv(save_path, index_col=0, nrows=0).columns)
+        last_record = obtain_last_record(save_path)
+        if last_record is not None and int(float(last_record[column_list.index(date_column) + 1])) >= min([int(date) for date in date_list]):
+            # the file already has the records of the given dates, example: the previous run failed after appending them, so the records are replaced
+            append = False
+    if append:
+        key_list = [table[column].astype(str).values for column in reversed(order_columns[1:])] + [pd.to_numeric(table[order_columns[0]]).values]
+        table = table.iloc[np.lexsort(key_list)]
+        table = table[column_list]
+        table.index = np.arange(len(table)) + (0 if last_record is None else int(last_record[0]) + 1)
+        file_size = os.path.getsize(save_path)
+        with open(save_path, 'ab') as f:
+            try:
+                table.to_csv(f, header=False)
+            except:
+                # remove the incomplete records
+                f.truncate(file_size)
+                raise
+        return
+    if os.path.exists(save_path):
+        old_table = pd.read_csv(save_path, index_col=0, dtype=str)
+        date_set = set([int(date) for date in date_list])
+        old_table = old_table[~pd.to_numeric(old_table[date_column]).isin(date_set)]
+        table = pd.concat([old_table, table], ignore_index=True)
+        # sort by the service date in number and the other columns in string, the order of the records with the same key is kept
+        key_list = [table[column].astype(str).values for column in reversed(order_columns[1:])] + [pd.to_numeric(table[order_columns[0]]).values]
+        table = table.iloc[np.lexsort(key_list)]
+        table.reset_index(drop=True, inplace=True)
+    table.to_csv(save_path + '.tmp')
+    os.rename(save_path + '.tmp', save_path)
+
+
+def upsert_sql(table, engine, tablename, date_list, date_column='service_date'):
+    """
+    Replace the records of the given service dates in a database table
+
+    The old records of the given service dates are deleted and the new records are inserted in one transaction. The id of the new records continues from the maximum id in the table.
+
+    :param table: the dataframe of the new records
+    :param engine: database connect engine
+    :param tablename: the name of the table
+    :param date_list: the list of service dates to replace
+    :param date_column: the name of the column for the service date
+    :return: None
+    """
+    if not engine.has_table(tablename):
+        db_io.export_table(table, tablename, engine)
+        return
+    with engine.begin() as connection:
+        date_string = ', '.join([str(int(date)) for date in date_list])
+        connection.execute('DELETE FROM %s WHERE %s IN (%s)' % (tablename, date_column, date_string))
+        max_id = connection.execute('SELECT MAX(id) FROM %s' % tablename).scalar()
+        table = table.copy()
+        table.index = np.arange(len(table)) + (0 if max_id is None else max_id + 1)
+        db_io.insert_table(connection, db_io.prepare_table(table), tablename)
+
+
 #################################################################################################################
 #                                    api data section                                                              #
 #################################################################################################################
@@ -543,132 +778,211 @@ def improve_dataset(segment_df, stop_times, weather_df):
 Generate the api data from the GTFS data and the historical data
 """
 
-def generate_api_data(date_list, time_list, stop_num, route_stop_dist, full_history):
+def obtain_random_generator(seed, shape_id):
     """
-    Generate the api data for the test_route_set and given time list
+    Obtain the random number generator for a shape id from the master seed
+
+    The generator only depends on the master seed and the shape id, so the result doesn't depend on the other shapes or the number of worker processes.
+
+    :param seed: the master seed
+    :param shape_id: the shape id
+    :return: random.Random object
+    """
+    return random.Random(int(hashlib.md5(str(seed) + '_' + str(shape_id)).hexdigest(), 16))
+
+
+def obtain_stop_set(stop_sequence, stop_num, stop_mode='random', random_generator=random):
+    """
+    Choose the target stops for a shape
+
+    The first two stops and the last stop are never chosen.
+
+    :param stop_sequence: the stop sequence of the shape
+    :param stop_num: the number of the target stop
+    :param stop_mode: 'random': choose stop_num random stops, the duplicated stops are only counted once. 'all': choose all the stops. 'stratified': split the stop sequence into stop_num parts with the same length and choose a random stop in each part
+    :param random_generator: the random number generator, example: the random module or the result of obtain_random_generator
+    :return: list of the target stops
+    """
+    if stop_mode == 'random':
+        stop_set = set()
+        for i in range(stop_num):
+            stop_set.add(stop_sequence[random_generator.randint(2, len(stop_sequence) - 2)])
+        return list(stop_set)
+    candidate_list = stop_sequence[2:len(stop_sequence) - 1]
+    if stop_mode == 'all':
+        return candidate_list
+    if stop_mode == 'stratified':
+        count = min(stop_num, len(candidate_list))
+        boundary_list = [len(candidate_list) * i / count for i in range(count + 1)]
+        return [candidate_list[random_generator.randint(boundary_list[i], boundary_list[i + 1] - 1)] for i in range(count)]
+    raise ValueError("stop_mode should be 'random', 'all' or 'stratified'")
+
+
+def generate_api_data_shape(args):
+    """
+    Generate the api data for a single shape id. It is also used by the worker processes in generate_api_data.
 
     Algorithm:
-    Generate the set of trip id for test routes
-    Generate the random test stop id for each test routes
-    Filtering the historical data with trip id
+    remove the abnormal records of all the trips
     Generate the list of historical data Groupby(date, trip id)
     for each item in the list of the historical data:
-        obtain the trip id and the date
-        obtain the corresponding route
-        obtain the corresponding stop set
+        parse the timestamps once and find the records before and after all the time points with searchsorted
+        calculate the dist_along_route at all the time points
         for stop in stop set:
-            for each time point in the time list:
-                check whether the bus has passed the stop at the time point
-                if yes, continue to next stop
-                otherwise, save the record into result
-                
-    :param time_list: the date list for testing [20160101, 20160102, ...]
+            find the first time point when the bus has no next record or has passed the stop
+            save the records of the time points before it into result
+    concatenate the result
+
+    :param args: tuple of (shape_id, stop_set, single_route_stop_dist, history, time_list). single_route_stop_dist and history only include the records of the shape id
+    :return: the dataframe for the api data of the shape id, None if there is no record
+    """
+    shape_id, stop_set, single_route_stop_dist, history, time_list = args
+    stop_set = [str(int(item)) for item in stop_set]
+    stop_sequence = list(single_route_stop_dist.stop_id)
+    stop_index_dict = {}
+    for i, stop_id in enumerate(stop_sequence):
+        stop_index_dict.setdefault(float(stop_id), i)
+    current_time_array = np.array([context_features.parse_time(current_time) for current_time in time_list], dtype=np.int64)
+    # filtering the history data of all the trips: remove the abnormal value
+    history = history_filter.filter_history(history, single_route_stop_dist, key_column='shape_id')
+    result_list = []
+    for name, single_history in history.groupby(['service_date', 'trip_id']):
+        service_date, trip_id = name
+        if len(single_history) < 2:
+            continue
+        # find the records before and after each time point
+        time_array = single_history['epoch_time'].values.astype(np.int64)
+        prev_index, next_index = obtain_snapshot_index(time_array % 86400, current_time_array)
+        has_prev = prev_index >= 0
+        has_next = next_index < len(single_history)
+        prev_index = np.maximum(prev_index, 0)
+        next_index = np.minimum(next_index, len(single_history) - 1)
+        record_stop_index = np.array([stop_index_dict[float(stop_id)] for stop_id in single_history['next_stop_id'].values])[prev_index]
+        # calculate the dist_along_route at each time point
+        distance_array = single_history['total_distance'].values.astype(float)
+        prev_time, next_time = time_array[prev_index], time_array[next_index]
+        time_of_day = prev_time - prev_time % 86400 + current_time_array
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = (time_of_day - prev_time).astype(float) / (next_time - prev_time).astype(float)
+            dist_along_route = distance_array[prev_index] + (distance_array[next_index] - distance_array[prev_index]) * ratio
+        for target_stop in stop_set:
+            # the time points are used until the bus has no next record or has passed the target stop
+            target_index = stop_index_dict[float(target_stop)]
+            stop_mask = has_prev & (~has_next | (record_stop_index > target_index))
+            end = np.argmax(stop_mask) if stop_mask.any() else len(time_list)
+            snapshot_index = np.flatnonzero(has_prev[:end])
+            if len(snapshot_index) == 0:
+                continue
+            current_result = pd.DataFrame({'vehicle_id': single_history['vehicle_id'].values[prev_index[snapshot_index]],
+                                           'time_of_day': time_of_day[snapshot_index] * 1000000,
+                                           'date': single_history['service_date'].values[prev_index[snapshot_index]],
+                                           'dist_along_route': dist_along_route[snapshot_index]})
+            current_result['trip_id'] = trip_id
+            current_result['route_id'] = single_history.iloc[0].route_id
+            current_result['stop_id'] = target_stop
+            current_result['shape_id'] = shape_id
+            result_list.append(current_result)
+    if result_list == []:
+        return None
+    return pd.concat(result_list, ignore_index=True)
+
+
+def generate_api_data(date_list, time_list, stop_num, route_stop_dist, full_history, seed=None, stop_mode='random', processes=None):
+    """
+    Generate the api data for the test_route_set and given time list
+
+    Algorithm:
+    Filtering the historical data with the date list and split it by the shape id
+    for each shape id with at least 5 stops:
+        Generate the test stop id with the random number generator of the shape id
+        Generate the task with the stop set, the stop sequence and the historical data of the shape id
+    Generate the api data for each task with generate_api_data_shape, with a pool of worker processes if processes is provided
+    concatenate the result and sort it by (date, trip_id)
+
+    :param date_list: the date list for testing [20160101, 20160102, ...]
     :param time_list: the time list for testing, ['12:00:00', '12:05:00', ...]
     :param stop_num: the number of the target stop for test
     :param route_stop_dist: the dataframe for the route_stop_dist table
     :param full_history: the dataframe for the history table
+    :param seed: the master seed for the random number generator of each shape id. If it is None, the random module is used for all the shapes in order
+    :param stop_mode: 'random', 'all' or 'stratified', see obtain_stop_set
+    :param processes: number of worker processes. The stop sets are chosen before sending the tasks, so the result doesn't depend on the number of worker processes
     :return: the dataframe for the api data
     """
-    trip_route_dict = {}
-    route_stop_dict = {}
-    grouped = route_stop_dist.groupby(['shape_id'])
-    for shape_id, single_route_stop_dist in grouped:
+    history = epoch_time.ensure_time_columns(full_history[full_history.service_date.isin(date_list)])
+    history_dict = dict(list(history.groupby(np.asarray(history['shape_id']))))
+    task_list = []
+    for shape_id, single_route_stop_dist in route_stop_dist.groupby(np.asarray(route_stop_dist['shape_id'])):
         stop_sequence = list(single_route_stop_dist.stop_id)
         if len(stop_sequence) < 5:
             continue
-        trip_set = set(full_history[full_history.shape_id == shape_id].trip_id)
-        current_dict = dict.fromkeys(trip_set, shape_id)
-        trip_route_dict.update(current_dict)
-        stop_set = set()
-        for i in range(stop_num):
-            stop_set.add(stop_sequence[random.randint(2, len(stop_sequence) - 2)])
-        route_stop_dict[shape_id] = stop_set
-    history = full_history[
-        (full_history.trip_id.isin(trip_route_dict.keys())) & (full_history.service_date.isin(date_list))]
-    history_grouped = history.groupby(['service_date', 'trip_id'])
-    result = pd.DataFrame(
-        columns=['trip_id', 'vehicle_id', 'route_id', 'stop_id', 'time_of_day', 'date', 'dist_along_route', 'shape_id'])
-    print_dict = dict.fromkeys(date_list, True)
-    for name, single_history in history_grouped:
-        service_date, trip_id = name
-        if service_date not in date_list:
-            continue
-        if print_dict[service_date]:
-            print service_date
-            print_dict[service_date] = False
-        shape_id = trip_route_dict[trip_id]
-        stop_set = [str(int(item)) for item in route_stop_dict[shape_id]]
-        stop_sequence = list(route_stop_dist[route_stop_dist.shape_id == shape_id].stop_id)
-        # filtering the history data: remove the abnormal value
-        single_history = filter_single_history(single_history, stop_sequence)
-
-        if single_history is None or len(single_history) < 2:
-            continue
-        for target_stop in stop_set:
-            target_index = stop_sequence.index(float(target_stop))
-            for current_time in time_list:
-                prev_history = single_history[single_history['timestamp'].apply(lambda x: x[11:19] <= current_time)]
-                next_history = single_history[single_history['timestamp'].apply(lambda x: x[11:19] > current_time)]
-                if len(prev_history) == 0:
-                    continue
-                if len(next_history) == 0:
-                    break
-                tmp_stop = str(prev_history.iloc[-1].next_stop_id)
-                tmp_index = stop_sequence.index(float(tmp_stop))
-                if tmp_index > target_index:
-                    break
-                # If the bus does not pass the target stop, save the remained stops into the stop sequence and calculate the result
-                route_id = single_history.iloc[0].route_id
-                current_list = generate_single_api(current_time, route_id, prev_history, next_history, target_stop, shape_id)
-                if current_list is not None:
-                    result.loc[len(result)] = current_list
-    return result
+        random_generator = random if seed is None else obtain_random_generator(seed, shape_id)
+        stop_set = obtain_stop_set(stop_sequence, stop_num, stop_mode, random_generator)
+        if shape_id in history_dict:
+            task_list.append((shape_id, stop_set, single_route_stop_dist, history_dict[shape_id], time_list))
+    if processes is None:
+        result_list = []
+        for i, task in enumerate(task_list):
+            print "shape: ", str(i + 1) + '/' + str(len(task_list)), task[0]
+            result_list.append(generate_api_data_shape(task))
+    else:
+        pool = Pool(processes)
+        try:
+            result_list = pool.map(generate_api_data_shape, task_list)
+        finally:
+            pool.terminate()
+    result_list = [item for item in result_list if item is not None]
+    column_list = ['trip_id', 'vehicle_id', 'route_id', 'stop_id', 'time_of_day', 'date', 'dist_along_route', 'shape_id', 'epoch_time', 'seconds_of_day']
+    if result_list == []:
+        return pd.DataFrame(columns=column_list)
+    result = pd.concat(result_list, ignore_index=True)
+    result = result.sort_values(['date', 'trip_id'], kind='mergesort')
+    result.reset_index(drop=True, inplace=True)
+    result = epoch_time.set_time_columns(result, result['time_of_day'].values)
+    result['time_of_day'] = epoch_time.format_timestamp(result['time_of_day'].values)
+    # the date is saved in float like the original table
+    result['date'] = result['date'].astype(float)
+    return result[column_list]
 
 
-def generate_single_api(current_time, route_id, prev_history, next_history, stop_id, shape_id):
+def obtain_snapshot_index(time_array, current_time_array):
     """
-    Calculate the single record for the api data
+    Find the records before and after each time point for a single trip
 
-    Algorithm for calculate the single record:
-    According to the time point, find the closest time duration (prev, next)
-    Calculate the dist_along_route for the bus at current timepoint:
-        calculate the space distance between the time duration (prev, next)
-        calculate the time distance of two parts: (prev, current), (prev, next)
-        use the ratio of the time distance to multiply with the space distance to obtain the dist_along_route for current
-    According to the dista_along_route and the stop sequence confirm the remained stops including the target stop
-    Count the number of the remained stops
-    
-    :param current_time: The current time for generating the api data
-    :param route_id: the id of the route for the specific record
-    :param prev_history: the dataframe of the history table before the timestamp on the record of api data with the same trip id
-    :param next_history: the dataframe of the history table after the timestamp on the record of api data with the same trip id
-    :param stop_id: The id of the target stop
-    :param shape_id: The id of the shape (stop sequence)
-    :return: the list for the result
-    """
-    single_trip = prev_history.iloc[0].trip_id
-    prev_record = prev_history.iloc[-1]
-    next_record = next_history.iloc[0]
-    # calculate the dist_along_route for current
-    prev_distance = float(prev_record.total_distance)
-    next_distance = float(next_record.total_distance)
-    prev_timestamp = datetime.strptime(prev_record['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
-    next_timestamp = datetime.strptime(next_record['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
-    # determine the current time
-    if prev_record['timestamp'][11:19] <= current_time <= next_record['timestamp'][11:19]:
-        time_of_day = prev_record['timestamp'][:11] + current_time + 'Z'
-    else:
-        # case: this trip is crossing between two days
-        if current_time > next_record['timestamp'][11:19]:
-            time_of_day = prev_record['timestamp'][11:19] + current_time + 'Z'
-        else:
-            time_of_day = next_record['timestamp'][11:19] + current_time + 'Z'
-    time_of_day = datetime.strptime(time_of_day, '%Y-%m-%dT%H:%M:%SZ')
-    dist_along_route = calculate_arrival_distance(time_of_day, prev_distance, next_distance, prev_timestamp, next_timestamp)
-    # Generate the return list
-    # trip_id    vehicle_id    route_id    stop_id    time_of_day    date    dist_along_route
-    result = [single_trip, prev_record['vehicle_id'], route_id, stop_id, str(time_of_day), prev_record['service_date'], dist_along_route, shape_id]
-    return result
+    Algorithm:
+    if the time of day of the records is sorted:
+        next_index = searchsorted(time_array, current_time, side='right')
+        prev_index = next_index - 1
+    else, example: the trip crosses the midnight:
+        compare all the records with all the time points
+        prev_index = the last record with time <= current_time
+        next_index = the first record with time > current_time
+
+    :param time_array: numpy array of the seconds of day of the records in the original order
+    :param current_time_array: numpy array of the seconds of day of the time points
+    :return: tuple of (prev_index, next_index). prev_index is -1 if there is no record before the time point, and next_index is len(time_array) if there is no record after the time point
+    """
+    if (np.diff(time_array) >= 0).all():
+        next_index = np.searchsorted(time_array, current_time_array, side='right')
+        return next_index - 1, next_index
+    before_array = time_array[np.newaxis, :] <= current_time_array[:, np.newaxis]
+    prev_index = np.where(before_array.any(axis=1), len(time_array) - 1 - np.argmax(before_array[:, ::-1], axis=1), -1)
+    next_index = np.where((~before_array).any(axis=1), np.argmax(~before_array, axis=1), len(time_array))
+    return prev_index, next_index
+
+
+def generate_time_list(start_time='00:00:00', end_time='23:59:59', interval=30):
+    """
+    Generate the time list for the api data
+
+    :param start_time: the first time point, string, example: '06:00:00'
+    :param end_time: the last time point, string. It is included if it is on the interval
+    :param interval: seconds between two neighboring time points
+    :return: list of the time points, example: ['06:00:00', '06:00:30', '06:01:00', ...]
+    """
+    start = context_features.parse_time(start_time)
+    end = context_features.parse_time(end_time)
+    return ['%02d:%02d:%02d' % (second / 3600, second % 3600 / 60, second % 60) for second in xrange(start, end + 1, interval)]
 
 
 #################################################################################################################
@@ -679,7 +993,7 @@ Functions for users
 """
 
 # weather data
-def obtain_weather(start_date, end_date, api_token, save_path=None, engine=None):
+def obtain_weather(start_date, end_date, api_token, save_path=None, engine=None, cache_path=None, processes=4, rate_limit=10, source=None):
     """
     Download the weather.csv file into save_path
     
@@ -688,158 +1002,535 @@ def obtain_weather(start_date, end_date, api_token, save_path=None, engine=None)
     :param api_token: api_token for wunderground api interface. Anyone can apply for it in free.
     :param save_path: path of a csv file for storing the weather table.
     :param engine: database connect engine
-    :return: return the weather table in dataframe
+    :param cache_path: path of the directory to cache the weather information of each date. If all the dates are in the cache, nothing is downloaded
+    :param processes: number of dates downloaded at the same time
+    :param rate_limit: maximum number of requests per minute for the api interface
+    :param source: function to download the weather information of a date, example: lambda date: get_precip(date, api_token, base_url). If it is None, get_precip with the api_token is used
+    :return: return the weather table in dataframe. If the weather of any date can't be downloaded, ValueError is raised and the weather table is not written
     """
-    weather = download_weather(start_date, end_date, api_token)
+    weather = download_weather(start_date, end_date, api_token, cache_path, processes, rate_limit, source)
     if save_path is not None:
         weather.to_csv(save_path)
     if engine is not None:
-        weather.to_sql(name='weather', con=engine, if_exists='replace', index_label='id')
+        db_io.export_table(weather, 'weather', engine)
     return weather
 
 
 # history data
-def download_history_file(year, month, date_list, save_path):
+def check_history_file(filename, file_size=None):
     """
-    Download the history data from nyc database. User still needs to uncompress the data into csv file
+    Check whether the downloaded history file is complete
+
+    Algorithm:
+    if the size of the file is known, compare it with the size of the local file
+    check the magic bytes 'YZ' at the end of the xz stream
+
+    :param filename: path of the local file
+    :param file_size: the size of the remote file in bytes. If it is None, only the end of the xz stream is checked
+    :return: True if the file is complete, otherwise False
+    """
+    if not os.path.exists(filename):
+        return False
+    current_size = os.path.getsize(filename)
+    if file_size is not None and current_size != file_size:
+        return False
+    if current_size < 2:
+        return False
+    with open(filename, 'rb') as f:
+        f.seek(-2, os.SEEK_END)
+        return f.read(2) == 'YZ'
+
+
+def download_single_history_file(args):
+    """
+    Download a single history file. It is used by the worker threads in download_history.
+
+    Algorithm:
+    for each attempt:
+        obtain the size of the remote file
+        if the local file is complete, skip it
+        if the partial file '.part' exists, resume it with the HTTP Range request
+        otherwise, download the whole file into the partial file
+        if the partial file is complete, rename it into the local file
+        otherwise, wait and retry
+
+    :param args: tuple of (file_url, filename, retry, timeout)
+    :return: True if the file is complete, otherwise False
+    """
+    file_url, filename, retry, timeout = args
+    part_filename = filename + '.part'
+    for attempt in xrange(retry + 1):
+        if attempt > 0:
+            time.sleep(2 ** (attempt - 1))
+        try:
+            response = requests.head(file_url, timeout=timeout, allow_redirects=True)
+            if response.status_code == 404:
+                print "file not found: ", file_url
+                return False
+            response.raise_for_status()
+            file_size = response.headers.get('content-length')
+            if file_size is not None:
+                file_size = int(file_size)
+            if check_history_file(filename, file_size):
+                print "skip the complete file: ", filename
+                return True
+            if os.path.exists(filename):
+                os.rename(filename, part_filename)
+            current_size = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+            if file_size is not None and current_size >= file_size:
+                current_size = 0
+            headers = {'Range': 'bytes=%d-' % current_size} if current_size > 0 else {}
+            response = requests.get(file_url, headers=headers, stream=True, timeout=timeout)
+            response.raise_for_status()
+            # the server might ignore the Range request and return the whole file
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            with open(part_filename, mode) as f:
+                for block in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(block)
+            if check_history_file(part_filename, file_size):
+                os.rename(part_filename, filename)
+                print "download: ", filename
+                return True
+            print "incomplete file: ", filename
+        except (requests.RequestException, IOError) as e:
+            print "error when downloading ", file_url, ": ", e
+    return False
+
+
+def download_history(date_list, save_path, processes=4, retry=3, timeout=60, base_url='http://data.mytransit.nyc/bus_time/'):
+    """
+    Download the history files of the given dates with a pool of worker threads
+
+    :param date_list: list of datetime to represent the dates of the required data
+    :param save_path: path for downloading the compressed data
+    :param processes: number of worker threads
+    :param retry: number of retries for each file
+    :param timeout: timeout of the HTTP requests in seconds
+    :param base_url: url of the nyc database. It can be replaced by the url of a local server for testing
+    :return: list of the filenames which are not downloaded completely
+    """
+    task_list = []
+    for date in date_list:
+        filename = 'bus_time_' + date.strftime('%Y%m%d') + '.csv.xz'
+        file_url = base_url + date.strftime('%Y/%Y-%m/') + filename
+        task_list.append((file_url, os.path.join(save_path, filename), retry, timeout))
+    pool = ThreadPool(processes)
+    try:
+        result = pool.map(download_single_history_file, task_list)
+    finally:
+        pool.terminate()
+    return [os.path.basename(task[1]) for task, flag in zip(task_list, result) if not flag]
+
+
+def download_history_file(year, month, date_list, save_path, processes=4, retry=3, base_url='http://data.mytransit.nyc/bus_time/'):
+    """
+    Download the history data from nyc database. The compressed files can be read directly by obtain_history
     
     :param year: integer to represent the year, example: 2016
     :param month: integer to represent the month, example: 1
     :param date_list: list of integer to represent the dates of the required data
     :param save_path: path for downloading the compressed data
-    :return: None
+    :param processes: number of files downloaded at the same time
+    :param retry: number of retries for each file
+    :param base_url: url of the nyc database
+    :return: list of the filenames which are not downloaded completely
+    """
+    date_list = [datetime(year, month, date) for date in date_list]
+    return download_history(date_list, save_path, processes, retry, base_url=base_url)
+
+
+def download_history_range(start_date, end_date, save_path, processes=4, retry=3, base_url='http://data.mytransit.nyc/bus_time/'):
+    """
+    Download the history data from nyc database for a date range
+
+    :param start_date: start date, string or integer, example: 20160101
+    :param end_date: similar to start_date
+    :param save_path: path for downloading the compressed data
+    :param processes: number of files downloaded at the same time
+    :param retry: number of retries for each file
+    :param base_url: url of the nyc database
+    :return: list of the filenames which are not downloaded completely
+    """
+    a = datetime.strptime(str(start_date), '%Y%m%d')
+    b = datetime.strptime(str(end_date), '%Y%m%d')
+    date_list = list(rrule(DAILY, dtstart=a, until=b))
+    return download_history(date_list, save_path, processes, retry, base_url=base_url)
+
+
+def list_history_file(history_path, start_date, end_date):
+    """
+    List the history files within the date range in the order of the service date
+
+    If both of the compressed file and the uncompressed file are available for the same date, the uncompressed one is used.
+
+    :param history_path: path of all the historical data
+    :param start_date: integer to represent the start date, example: 20160105
+    :param end_date: integer to represent the end date, format is the same as start date
+    :return: list of the filenames
+    """
+    file_dict = {}
+    for filename in os.listdir(history_path):
+        if not (filename.endswith('.csv') or filename.endswith('.csv.xz')):
+            continue
+        date = int(filename[9:17])
+        if not int(start_date) <= date <= int(end_date):
+            continue
+        if date not in file_dict or filename.endswith('.csv'):
+            file_dict[date] = filename
+    return [file_dict[date] for date in sorted(file_dict.keys())]
+
+
+def filter_history(ptr_history, trip_set):
+    """
+    Remove the abnormal records in the raw history data
+
+    :param ptr_history: dataframe for the raw history data
+    :param trip_set: set of the trip id in trips.txt file
+    :return: dataframe for the filtered history data
     """
-    year = str(year)
-    if month < 10:
-        month = '0' + str(month)
+    dist_along_route = pd.to_numeric(ptr_history.dist_along_route, errors='coerce')
+    tmp_history = ptr_history[(dist_along_route > 1) & (ptr_history.progress == 0) & (ptr_history.block_assigned == 1) & (ptr_history.trip_id.isin(trip_set))].copy()
+    return tmp_history
+
+
+def read_history_file(filename, trip_set, chunksize=None):
+    """
+    Read a raw history file and yield the filtered history data
+
+    The file can be either the csv file or the compressed csv.xz file. If the chunksize is provided, the file is decompressed and parsed with the given number of rows at a time, so that only the filtered rows of each chunk are kept in memory.
+
+    :param filename: path of the history file
+    :param trip_set: set of the trip id in trips.txt file
+    :param chunksize: number of rows for each chunk. If it is None, the whole file is read at once
+    :return: generator of the filtered history data
+    """
+    if chunksize is None:
+        reader = [pd.read_csv(filename)]
     else:
-        month = str(month)
-    base_url = 'http://data.mytransit.nyc/bus_time/'
-    url = base_url + year + '/' + year + '-' + month + '/'
-    download_file = urllib.URLopener()
-    for date in date_list:
-        if date < 10:
-            date = '0' + str(date)
+        reader = pd.read_csv(filename, chunksize=chunksize)
+    for ptr_history in reader:
+        yield filter_history(ptr_history, trip_set)
+
+
+def add_history_column(history, gtfs):
+    """
+    Add the total_distance, route_id, shape_id, epoch_time and seconds_of_day into the filtered history data
+
+    :param history: dataframe for the filtered history data
+    :param gtfs: the GTFSIndex built from trips.txt file
+    :return: dataframe for the history table
+    """
+    history['dist_along_route'] = pd.to_numeric(history['dist_along_route'])
+    history['dist_from_stop'] = pd.to_numeric(history['dist_from_stop'])
+    history['total_distance'] = history['dist_along_route'] - history['dist_from_stop']
+    history = epoch_time.add_time_columns(history)
+    history = gtfs.add_route_shape(history)
+    return history
+
+
+def process_history_file(args):
+    """
+    Generate the history table for a single history file. It is used by the worker processes in obtain_history.
+
+    If staging_path is provided, the history table is written into the staging file chunk by chunk, so each worker only keeps one chunk in memory instead of the history table of the whole file. The chunks are read back by read_staging_file.
+
+    :param args: tuple of (filename, trip_set, gtfs, chunksize, staging_path)
+    :return: dataframe for the history table of that file, or the staging_path if it is provided
+    """
+    filename, trip_set, gtfs, chunksize, staging_path = args
+    if staging_path is None:
+        history_list = [add_history_column(tmp_history, gtfs) for tmp_history in read_history_file(filename, trip_set, chunksize)]
+        return pd.concat(history_list, ignore_index=True)
+    with open(staging_path, 'wb') as f:
+        for tmp_history in read_history_file(filename, trip_set, chunksize):
+            pickle.dump(add_history_column(tmp_history, gtfs), f, pickle.HIGHEST_PROTOCOL)
+    return staging_path
+
+
+def read_staging_file(staging_path):
+    """
+    Yield the chunks of the history table written by process_history_file
+
+    :param staging_path: path of the staging file
+    :return: generator of the history table
+    """
+    with open(staging_path, 'rb') as f:
+        while True:
+            try:
+                tmp_history = pickle.load(f)
+            except EOFError:
+                return
+            yield tmp_history
+
+
+def generate_history(file_list, history_path, trip_set, gtfs, chunksize=None, processes=None):
+    """
+    Yield the history table of the history files in the order of the file list
+
+    Algorithm:
+    if processes is None:
+        for filename in file_list:
+            read the file (chunk by chunk if chunksize is provided)
+            add the total_distance, route_id, shape_id and yield the result
+    else:
+        send every file to a pool of worker processes
+        if chunksize is provided:
+            each worker writes the chunks of its file into a staging file in a temporary directory
+            read the staging file of each file in the order of the file list and yield its chunks
         else:
-            date = str(date)
-        filename = 'bus_time_' + year + month + date + '.csv.xz'
-        file_url = url + filename
-        download_file.retrieve(file_url, save_path + filename)
+            yield the history table of each file in the order of the file list
+
+    :param file_list: list of the history filenames sorted by the service date
+    :param history_path: path of all the historical data
+    :param trip_set: set of the trip id in trips.txt file
+    :param gtfs: the GTFSIndex built from trips.txt file
+    :param chunksize: number of rows for each chunk
+    :param processes: number of worker processes
+    :return: generator of the history table
+    """
+    if processes is None:
+        for filename in file_list:
+            print filename
+            for tmp_history in read_history_file(history_path + filename, trip_set, chunksize):
+                yield add_history_column(tmp_history, gtfs)
+        return
+    pool = Pool(processes)
+    staging_dir = None if chunksize is None else tempfile.mkdtemp()
+    try:
+        task_list = [(history_path + filename, trip_set, gtfs, chunksize, None if staging_dir is None else os.path.join(staging_dir, '%d.pkl' % file_index)) for file_index, filename in enumerate(file_list)]
+        for file_index, tmp_history in enumerate(pool.imap(process_history_file, task_list)):
+            print file_list[file_index]
+            if staging_dir is None:
+                yield tmp_history
+                continue
+            for chunk in read_staging_file(tmp_history):
+                yield chunk
+            os.remove(tmp_history)
+    finally:
+        pool.terminate()
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def select_date_range(history, date_range, date_column='service_date'):
+    """
+    Select the records whose service dates are in the date range
+
+    :param history: dataframe for the history table
+    :param date_range: tuple of (start_date, end_date) in integer. If it is None, all the records are selected
+    :param date_column: the name of the column for the service date
+    :return: dataframe of the selected records
+    """
+    if date_range is None:
+        return history
+    service_date = pd.to_numeric(history[date_column])
+    return history[(service_date >= int(date_range[0])) & (service_date <= int(date_range[1]))]
+
 
+def export_history_chunks(history_chunks, save_path=None, engine=None, store_path=None, date_range=None):
+    """
+    Export the chunks of the history table without keeping them in memory
+
+    The chunks are appended to the csv file, the staging table of the database and the staging files of the partitioned store. The database table and the partitions are replaced after all the chunks are exported. If the export fails, the staging table and the staging files are removed, and the old table and partitions are not changed, the same as db_io.export_table.
 
-def obtain_history(start_date, end_date, trips, history_path, save_path=None, engine=None):
+    :param history_chunks: iterator of the dataframes of the history table
+    :param save_path: path of a csv file to store the history table
+    :param engine: database connect engine
+    :param store_path: path of a directory to store the history table as a partitioned store by service date and shape id
+    :param date_range: tuple of (start_date, end_date) of the partitions to replace in the store. The records of the other service dates, example: the trips after midnight of the day before start_date, are not written into the store, so the complete partitions of these dates are kept. If it is None, the partitions of all the service dates in the chunks are replaced
+    :return: number of the exported rows
+    """
+    if store_path is not None:
+        partition_store.drop_partition_staging(store_path)
+    row_count = 0
+    staged = False
+    try:
+        for tmp_history in history_chunks:
+            tmp_history.index = range(row_count, row_count + len(tmp_history))
+            if save_path is not None:
+                tmp_history.to_csv(save_path, mode='a' if staged else 'w', header=not staged)
+            if engine is not None:
+                if not staged:
+                    db_io.create_staging(tmp_history, 'history', engine)
+                db_io.append_staging(tmp_history, 'history', engine)
+            if store_path is not None:
+                partition_store.append_partition(select_date_range(tmp_history, date_range), store_path)
+            staged = True
+            row_count += len(tmp_history)
+        if engine is not None and staged:
+            db_io.swap_staging('history', engine)
+        if store_path is not None:
+            partition_store.commit_partition(store_path)
+    except:
+        if engine is not None:
+            db_io.drop_staging('history', engine)
+        if store_path is not None:
+            partition_store.drop_partition_staging(store_path)
+        raise
+    return row_count
+
+
+def obtain_history(start_date, end_date, trips, history_path, save_path=None, engine=None, chunksize=None, processes=None, store_path=None):
     """
     Generate the csv file for history data
     
     :param start_date: integer to represent the start date, example: 20160105
     :param end_date: integer to represent the end date, format is the same as start date
-    :param trips: the dataframe storing the table from trips.txt file in GTFS dataset
-    :param history_path: path of all the historical data. User should place all the historical data under the same directory and use this directory as the history_path. Please notice that the change of the filename might cause error.
+    :param trips: the dataframe storing the table from trips.txt file in GTFS dataset or the GTFSIndex
+    :param history_path: path of all the historical data. User should place all the historical data under the same directory and use this directory as the history_path. Both of the csv files and the compressed csv.xz files are accepted. Please notice that the change of the filename might cause error.
     :param save_path: path of a csv file to store the history table
     :param engine: database connect engine
-    :return: the history table in dataframe
+    :param chunksize: number of rows to read from the history file at a time. If it is provided, the history files are read, filtered and exported chunk by chunk without keeping the history table in memory, so the peak memory depends on the chunksize instead of the size of the history files. The history table is only exported to save_path, engine and store_path, so at least one of them should be provided, and None is returned.
+    :param processes: number of worker processes. If it is provided, each history file is processed by a pool of worker processes, and the result is merged in the order of the service date, which is the same as the result without worker processes. If chunksize is also provided, each worker writes the chunks of its file into a staging file in the temporary directory, so the peak memory depends on the chunksize and the number of worker processes instead of the size of the history files, and the temporary directory needs the space of the filtered history files.
+    :param store_path: path of a directory to store the history table as a partitioned store by service date and shape id. Only the partitions of the service dates from start_date to end_date are replaced, the records of the other service dates in the history files are not written into the store
+    :return: the history table in dataframe with the compact dtypes in schema.py, or None if chunksize is provided
     """
-    trip_set = set(trips.trip_id)
+    if chunksize is not None and save_path is None and engine is None and store_path is None:
+        raise ValueError("save_path, engine or store_path should be provided if chunksize is provided")
+    gtfs = gtfs_index.obtain_gtfs_index(trips)
+    trip_set = set(gtfs.route_dict)
     # generate the history data
-    file_list = os.listdir(history_path)
+    file_list = list_history_file(history_path, start_date, end_date)
+    if chunksize is not None:
+        export_history_chunks(generate_history(file_list, history_path, trip_set, gtfs, chunksize, processes), save_path, engine, store_path, (start_date, end_date))
+        return None
     history_list = []
-    for filename in file_list:
-        if not filename.endswith('.csv'):
-            continue
-        if int(start_date) <= int(filename[9:17]) <= int(end_date):
-            print filename
-            ptr_history = pd.read_csv(history_path + filename)
-            tmp_history = ptr_history[(ptr_history.dist_along_route != '\N') & (ptr_history.dist_along_route != 0) & (ptr_history.progress == 0) & (ptr_history.block_assigned == 1) & (ptr_history.dist_along_route > 1) & (ptr_history.trip_id.isin(trip_set))]
-            history_list.append(tmp_history)
-    result = pd.concat(history_list, ignore_index=True)
-    # add some other information: total_distance, route_id, shape_id
-    result['dist_along_route'] = pd.to_numeric(result['dist_along_route'])
-    result['dist_from_stop'] = pd.to_numeric(result['dist_from_stop'])
-    result['total_distance'] = result['dist_along_route'] - result['dist_from_stop']
-    trip_route_dict = trips.set_index('trip_id').to_dict(orient='index')
-    result['route_id'] = result['trip_id'].apply(lambda x: trip_route_dict[x]['route_id'])
-    result['shape_id'] = result['trip_id'].apply(lambda x: trip_route_dict[x]['shape_id'])
+    row_count = 0
+    for tmp_history in generate_history(file_list, history_path, trip_set, gtfs, chunksize, processes):
+        tmp_history.index = range(row_count, row_count + len(tmp_history))
+        row_count += len(tmp_history)
+        history_list.append(tmp_history)
+    result = pd.concat(history_list)
+    if store_path is not None:
+        # the history files also have the records of the day before start_date, which only replace the partitions in the date range
+        partition_store.write_partition(select_date_range(result, (start_date, end_date)), store_path)
     # export csv file
     if save_path is not None:
         result.to_csv(save_path)
     if engine is not None:
-        result.to_sql(name='history', con=engine, if_exists='replace', index_label='id')
-    return result
+        db_io.export_table(result, 'history', engine)
+    return schema.apply_schema(result, 'history')
 
 
 # route_stop_dist data
-def obtain_route_stop_dist(trips, stop_times, history_file, save_path=None, engine=None):
+def obtain_route_stop_dist(trips, stop_times, history_file, save_path=None, engine=None, aggregation='mean', fill_missing=False):
     """
     Generate the csv file for route_stop_dist data. In order to obtain a more complete data for route_stop_dist, the size of the history file should be as large as possible.
     
-    :param trips: the dataframe storing the table from trips.txt file in GTFS dataset
+    :param trips: the dataframe storing the table from trips.txt file in GTFS dataset or the GTFSIndex
     :param stop_times: the dataframe storing the table from stop_times.txt file in GTFS dataset
-    :param history_file: path of the preprocessed history file
+    :param history_file: path of the preprocessed history file, path of the partitioned history store, the db_io.DatabaseTable of the history table, or the dataframe of the history table
     :param save_path: path of a csv file to store the route_stop_dist table
     :param engine: database connect engine
-    :return: the route_stop_dist table in dataframe
+    :param aggregation: the way to aggregate the dist_along_route of a stop in the history table, 'mean' or 'median'
+    :param fill_missing: whether to fill the stops which are not in the history table with the shape_dist_traveled in stop_times.txt file, calibrated by the other stops of the same shape. If it is False, the shapes with any missing stop are removed
+    :return: the route_stop_dist table in dataframe with the compact dtypes in schema.py
     """
-    trip_route_dict = trips.set_index('trip_id').to_dict(orient='index')
-    stop_times['route_id'] = stop_times['trip_id'].apply(lambda x: trip_route_dict[x]['route_id'])
-    stop_times['shape_id'] = stop_times['trip_id'].apply(lambda x: trip_route_dict[x]['shape_id'])
-    history = pd.read_csv(history_file)
-    route_stop_dist = calculate_stop_distance(stop_times, history)
+    gtfs = gtfs_index.obtain_gtfs_index(trips)
+    stop_times = gtfs.add_route_shape(stop_times.copy())
+    if isinstance(history_file, pd.DataFrame):
+        history = history_file
+    elif isinstance(history_file, db_io.DatabaseTable):
+        history = history_file.select(columns=['next_stop_id', 'dist_along_route', 'route_id', 'shape_id'])
+    elif os.path.isdir(history_file):
+        history = partition_store.read_partition(history_file, columns=['next_stop_id', 'dist_along_route', 'route_id', 'shape_id'])
+    else:
+        history = pd.read_csv(history_file)
+    route_stop_dist = calculate_stop_distance(stop_times, history, aggregation=aggregation, fill_missing=fill_missing)
     if save_path is not None:
         route_stop_dist.to_csv(save_path)
     if engine is not None:
-        route_stop_dist.to_sql(name='route_stop_dist', con=engine, if_exists='replace', index_label='id')
-    return route_stop_dist
+        db_io.export_table(route_stop_dist, 'route_stop_dist', engine)
+    return schema.apply_schema(route_stop_dist, 'route_stop_dist')
 
 
 # segment data
-def obtain_segment(weather_df, trips, stop_times, route_stop_dist, full_history, training_date_list, save_path=None, engine=None):
+def obtain_segment(weather_df, trips, stop_times, route_stop_dist, full_history, training_date_list, save_path=None, engine=None, processes=None, shard_by='service_date', store_path=None, watermark_path=None, gtfs_version=None):
     """
     Generate the csv file for segment table
     
     :param weather_df: the dataframe storing the weather data
-    :param trips: the dataframe storing the table from trips.txt file in GTFS dataset
-    :param stop_times: the dataframe storing the table from stop_times.txt file in GTFS dataset
-    :param full_history: the dataframe storing the history table
+    :param trips: the dataframe storing the table from trips.txt file in GTFS dataset or the GTFSIndex
+    :param stop_times: the dataframe storing the table from stop_times.txt file in GTFS dataset. It is not used if trips is the GTFSIndex
+    :param route_stop_dist: the dataframe storing route_stop_dist table
+    :param full_history: the dataframe storing the history table, the path of the partitioned history store or the db_io.DatabaseTable of the history table
     :param training_date_list: the list of dates to generate the segments from history table
     :param save_path: path of a csv file to store the segment table
     :param engine: database connect engine
-    :return: the segment table in dataframe
+    :param processes: number of worker processes. If it is provided, the history table is split into shards by shard_by and each shard is processed by a pool of worker processes. The result is the same as the result without worker processes.
+    :param shard_by: the column to split the history table for the worker processes, 'service_date' or 'shape_id'
+    :param store_path: path of a directory to store the segment table as a partitioned store by service date and shape id
+    :param watermark_path: path of a json file to record the service dates which are already processed and the version of GTFS data for each date. If it is provided, only the new dates and the dates processed with another version of GTFS data are processed, and the segments of these dates are replaced in the csv file, the database and the partitioned store. The other dates are kept. Only the dates with segments are recorded, so the dates without history are processed again in the next run. The segments of the dates after all the recorded dates are appended to the csv file in place.
+    :param gtfs_version: the version of the GTFS data, example: the date of the GTFS feed. If it is None, it is calculated from the GTFSIndex
+    :return: the segment table in dataframe with the compact dtypes in schema.py. If watermark_path is provided, only the segments of the processed dates are returned, and None is returned if no date is processed.
     """
-    full_history = full_history[full_history.service_date.isin(training_date_list)]
+    gtfs = gtfs_index.obtain_gtfs_index(trips, stop_times)
     shape_list = set(route_stop_dist.shape_id)
-    full_history = full_history[full_history.shape_id.isin(shape_list)]
-    segment_df = generate_original_segment(full_history, weather_df, stop_times)
-    segment_df = improve_dataset(segment_df, stop_times, weather_df)
-    trip_route_dict = trips.set_index('trip_id').to_dict(orient='index')
-    segment_df['route_id'] = segment_df['trip_id'].apply(lambda x: trip_route_dict[x]['route_id'])
-    segment_df['shape_id'] = segment_df['trip_id'].apply(lambda x: trip_route_dict[x]['shape_id'])
-
+    if watermark_path is not None:
+        watermark = load_watermark(watermark_path)
+        if gtfs_version is None:
+            gtfs_version = gtfs.version()
+        training_date_list = [date for date in training_date_list if watermark.get(str(int(date))) != gtfs_version]
+        print "dates to process: ", training_date_list
+        if training_date_list == []:
+            return None
+    if processes is None:
+        full_history = partition_store.select_table(full_history, training_date_list, shape_list)
+        segment_df = generate_original_segment(full_history, weather_df, gtfs)
+        segment_df = improve_dataset(segment_df, gtfs, weather_df)
+    else:
+        segment_df = generate_segment_parallel(weather_df, gtfs, shape_list, full_history, training_date_list, processes, shard_by)
+    if segment_df is None:
+        segment_df = pd.DataFrame(columns=['segment_start', 'segment_end', 'timestamp', 'travel_duration', 'weather', 'service_date', 'day_of_week', 'trip_id', 'vehicle_id', 'epoch_time', 'seconds_of_day'])
+    segment_df = gtfs.add_route_shape(segment_df)
+
+    if watermark_path is None:
+        if save_path is not None:
+            segment_df.to_csv(save_path)
+        if engine is not None:
+            db_io.export_table(segment_df, 'segment', engine)
+        if store_path is not None:
+            partition_store.write_partition(segment_df, store_path)
+        return schema.apply_schema(segment_df, 'segment')
     if save_path is not None:
-        segment_df.to_csv(save_path)
+        # the new dates after all the processed dates are appended to the csv file in place
+        processed_list = [int(date) for date in watermark]
+        append = processed_list == [] or min([int(date) for date in training_date_list]) > max(processed_list)
+        upsert_csv(segment_df, save_path, training_date_list, append=append)
     if engine is not None:
-        segment_df.to_sql(name='segment', con=engine, if_exists='replace', index_label='id')
-    return segment_df
+        upsert_sql(segment_df, engine, 'segment', training_date_list)
+    if store_path is not None:
+        partition_store.delete_partition(store_path, training_date_list)
+        partition_store.write_partition(segment_df, store_path)
+    # only the dates with segments are processed, the dates whose history is not available yet are processed in the next run
+    for date in set(segment_df['service_date'].astype(int)):
+        watermark[str(int(date))] = gtfs_version
+    save_watermark(watermark_path, watermark)
+    return schema.apply_schema(segment_df, 'segment')
 
 
 # api_data table
-def obtain_api_data(route_stop_dist, full_history, date_list, time_list, stop_num, save_path=None, engine=None):
+def obtain_api_data(route_stop_dist, full_history, date_list, time_list, stop_num, save_path=None, engine=None, seed=None, stop_mode='random', processes=None):
     """
     Generate the csv file for api_data table
     
     :param route_stop_dist: the dataframe storing route_stop_dist table
-    :param full_history: the dataframe storing historical data
+    :param full_history: the dataframe storing historical data, the path of the partitioned history store or the db_io.DatabaseTable of the history table
     :param date_list: the list of integers to represent the dates for generating api data. Example: [20160101, 20160102, 20160103]
     :param time_list: the list of strings to represent the time for generating api data. Example: ['12:00:00', '12:05:00', '12:10:00', '12:15:00', '12:20:00', '12:25:00', '12:30:00']. Please follow the same format.
     :param stop_num: the number of target stop for each shape id
     :param save_path: path of a csv file to store the api_data table
     :param engine: database connect engine
-    :return: the dataframe storing api_data table
+    :param seed: the master seed to choose the target stops. The target stops of each shape id only depend on the master seed and the shape id, so the result is reproducible. If it is None, the random module is used.
+    :param stop_mode: the way to choose the target stops. 'random': stop_num random stops. 'all': all the stops. 'stratified': one random stop in each of the stop_num parts of the stop sequence
+    :param processes: number of worker processes to generate the api data of different shape ids. The result is the same for any number of worker processes
+    :return: the dataframe storing api_data table with the compact dtypes in schema.py
     """
-    full_history = full_history[full_history.service_date.isin(date_list)]
-    result = generate_api_data(date_list, time_list, stop_num, route_stop_dist, full_history)
+    full_history = partition_store.select_table(full_history, date_list, set(route_stop_dist.shape_id))
+    result = generate_api_data(date_list, time_list, stop_num, route_stop_dist, full_history, seed, stop_mode, processes)
     if save_path is not None:
         result.to_csv(save_path)
     if engine is not None:
-        result.to_sql(name='api_data', con=engine, if_exists='replace', index_label='id')
-    return result
+        db_io.export_table(result, 'api_data', engine)
+    return schema.apply_schema(result, 'api_data')
 
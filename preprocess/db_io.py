@@ -0,0 +1,507 @@
+"""
+Export the tables into the database in bulk
+
+pandas.to_sql with if_exists='replace' drops the old table first and inserts the records in small batches, so exporting a large table takes a long time and the table is incomplete until the export is finished. Here the records are written into a staging table and the staging table replaces the old table in one transaction:
+
+* create the empty staging table <tablename>_staging with the columns of the dataframe
+* insert the records into the staging table: COPY for postgresql with psycopg2, chunked multi-row INSERT for the other databases. The number of rows in each INSERT is limited by the number of variables in a statement, example: 999 for SQLite
+* drop the old table, rename the staging table and create the indexes on (service_date, trip_id), (shape_id) and id in one transaction
+
+list of functions:
+
+* create_staging: create the empty staging table
+* append_staging: insert the records into the staging table
+* swap_staging: replace the table with the staging table
+* drop_staging: remove the staging table after a failed export
+* export_table: create_staging + append_staging + swap_staging
+* insert_table: insert the records into a table with an open connection
+
+The tables in the database can also be read by slices. The service dates and the shape ids are converted into the conditions of an indexed SQL query, and the records are read chunk by chunk:
+
+* iterate_table: read the records of the given service dates and shape ids chunk by chunk
+* read_table: read the records of the given service dates and shape ids with the compact dtypes
+* DatabaseTable: a database table which can be given to the functions in place of the history dataframe
+"""
+
+# import module
+import pandas as pd
+import numpy as np
+from cStringIO import StringIO
+from sqlalchemy import MetaData, Table, inspect, create_engine, select, and_
+import schema
+
+
+# the maximum number of variables in a statement of SQLite
+SQLITE_MAX_VARIABLE = 999
+
+# the placeholder of the parameters in the sql statement for the parameter style of the database driver
+PLACEHOLDER_DICT = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}
+
+# the indexes created for the exported tables if the columns are in the table
+INDEX_LIST = [['id'], ['service_date', 'trip_id'], ['shape_id']]
+
+# the default number of rows in each chunk when reading a table
+READ_CHUNK_SIZE = 100000
+
+
+#################################################################################################################
+#                                    helper function                                                            #
+#################################################################################################################
+
+
+def obtain_staging_name(tablename):
+    """
+    :param tablename: the name of the table
+    :return: the name of the staging table
+    """
+    return tablename + '_staging'
+
+
+def quote_name(engine, name):
+    """
+    Quote the name of a table, a column or an index for the database
+
+    :param engine: database connect engine or connection
+    :param name: the name
+    :return: the quoted name
+    """
+    return engine.dialect.identifier_preparer.quote(name)
+
+
+def prepare_table(table, index_label='id'):
+    """
+    Convert the dataframe into the columns to be exported
+
+    :param table: the dataframe
+    :param index_label: the name of the column for the index. If it is None, the index is not exported
+    :return: the dataframe with the index column, the categorical columns are converted into the original values
+    """
+    table = table.copy()
+    if index_label is not None:
+        table.index.name = index_label
+        table.reset_index(inplace=True)
+    for column in table.columns:
+        if str(table[column].dtype) == 'category':
+            table[column] = table[column].astype(object)
+    return table
+
+
+def obtain_chunk_size(dialect_name, column_count, chunksize=None):
+    """
+    Obtain the number of rows in each INSERT statement
+
+    :param dialect_name: the name of the database dialect, example: 'sqlite', 'postgresql'
+    :param column_count: the number of columns in the table
+    :param chunksize: the number of rows given by the user. If it is None, 1000 rows are used
+    :return: the number of rows
+    """
+    if chunksize is None:
+        chunksize = 1000
+    if dialect_name == 'sqlite':
+        chunksize = min(chunksize, SQLITE_MAX_VARIABLE // max(column_count, 1))
+    return max(chunksize, 1)
+
+
+def obtain_records(table):
+    """
+    Convert the dataframe into a list of tuples with python values, the missing values are converted into None
+
+    :param table: the dataframe
+    :return: list of tuples
+    """
+    # tolist converts the numpy values into the python values
+    record_list = [list(record) for record in zip(*[table[column].tolist() for column in table.columns])]
+    for row, column in zip(*np.nonzero(pd.isnull(table).values)):
+        record_list[row][column] = None
+    return [tuple(record) for record in record_list]
+
+
+def copy_table(connection, table, tablename):
+    """
+    Insert the records with the COPY statement of postgresql
+
+    :param connection: the sqlalchemy connection with psycopg2
+    :param table: the dataframe with the same columns as the database table
+    :param tablename: the name of the database table
+    :return: None
+    """
+    buffer = StringIO()
+    table.to_csv(buffer, header=False, index=False)
+    buffer.seek(0)
+    column_string = ', '.join([quote_name(connection, column) for column in table.columns])
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (quote_name(connection, tablename), column_string), buffer)
+    finally:
+        cursor.close()
+
+
+def execute_atomic(engine, statement_list):
+    """
+    Execute a list of statements in one transaction
+
+    The sqlite3 module commits the transaction before the statements like CREATE, DROP and ALTER, so the transaction of SQLite is started and committed explicitly with the raw connection.
+
+    :param engine: database connect engine
+    :param statement_list: list of the sql statements
+    :return: None
+    """
+    if engine.dialect.name != 'sqlite':
+        with engine.begin() as connection:
+            for statement in statement_list:
+                connection.execute(statement)
+        return
+    connection = engine.raw_connection()
+    try:
+        dbapi_connection = connection.connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('BEGIN')
+            try:
+                for statement in statement_list:
+                    cursor.execute(statement)
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+        finally:
+            cursor.close()
+            dbapi_connection.isolation_level = isolation_level
+    finally:
+        connection.close()
+
+
+def obtain_batch_size(dialect_name):
+    """
+    Obtain the number of values in each IN condition of a query
+
+    :param dialect_name: the name of the database dialect, example: 'sqlite', 'postgresql'
+    :return: the number of values. For SQLite, the values of the two IN conditions together should be less than the limit of variables
+    """
+    if dialect_name == 'sqlite':
+        return SQLITE_MAX_VARIABLE // 2
+    return 10000
+
+
+def obtain_value_batches(value_list, batch_size):
+    """
+    Split the filter values into batches of python values
+
+    :param value_list: list of the values. If it is None, the column is not filtered
+    :param batch_size: the number of values in each batch
+    :return: list of the batches, [None] if value_list is None
+    """
+    if value_list is None:
+        return [None]
+    # the numpy values are converted into the python values which can be passed to the database driver
+    value_list = sorted(set([value.item() if isinstance(value, np.generic) else value for value in value_list]))
+    return [value_list[start:start + batch_size] for start in xrange(0, len(value_list), batch_size)]
+
+
+def build_query(database_table, date_batch, shape_batch, columns, date_column, shape_column):
+    """
+    Build the query of the records in the batches of service dates and shape ids
+
+    :param database_table: the sqlalchemy table
+    :param date_batch: list of the service dates. If it is None, all the service dates are selected
+    :param shape_batch: list of the shape ids. If it is None, all the shape ids are selected
+    :param columns: list of the columns. If it is None, all the columns are selected
+    :param date_column: the name of the column for the service date
+    :param shape_column: the name of the column for the shape id
+    :return: the sqlalchemy select statement ordered by the id column if it exists
+    """
+    if columns is None:
+        column_list = list(database_table.columns)
+    else:
+        column_list = [database_table.columns[column] for column in columns]
+        if 'id' in database_table.columns and 'id' not in columns:
+            column_list = [database_table.columns['id']] + column_list
+    statement = select(column_list)
+    condition_list = []
+    if date_batch is not None:
+        condition_list.append(database_table.columns[date_column].in_(date_batch))
+    if shape_batch is not None:
+        condition_list.append(database_table.columns[shape_column].in_(shape_batch))
+    if condition_list != []:
+        statement = statement.where(and_(*condition_list))
+    if 'id' in database_table.columns:
+        statement = statement.order_by(database_table.columns['id'])
+    return statement
+
+
+#################################################################################################################
+#                                    main function                                                              #
+#################################################################################################################
+
+
+def insert_table(connection, table, tablename, chunksize=None):
+    """
+    Insert the records into a database table with an open connection
+
+    Algorithm:
+    if the database is postgresql with psycopg2:
+        for each chunk of the records:
+            write the chunk into a csv buffer and COPY it into the table
+    else:
+        for each chunk of the records:
+            insert the chunk with one multi-row INSERT statement
+
+    :param connection: the sqlalchemy connection
+    :param table: the dataframe with the same columns as the database table, see prepare_table
+    :param tablename: the name of the database table
+    :param chunksize: the number of rows in each chunk
+    :return: None
+    """
+    if len(table) == 0:
+        return
+    dialect = connection.dialect
+    if dialect.name == 'postgresql' and dialect.driver == 'psycopg2':
+        chunksize = 100000 if chunksize is None else chunksize
+        for start in xrange(0, len(table), chunksize):
+            copy_table(connection, table.iloc[start:start + chunksize], tablename)
+        return
+    chunksize = obtain_chunk_size(dialect.name, len(table.columns), chunksize)
+    if dialect.paramstyle not in PLACEHOLDER_DICT:
+        # compile the multi-row INSERT statement with sqlalchemy for the other parameter styles
+        database_table = Table(tablename, MetaData(), autoload=True, autoload_with=connection)
+        column_list = list(table.columns)
+        for start in xrange(0, len(table), chunksize):
+            record_list = obtain_records(table.iloc[start:start + chunksize])
+            connection.execute(database_table.insert().values([dict(zip(column_list, record)) for record in record_list]))
+        return
+    # the statement is built once for the chunks with the same number of rows
+    row_string = '(' + ', '.join([PLACEHOLDER_DICT[dialect.paramstyle]] * len(table.columns)) + ')'
+    column_string = ', '.join([quote_name(connection, column) for column in table.columns])
+    statement_dict = {}
+    cursor = connection.connection.cursor()
+    try:
+        for start in xrange(0, len(table), chunksize):
+            record_list = obtain_records(table.iloc[start:start + chunksize])
+            if len(record_list) not in statement_dict:
+                statement_dict[len(record_list)] = 'INSERT INTO %s (%s) VALUES %s' % (quote_name(connection, tablename), column_string, ', '.join([row_string] * len(record_list)))
+            cursor.execute(statement_dict[len(record_list)], [value for record in record_list for value in record])
+    finally:
+        cursor.close()
+
+
+def create_staging(table, tablename, engine, index_label='id'):
+    """
+    Create the empty staging table with the columns of the dataframe
+
+    :param table: the dataframe, only the columns and the dtypes are used
+    :param tablename: the name of the table
+    :param engine: database connect engine
+    :param index_label: the name of the column for the index. If it is None, the index is not exported
+    :return: None
+    """
+    staging_name = obtain_staging_name(tablename)
+    prepare_table(table.iloc[:0], index_label).to_sql(name=staging_name, con=engine, if_exists='replace', index=False)
+
+
+def append_staging(table, tablename, engine, chunksize=None, index_label='id'):
+    """
+    Insert the records into the staging table
+
+    :param table: the dataframe
+    :param tablename: the name of the table
+    :param engine: database connect engine
+    :param chunksize: the number of rows in each chunk
+    :param index_label: the name of the column for the index. If it is None, the index is not exported
+    :return: None
+    """
+    with engine.begin() as connection:
+        insert_table(connection, prepare_table(table, index_label), obtain_staging_name(tablename), chunksize)
+
+
+def drop_staging(tablename, engine):
+    """
+    Remove the staging table if it exists
+
+    :param tablename: the name of the table
+    :param engine: database connect engine
+    :return: None
+    """
+    execute_atomic(engine, ['DROP TABLE IF EXISTS %s' % quote_name(engine, obtain_staging_name(tablename))])
+
+
+def swap_staging(tablename, engine, index_list=None):
+    """
+    Replace the table with the staging table and create the indexes in one transaction
+
+    :param tablename: the name of the table
+    :param engine: database connect engine
+    :param index_list: list of the column lists for the indexes. The indexes whose columns are not in the table are skipped. If it is None, INDEX_LIST is used
+    :return: None
+    """
+    if index_list is None:
+        index_list = INDEX_LIST
+    staging_name = obtain_staging_name(tablename)
+    column_set = set([column['name'] for column in inspect(engine).get_columns(staging_name)])
+    statement_list = ['DROP TABLE IF EXISTS %s' % quote_name(engine, tablename),
+                      'ALTER TABLE %s RENAME TO %s' % (quote_name(engine, staging_name), quote_name(engine, tablename))]
+    for column_list in index_list:
+        if not set(column_list).issubset(column_set):
+            continue
+        index_name = 'ix_' + tablename + '_' + '_'.join(column_list)
+        column_string = ', '.join([quote_name(engine, column) for column in column_list])
+        statement_list.append('CREATE INDEX %s ON %s (%s)' % (quote_name(engine, index_name), quote_name(engine, tablename), column_string))
+    execute_atomic(engine, statement_list)
+
+
+def export_table(table, tablename, engine, chunksize=None, index_label='id', index_list=None):
+    """
+    Export the dataframe into the database table in bulk
+
+    The old table is kept until all the records are written into the staging table, and it is replaced in one transaction. If the export fails, the staging table is removed and the old table is not changed.
+
+    :param table: the dataframe
+    :param tablename: the name of the table
+    :param engine: database connect engine
+    :param chunksize: the number of rows in each chunk
+    :param index_label: the name of the column for the index. If it is None, the index is not exported
+    :param index_list: list of the column lists for the indexes, see swap_staging
+    :return: None
+    """
+    create_staging(table, tablename, engine, index_label)
+    try:
+        append_staging(table, tablename, engine, chunksize, index_label)
+        swap_staging(tablename, engine, index_list)
+    except:
+        drop_staging(tablename, engine)
+        raise
+
+
+def iterate_table(engine, tablename, date_list=None, shape_list=None, columns=None, date_column='service_date', shape_column='shape_id', chunksize=READ_CHUNK_SIZE):
+    """
+    Read the records of the given service dates and shape ids chunk by chunk
+
+    Algorithm:
+    split the service dates and the shape ids into batches within the limit of variables of the database
+    for each pair of the batches:
+        query the records with the IN conditions on the indexed columns, ordered by id
+        yield the records chunk by chunk from a server side cursor
+
+    :param engine: database connect engine
+    :param tablename: the name of the database table
+    :param date_list: list of the service dates. If it is None, all the service dates are read
+    :param shape_list: list of the shape ids. If it is None, all the shape ids are read
+    :param columns: list of the columns. If it is None, all the columns are read
+    :param date_column: the name of the column for the service date
+    :param shape_column: the name of the column for the shape id
+    :param chunksize: the number of rows in each chunk
+    :return: generator of the dataframes with the id column as the index
+    """
+    database_table = Table(tablename, MetaData(), autoload=True, autoload_with=engine)
+    index_col = 'id' if 'id' in database_table.columns else None
+    batch_size = obtain_batch_size(engine.dialect.name)
+    date_batch_list = obtain_value_batches(date_list, batch_size)
+    shape_batch_list = obtain_value_batches(shape_list, batch_size)
+    # the server side cursor fetches the records chunk by chunk, otherwise psycopg2 fetches the whole result into memory before the first chunk
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        for date_batch in date_batch_list:
+            for shape_batch in shape_batch_list:
+                statement = build_query(database_table, date_batch, shape_batch, columns, date_column, shape_column)
+                for chunk in pd.read_sql(statement, connection, index_col=index_col, chunksize=chunksize):
+                    yield chunk
+    finally:
+        connection.close()
+
+
+def read_table(engine, tablename, date_list=None, shape_list=None, columns=None, date_column='service_date', shape_column='shape_id', chunksize=READ_CHUNK_SIZE, table_name=None):
+    """
+    Read the records of the given service dates and shape ids with the compact dtypes
+
+    Each chunk is converted into the compact dtypes before the next chunk is read, so the records are not kept in memory with the default dtypes of pandas.
+
+    :param engine: database connect engine
+    :param tablename: the name of the database table
+    :param date_list: list of the service dates. If it is None, all the service dates are read
+    :param shape_list: list of the shape ids. If it is None, all the shape ids are read
+    :param columns: list of the columns. If it is None, all the columns are read
+    :param date_column: the name of the column for the service date, example: 'date' for the api_data table
+    :param shape_column: the name of the column for the shape id
+    :param chunksize: the number of rows in each chunk
+    :param table_name: the name of the table in schema.py. If it is None, the name of the database table is used when it is in the schema, otherwise the dtypes are not changed
+    :return: dataframe of the records in the order of the id column
+    """
+    if table_name is None and tablename in schema.SCHEMA:
+        table_name = tablename
+    result_list = []
+    for chunk in iterate_table(engine, tablename, date_list, shape_list, columns, date_column, shape_column, chunksize):
+        if table_name is not None:
+            chunk = schema.apply_schema(chunk, table_name)
+        result_list.append(chunk)
+    if result_list == []:
+        if columns is None:
+            columns = [column['name'] for column in inspect(engine).get_columns(tablename) if column['name'] != 'id']
+        return pd.DataFrame(columns=columns)
+    result = pd.concat(result_list)
+    if len(result_list) > 1:
+        result.sort_index(kind='mergesort', inplace=True)
+    if table_name is not None:
+        # the categorical columns of the chunks with different categories are concatenated as strings
+        result = schema.apply_schema(result, table_name)
+    return result
+
+
+class DatabaseTable(object):
+    """
+    A table in the database which can be given to the functions in place of the dataframe, example: the full_history parameter of obtain_segment
+
+    Only the records of the required service dates and shape ids are read from the database. The engine is created again from the url in the worker processes.
+    """
+
+    def __init__(self, engine, tablename, table_name=None, chunksize=READ_CHUNK_SIZE):
+        """
+        :param engine: database connect engine or the url of the database
+        :param tablename: the name of the database table
+        :param table_name: the name of the table in schema.py, see read_table
+        :param chunksize: the number of rows in each chunk
+        """
+        if isinstance(engine, basestring):
+            engine = create_engine(engine)
+        self._engine = engine
+        self.url = engine.url
+        self.tablename = tablename
+        self.table_name = table_name
+        self.chunksize = chunksize
+
+    def __getstate__(self):
+        """
+        The engine is not sent to the worker processes
+
+        :return: the attributes without the engine
+        """
+        state = self.__dict__.copy()
+        state['_engine'] = None
+        return state
+
+    @property
+    def engine(self):
+        """
+        :return: the database connect engine
+        """
+        if self._engine is None:
+            self._engine = create_engine(self.url)
+        return self._engine
+
+    def select(self, date_list=None, shape_list=None, columns=None, date_column='service_date', shape_column='shape_id'):
+        """
+        Read the records of the given service dates and shape ids, see read_table
+
+        :return: dataframe of the records in the order of the id column
+        """
+        return read_table(self.engine, self.tablename, date_list, shape_list, columns, date_column, shape_column, self.chunksize, self.table_name)
+
+    def distinct(self, column):
+        """
+        :param column: the name of the column
+        :return: sorted list of the distinct values of the column
+        """
+        database_table = Table(self.tablename, MetaData(), autoload=True, autoload_with=self.engine)
+        statement = select([database_table.columns[column]]).distinct()
+        with self.engine.connect() as connection:
+            return sorted([row[0] for row in connection.execute(statement)])
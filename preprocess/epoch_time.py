@@ -0,0 +1,113 @@
+"""
+Calculate the timestamps with numpy arrays of epoch microseconds
+
+The timestamps of a whole trip or a whole table are converted into integers once, so the arrival times can be calculated for all the records at the same time instead of parsing and formatting each timestamp with datetime. The results are exactly the same as the calculation with datetime and timedelta:
+
+* parse_timestamp: like datetime.strptime
+* seconds_to_microseconds: like timedelta(0, seconds)
+* format_timestamp: like str(datetime)
+
+The history, segment, api_data and baseline tables carry two integer columns set once when the table is generated, so the consumers compare and calculate the time with integers instead of parsing the strings again. The string columns are still kept for compatibility:
+
+* epoch_time: the number of seconds since the epoch, the fractional part is removed like timestamp[:19]
+* seconds_of_day: the number of seconds since the midnight
+"""
+
+# import module
+import pandas as pd
+import numpy as np
+
+
+def parse_timestamp(time_series):
+    """
+    Convert the timestamps into the epoch microseconds
+
+    :param time_series: series or list of the timestamp string, example: '2016-01-05T17:00:00Z' or '2016-01-05 17:00:00.500000'
+    :return: numpy array of the epoch microseconds in integer
+    """
+    if len(time_series) == 0:
+        return np.array([], dtype=np.int64)
+    return pd.to_datetime(time_series).values.astype('datetime64[us]').astype(np.int64)
+
+
+def seconds_to_microseconds(seconds_array):
+    """
+    Convert the float seconds into the integer microseconds with the same rounding as timedelta(0, seconds)
+
+    Algorithm:
+    split the seconds into the integer part and the fractional part
+    multiply the fractional part by 1000000 and split it into the integer part and the fractional part again
+    round the remained fractional part to the nearest integer, and round half away from zero
+
+    :param seconds_array: numpy array of the seconds in float
+    :return: numpy array of the microseconds in integer
+    """
+    fractional_part, integral_part = np.modf(np.asarray(seconds_array, dtype=float))
+    leftover, microseconds = np.modf(fractional_part * 1000000.0)
+    leftover = np.where(leftover >= 0, np.floor(leftover + 0.5), np.ceil(leftover - 0.5))
+    return integral_part.astype(np.int64) * 1000000 + microseconds.astype(np.int64) + leftover.astype(np.int64)
+
+
+def format_timestamp(time_array):
+    """
+    Convert the epoch microseconds into the string with the same format as str(datetime)
+
+    :param time_array: numpy array of the epoch microseconds in integer
+    :return: list of the timestamp string, example: '2016-01-05 17:00:00' or '2016-01-05 17:00:00.500000'
+    """
+    result = []
+    for time_string in np.datetime_as_string(np.asarray(time_array, dtype=np.int64).astype('datetime64[us]')):
+        time_string = time_string.replace('T', ' ')
+        if time_string.endswith('.000000'):
+            time_string = time_string[:-7]
+        result.append(time_string)
+    return result
+
+
+#################################################################################################################
+#                                    typed time columns                                                         #
+#################################################################################################################
+
+
+def set_time_columns(table, time_array, epoch_column='epoch_time', seconds_column='seconds_of_day'):
+    """
+    Set the epoch_time and seconds_of_day columns from the epoch microseconds
+
+    :param table: the dataframe
+    :param time_array: numpy array of the epoch microseconds in integer with the same length as the table
+    :param epoch_column: the name of the epoch seconds column
+    :param seconds_column: the name of the seconds of day column
+    :return: the dataframe with the two integer columns
+    """
+    second_array = np.asarray(time_array, dtype=np.int64) // 1000000
+    table[epoch_column] = second_array
+    table[seconds_column] = second_array % 86400
+    return table
+
+
+def add_time_columns(table, time_column='timestamp', epoch_column='epoch_time', seconds_column='seconds_of_day'):
+    """
+    Parse the time column and add the epoch_time and seconds_of_day columns
+
+    :param table: the dataframe with the time column
+    :param time_column: the name of the time column, example: 'timestamp' in history and segment table, 'time_of_day' in api_data and baseline table
+    :param epoch_column: the name of the epoch seconds column
+    :param seconds_column: the name of the seconds of day column
+    :return: the dataframe with the two integer columns
+    """
+    return set_time_columns(table, parse_timestamp(table[time_column]), epoch_column, seconds_column)
+
+
+def ensure_time_columns(table, time_column='timestamp', epoch_column='epoch_time', seconds_column='seconds_of_day'):
+    """
+    Make sure the table has the epoch_time and seconds_of_day columns, example: the table is read from a file exported by an older version
+
+    :param table: the dataframe with the time column
+    :param time_column: the name of the time column
+    :param epoch_column: the name of the epoch seconds column
+    :param seconds_column: the name of the seconds of day column
+    :return: the table itself if it has both of the columns, otherwise a copy of the table with the two integer columns
+    """
+    if epoch_column in table.columns and seconds_column in table.columns:
+        return table
+    return add_time_columns(table.copy(), time_column, epoch_column, seconds_column)
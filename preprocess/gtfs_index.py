@@ -0,0 +1,148 @@
+"""
+Build the lookup index for the GTFS dataset
+
+The index is built once from the trips.txt and stop_times.txt files, and it can be saved into a file and loaded later. It provides the following lookups without scanning the whole table:
+
+* trip id -> route id
+* trip id -> shape id
+* trip id -> stop sequence
+* shape id -> set of trip id
+"""
+
+# import module
+import numpy as np
+import cPickle as pickle
+import hashlib
+
+
+class GTFSIndex(object):
+    """
+    Lookup index for the trips.txt and stop_times.txt files in GTFS dataset
+    """
+
+    def __init__(self, trips, stop_times=None):
+        """
+        Build the lookup index
+
+        :param trips: the dataframe for the trips.txt file in GTFS dataset
+        :param stop_times: the dataframe for the stop_times.txt file in GTFS dataset. If it is None, the stop sequence is not available
+        """
+        trip_table = trips.drop_duplicates('trip_id').set_index('trip_id')
+        self.route_dict = trip_table['route_id'].to_dict()
+        self.shape_dict = trip_table['shape_id'].to_dict()
+        self.shape_trip_dict = {}
+        for trip_id, shape_id in self.shape_dict.iteritems():
+            self.shape_trip_dict.setdefault(shape_id, set()).add(trip_id)
+        self.stop_sequence_dict = {}
+        if stop_times is not None:
+            # sort the stop_times by trip id and keep the order of stops in each trip
+            trip_array = stop_times['trip_id'].values
+            order = np.argsort(trip_array, kind='mergesort')
+            trip_array = trip_array[order]
+            stop_array = stop_times['stop_id'].values[order]
+            boundary = np.flatnonzero(trip_array[1:] != trip_array[:-1]) + 1
+            start_list = [0] + list(boundary)
+            end_list = list(boundary) + [len(trip_array)]
+            for start, end in zip(start_list, end_list):
+                self.stop_sequence_dict[trip_array[start]] = stop_array[start:end].tolist()
+
+    def route_id(self, trip_id):
+        """
+        :param trip_id: the trip id
+        :return: the route id of the trip
+        """
+        return self.route_dict[trip_id]
+
+    def shape_id(self, trip_id):
+        """
+        :param trip_id: the trip id
+        :return: the shape id of the trip
+        """
+        return self.shape_dict[trip_id]
+
+    def stop_sequence(self, trip_id):
+        """
+        :param trip_id: the trip id
+        :return: the list of stop id for the trip. Empty list if the trip is not in stop_times.txt file
+        """
+        return self.stop_sequence_dict.get(trip_id, [])
+
+    def trip_set(self, shape_id):
+        """
+        :param shape_id: the shape id
+        :return: the set of trip id with that shape id
+        """
+        return self.shape_trip_dict.get(shape_id, set())
+
+    def add_route_shape(self, table, trip_column='trip_id'):
+        """
+        Add the route_id and shape_id columns into the table according to the trip id
+
+        :param table: the dataframe with the trip id column
+        :param trip_column: the name of the trip id column
+        :return: the dataframe with the route_id and shape_id columns
+        """
+        table['route_id'] = table[trip_column].map(self.route_dict)
+        table['shape_id'] = table[trip_column].map(self.shape_dict)
+        return table
+
+    def subset(self, trip_set):
+        """
+        Build the lookup index for a subset of the trips, example: the trips sent to a worker process
+
+        :param trip_set: the set of trip id
+        :return: the GTFSIndex object with only the given trips
+        """
+        result = GTFSIndex.__new__(GTFSIndex)
+        result.route_dict = {trip_id: self.route_dict[trip_id] for trip_id in trip_set if trip_id in self.route_dict}
+        result.shape_dict = {trip_id: self.shape_dict[trip_id] for trip_id in trip_set if trip_id in self.shape_dict}
+        result.shape_trip_dict = {}
+        for trip_id, shape_id in result.shape_dict.iteritems():
+            result.shape_trip_dict.setdefault(shape_id, set()).add(trip_id)
+        result.stop_sequence_dict = {trip_id: self.stop_sequence_dict[trip_id] for trip_id in trip_set if trip_id in self.stop_sequence_dict}
+        return result
+
+    def version(self):
+        """
+        Calculate the version of the lookup index, which is changed when the route id, shape id or stop sequence of any trip is changed
+
+        :return: the md5 string of the lookup index
+        """
+        md5 = hashlib.md5()
+        for trip_id in sorted(self.route_dict):
+            md5.update(repr((trip_id, self.route_dict[trip_id], self.shape_dict.get(trip_id), self.stop_sequence(trip_id))))
+        return md5.hexdigest()
+
+    def save(self, save_path):
+        """
+        Save the lookup index into a file
+
+        :param save_path: path of the file
+        :return: None
+        """
+        with open(save_path, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_gtfs_index(load_path):
+    """
+    Load the lookup index from a file
+
+    :param load_path: path of the file generated by GTFSIndex.save
+    :return: the GTFSIndex object
+    """
+    with open(load_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def obtain_gtfs_index(trips, stop_times=None):
+    """
+    Obtain the lookup index for the GTFS dataset
+
+    :param trips: the dataframe for the trips.txt file or the GTFSIndex object
+    :param stop_times: the dataframe for the stop_times.txt file
+    :return: the GTFSIndex object
+    """
+    if isinstance(trips, GTFSIndex):
+        return trips
+    return GTFSIndex(trips, stop_times)
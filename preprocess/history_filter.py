@@ -0,0 +1,148 @@
+"""
+Remove the abnormal records in the history table
+
+A record is abnormal if its next stop is not in the stop sequence of the trip, or the bus doesn't move forward compared with the previous normal record. The normal records are exactly the records whose total_distance is larger than the running maximum of the previous records, so the filter is computed with a running maximum and a boolean mask instead of walking the records one by one.
+
+list of functions:
+
+* obtain_progress_mask: the mask for the records of a single trip
+* filter_single_history: filter the records of a single trip
+* filter_history: filter the records of all the trips in the history table in one pass
+"""
+
+# import module
+import pandas as pd
+import numpy as np
+
+
+#################################################################################################################
+#                                    helper function                                                            #
+#################################################################################################################
+
+
+def obtain_progress_mask(distance_array):
+    """
+    Obtain the mask of the records which move forward for a single trip
+
+    Algorithm:
+    the first record is kept
+    the other records are kept if the total_distance is larger than the maximum total_distance of all the previous records
+
+    If there is any nan in the total_distance, the records are checked one by one with the same comparisons as the original loop: the nan is never smaller than the running maximum, and the last record is kept only if it is larger than the previous kept record.
+
+    :param distance_array: numpy array of the total_distance in float
+    :return: numpy array of boolean
+    """
+    mask = np.ones(len(distance_array), dtype=bool)
+    if len(distance_array) < 2:
+        return mask
+    if not np.isnan(distance_array).any():
+        mask[1:] = distance_array[1:] > np.maximum.accumulate(distance_array)[:-1]
+        return mask
+    mask[:] = False
+    keep_list = [0]
+    current_distance = distance_array[0]
+    for i in xrange(1, len(distance_array)):
+        if not current_distance >= distance_array[i]:
+            keep_list.append(i)
+            current_distance = distance_array[i]
+    if len(keep_list) > 1 and keep_list[-1] == len(distance_array) - 1 and not distance_array[keep_list[-1]] > distance_array[keep_list[-2]]:
+        keep_list.pop()
+    mask[keep_list] = True
+    return mask
+
+
+def obtain_pair_code(key_array, stop_array, table_key_array, table_stop_array):
+    """
+    Encode the (key, stop id) pairs of the history table and the stop table into integers
+
+    :param key_array: numpy array of the key like the trip id or shape id in the history table
+    :param stop_array: numpy array of the next stop id in the history table
+    :param table_key_array: numpy array of the key in the stop table
+    :param table_stop_array: numpy array of the stop id in the stop table
+    :return: tuple of the integer codes for the history table and the stop table. The pairs with nan are encoded as -1
+    """
+    key_code = pd.factorize(np.concatenate([key_array, table_key_array]))[0].astype(np.int64)
+    stop_code = pd.factorize(np.concatenate([stop_array, table_stop_array]))[0].astype(np.int64)
+    pair_code = key_code * (stop_code.max() + 1) + stop_code
+    pair_code[(key_code < 0) | (stop_code < 0)] = -1
+    return pair_code[:len(key_array)], pair_code[len(key_array):]
+
+
+#################################################################################################################
+#                                    main function                                                              #
+#################################################################################################################
+
+
+def filter_single_history(single_history, stop_sequence):
+    """
+    Filter the history file with only one day and one stop sequence to remove abnormal record
+
+    :param single_history: dataframe for history table with only one day
+    :param stop_sequence: list of stop id
+    :return: dataframe for filtered history table
+    """
+    current_history = single_history[
+        (single_history.next_stop_id.isin(stop_sequence)) & (single_history.dist_along_route > 0)]
+    if len(current_history) < 3:
+        return None
+    mask = obtain_progress_mask(current_history['total_distance'].values.astype(float))
+    return current_history[mask].reset_index(drop=True)
+
+
+def filter_history(history, stop_table, key_column='trip_id', group_columns=None, stop_column='stop_id'):
+    """
+    Filter the records of all the trips in the history table in one pass
+
+    The result is the same as calling filter_single_history for each group of group_columns, and the groups with less than 3 records in the stop sequence are removed.
+
+    Algorithm:
+    sort the history table by group_columns and keep the order of the records in each group
+    keep the records whose (key, next_stop_id) is in the stop table and dist_along_route > 0
+    remove the groups with less than 3 records
+    calculate the running maximum of the total_distance in each group
+    keep the first record of each group and the records larger than the running maximum of the previous records
+
+    :param history: dataframe for the history table
+    :param stop_table: dataframe of the stop sequence for each key, example: route_stop_dist with the key shape_id, or the stop_times with the key trip_id
+    :param key_column: the name of the column for the stop sequence in both of the history table and the stop table
+    :param group_columns: the list of columns for a single trip. If it is None, ['service_date', 'trip_id'] is used
+    :param stop_column: the name of the column for the stop id in the stop table
+    :return: dataframe for the filtered history table with the original index
+    """
+    if group_columns is None:
+        group_columns = ['service_date', 'trip_id']
+    history = history.sort_values(group_columns, kind='mergesort')
+    history_code, table_code = obtain_pair_code(history[key_column].values, history['next_stop_id'].values,
+                                                 stop_table[key_column].values, stop_table[stop_column].values)
+    history = history[np.in1d(history_code, table_code[table_code >= 0]) & (history_code >= 0) & (history.dist_along_route > 0).values]
+    if len(history) == 0:
+        return history
+    # split the groups
+    start_array = np.zeros(len(history), dtype=bool)
+    start_array[0] = True
+    for column in group_columns:
+        value_array = history[column].values
+        start_array[1:] |= value_array[1:] != value_array[:-1]
+    group_array = np.cumsum(start_array) - 1
+    size_mask = np.bincount(group_array)[group_array] >= 3
+    history = history[size_mask]
+    start_array = start_array[size_mask]
+    if len(history) == 0:
+        return history
+    group_array = np.cumsum(start_array) - 1
+    # compare with the running maximum in each group: the total_distance is replaced by its rank and shifted by the group so that the groups don't overlap
+    distance_array = history['total_distance'].values.astype(float)
+    nan_array = np.isnan(distance_array)
+    rank_array = np.unique(np.where(nan_array, 0.0, distance_array), return_inverse=True)[1].astype(np.int64)
+    rank_array += group_array * (rank_array.max() + 1)
+    running_max = np.maximum.accumulate(rank_array)
+    mask = start_array.copy()
+    mask[1:] |= rank_array[1:] > running_max[:-1]
+    # the groups with nan are checked one by one
+    if nan_array.any():
+        boundary = np.append(np.flatnonzero(start_array), len(history))
+        for group in np.unique(group_array[nan_array]):
+            start, end = boundary[group], boundary[group + 1]
+            mask[start:end] = obtain_progress_mask(distance_array[start:end])
+    return history[mask]
@@ -0,0 +1,221 @@
+"""
+Store the tables like history and segment in a partitioned store
+
+The partitioned store is a directory with one compressed HDF5 file for each service date. In each file, the records of every shape id are saved in a separate table, so that the reader can load only the required service dates, shape ids and columns instead of reading the whole csv file.
+
+format of the directory:
+    store_path/
+        20160105.h5
+            shape_<encoded shape id>
+            shape_<encoded shape id>
+            ...
+        20160106.h5
+        ...
+"""
+
+# import module
+import pandas as pd
+import numpy as np
+import os
+import binascii
+import db_io
+
+
+# the minimum size of the string columns appended into the staging files, so that the longer strings in the later chunks can be appended
+STRING_SIZE = 64
+
+
+#################################################################################################################
+#                                    helper function                                                            #
+#################################################################################################################
+
+
+def encode_shape(shape_id):
+    """
+    Convert the shape id into the key of the table in the HDF5 file
+
+    :param shape_id: the shape id, example: 'M010123'
+    :return: the key in the HDF5 file
+    """
+    return 'shape_' + binascii.hexlify(str(shape_id))
+
+
+def obtain_date_list(store_path):
+    """
+    Obtain the list of service dates in the partitioned store
+
+    :param store_path: path of the directory of the partitioned store
+    :return: sorted list of the service dates in integer
+    """
+    if not os.path.exists(store_path):
+        return []
+    return sorted([int(filename[:-3]) for filename in os.listdir(store_path) if filename.endswith('.h5')])
+
+
+#################################################################################################################
+#                                    main function                                                              #
+#################################################################################################################
+
+
+def write_partition(table, store_path, date_column='service_date', shape_column='shape_id'):
+    """
+    Write the table into the partitioned store
+
+    The service dates in the table replace the corresponding partitions in the store, the other partitions are kept.
+
+    Algorithm:
+    split the table by the service date
+    for each service date:
+        write the records of each shape id into a temporary HDF5 file
+        replace the HDF5 file of that service date with the temporary file
+
+    :param table: the dataframe to be stored, example: the history table
+    :param store_path: path of the directory of the partitioned store
+    :param date_column: the name of the column for the service date
+    :param shape_column: the name of the column for the shape id
+    :return: None
+    """
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    for service_date, date_table in table.groupby(date_column):
+        filename = os.path.join(store_path, str(int(service_date)) + '.h5')
+        tmp_filename = filename + '.tmp'
+        store = pd.HDFStore(tmp_filename, mode='w', complevel=9, complib='blosc')
+        try:
+            for shape_id, item in date_table.groupby(np.asarray(date_table[shape_column])):
+                store.put(encode_shape(shape_id), item, format='table')
+        finally:
+            store.close()
+        os.rename(tmp_filename, filename)
+
+
+def append_partition(table, store_path, date_column='service_date', shape_column='shape_id'):
+    """
+    Append the records into the staging files of the partitioned store
+
+    A large table can be written chunk by chunk without keeping it in memory: the records of each service date are appended into a temporary HDF5 file, and the partitions are replaced by commit_partition after all the chunks are appended. Call drop_partition_staging before the first chunk to remove the staging files of a failed run.
+
+    :param table: the dataframe of a chunk, example: a chunk of the history table
+    :param store_path: path of the directory of the partitioned store
+    :param date_column: the name of the column for the service date
+    :param shape_column: the name of the column for the shape id
+    :return: None
+    """
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    for service_date, date_table in table.groupby(date_column):
+        tmp_filename = os.path.join(store_path, str(int(service_date)) + '.h5.tmp')
+        store = pd.HDFStore(tmp_filename, mode='a', complevel=9, complib='blosc')
+        try:
+            for shape_id, item in date_table.groupby(np.asarray(date_table[shape_column])):
+                key = encode_shape(shape_id)
+                if key in store:
+                    # keep the dtypes of the previous chunks
+                    stored_dtypes = store.select(key, stop=0).dtypes
+                    for column in item.columns:
+                        if item[column].dtype != stored_dtypes[column]:
+                            item[column] = item[column].astype(stored_dtypes[column])
+                store.append(key, item, format='table', min_itemsize={'values': STRING_SIZE})
+        finally:
+            store.close()
+
+
+def commit_partition(store_path):
+    """
+    Replace the partitions with the staging files written by append_partition
+
+    :param store_path: path of the directory of the partitioned store
+    :return: None
+    """
+    if not os.path.exists(store_path):
+        return
+    for filename in os.listdir(store_path):
+        if filename.endswith('.h5.tmp'):
+            os.rename(os.path.join(store_path, filename), os.path.join(store_path, filename[:-4]))
+
+
+def drop_partition_staging(store_path):
+    """
+    Remove the staging files written by append_partition
+
+    :param store_path: path of the directory of the partitioned store
+    :return: None
+    """
+    if not os.path.exists(store_path):
+        return
+    for filename in os.listdir(store_path):
+        if filename.endswith('.h5.tmp'):
+            os.remove(os.path.join(store_path, filename))
+
+
+def delete_partition(store_path, date_list):
+    """
+    Delete the partitions of the given service dates from the partitioned store
+
+    :param store_path: path of the directory of the partitioned store
+    :param date_list: list of the service dates to delete
+    :return: None
+    """
+    for service_date in date_list:
+        filename = os.path.join(store_path, str(int(service_date)) + '.h5')
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def read_partition(store_path, date_list=None, shape_list=None, columns=None):
+    """
+    Read the records from the partitioned store
+
+    :param store_path: path of the directory of the partitioned store
+    :param date_list: list of service dates to read. If it is None, all the service dates are read
+    :param shape_list: list of shape ids to read. If it is None, all the shape ids are read
+    :param columns: list of columns to read. If it is None, all the columns are read
+    :return: dataframe of the records in the original order
+    """
+    file_date_list = obtain_date_list(store_path)
+    if date_list is not None:
+        date_set = set([int(date) for date in date_list])
+        file_date_list = [date for date in file_date_list if date in date_set]
+    if shape_list is not None:
+        key_set = set(['/' + encode_shape(shape_id) for shape_id in shape_list])
+    result_list = []
+    for service_date in file_date_list:
+        store = pd.HDFStore(os.path.join(store_path, str(service_date) + '.h5'), mode='r')
+        try:
+            for key in sorted(store.keys()):
+                # the categorical columns are saved with the meta tables under the key of the table
+                if key.count('/') > 1 or (shape_list is not None and key not in key_set):
+                    continue
+                result_list.append(store.select(key, columns=columns))
+        finally:
+            store.close()
+    if result_list == []:
+        return pd.DataFrame(columns=columns)
+    result = pd.concat(result_list)
+    result.sort_index(inplace=True)
+    return result
+
+
+def select_table(table, date_list=None, shape_list=None, columns=None, date_column='service_date', shape_column='shape_id'):
+    """
+    Select the records of the given service dates and shape ids from a table
+
+    :param table: the dataframe of the table, the path of the partitioned store for that table or the db_io.DatabaseTable
+    :param date_list: list of the service dates. If it is None, all the service dates are selected
+    :param shape_list: list of the shape ids. If it is None, all the shape ids are selected
+    :param columns: list of the columns. If it is None, all the columns are selected
+    :param date_column: the name of the column for the service date
+    :param shape_column: the name of the column for the shape id
+    :return: dataframe of the selected records
+    """
+    if isinstance(table, basestring):
+        return read_partition(table, date_list, shape_list, columns)
+    if isinstance(table, db_io.DatabaseTable):
+        return table.select(date_list, shape_list, columns, date_column, shape_column)
+    if date_list is not None:
+        table = table[table[date_column].isin(date_list)]
+    if shape_list is not None:
+        table = table[table[shape_column].isin(shape_list)]
+    if columns is not None:
+        table = table[columns]
+    return table
@@ -0,0 +1,167 @@
+"""
+Declare the compact dtypes of the tables and apply them to the dataframes
+
+With the default dtypes of pandas, the ids are saved as python strings and all the numbers are saved in 64 bits, so the history table of a month doesn't fit in the memory. The compact schema of each table is:
+
+* trip_id, vehicle_id, route_id, shape_id: category, the string of each id is saved once
+* stop ids: int32
+* distances and coordinates: float32
+* service date: int32
+* epoch_time: int64, seconds_of_day: int32
+* small flags like weather, day_of_week and rush_hour: int8 or bool
+
+The travel durations and the arrival times are kept in float64, and the timestamp and time_of_day strings are kept for compatibility.
+
+list of functions:
+
+* apply_schema: convert the columns of a table into the compact dtypes
+* read_table: read the csv file of a table with the compact dtypes
+* obtain_memory_usage: the memory usage of a table in bytes
+* memory_report: compare the memory usage before and after applying the schema
+"""
+
+# import module
+import pandas as pd
+import numpy as np
+from collections import OrderedDict
+
+
+#################################################################################################################
+#                                    schema                                                                     #
+#################################################################################################################
+
+
+ID_SCHEMA = {'trip_id': 'category', 'vehicle_id': 'category', 'route_id': 'category', 'shape_id': 'category'}
+
+TIME_SCHEMA = {'epoch_time': 'int64', 'seconds_of_day': 'int32'}
+
+SCHEMA = {
+    'history': dict(ID_SCHEMA, **dict(TIME_SCHEMA, **{
+        'latitude': 'float32', 'longitude': 'float32', 'bearing': 'float32', 'progress': 'int8', 'service_date': 'int32',
+        'block_assigned': 'int8', 'next_stop_id': 'int32', 'dist_along_route': 'float32', 'dist_from_stop': 'float32',
+        'total_distance': 'float32'})),
+    'route_stop_dist': dict(ID_SCHEMA, **{
+        'stop_id': 'int32', 'direction_id': 'int8', 'dist_along_route': 'float32'}),
+    'segment': dict(ID_SCHEMA, **dict(TIME_SCHEMA, **{
+        'segment_start': 'int32', 'segment_end': 'int32', 'weather': 'int8', 'service_date': 'int32', 'day_of_week': 'int8'})),
+    'api_data': dict(ID_SCHEMA, **dict(TIME_SCHEMA, **{
+        'stop_id': 'int32', 'date': 'int32', 'dist_along_route': 'float32'})),
+    'baseline': dict(ID_SCHEMA, **dict(TIME_SCHEMA, **{
+        'stop_id': 'int32', 'service_date': 'int32', 'dist_along_route': 'float32', 'stop_num_from_call': 'int16',
+        'weather': 'int8', 'rush_hour': 'int8'})),
+    'dataset': dict(ID_SCHEMA, **{
+        'service_date': 'int32', 'weather': 'int8', 'rush_hour': 'int8', 'stop_id': 'int32', 'dist_along_route': 'float32'}),
+}
+
+
+#################################################################################################################
+#                                    helper function                                                            #
+#################################################################################################################
+
+
+def convert_column(column, dtype):
+    """
+    Convert a column into the given dtype
+
+    The integer dtypes are only used when the column has no missing value and all the values are integers in the range of the dtype, otherwise the column is kept unchanged. The category dtype is only used for the string columns.
+
+    :param column: the series of the column
+    :param dtype: the name of the dtype, example: 'category', 'int32', 'float32'
+    :return: the converted series
+    """
+    if dtype == 'category':
+        if column.dtype == object:
+            return column.astype('category')
+        return column
+    if column.dtype == object:
+        column = pd.to_numeric(column, errors='ignore')
+        if column.dtype == object:
+            return column
+    if dtype.startswith('int'):
+        if column.dtype == bool:
+            return column.astype(dtype)
+        if column.dtype.kind not in 'iuf':
+            return column
+        values = column.values
+        if len(values) > 0:
+            info = np.iinfo(dtype)
+            if np.isnan(values.astype(float)).any() or values.min() < info.min or values.max() > info.max:
+                return column
+            if column.dtype.kind == 'f' and (values != np.floor(values)).any():
+                return column
+        return column.astype(dtype)
+    if column.dtype.kind not in 'iuf':
+        return column
+    return column.astype(dtype)
+
+
+#################################################################################################################
+#                                    main function                                                              #
+#################################################################################################################
+
+
+def apply_schema(table, table_name):
+    """
+    Convert the columns of a table into the compact dtypes declared in the schema
+
+    The columns which are not in the schema are kept unchanged, and the table given by the user is not modified.
+
+    :param table: the dataframe of the table
+    :param table_name: the name of the table in the schema: 'history', 'route_stop_dist', 'segment', 'api_data', 'baseline' or 'dataset'
+    :return: the dataframe with the compact dtypes
+    """
+    if table is None:
+        return None
+    table_schema = SCHEMA[table_name]
+    column_dict = OrderedDict()
+    for column in table.columns:
+        if column in table_schema:
+            column_dict[column] = convert_column(table[column], table_schema[column])
+        else:
+            column_dict[column] = table[column]
+    return pd.DataFrame(column_dict, index=table.index, columns=table.columns)
+
+
+def read_table(path, table_name, index_col=0, **kwargs):
+    """
+    Read the csv file of a table with the compact dtypes
+
+    The id columns are parsed into categories directly, so the strings are not kept in memory during the reading.
+
+    :param path: path of the csv file exported by the obtain functions
+    :param table_name: the name of the table in the schema
+    :param index_col: the column of the index, the csv files exported by the obtain functions have the index in the first column
+    :param kwargs: other parameters of pandas.read_csv
+    :return: the dataframe with the compact dtypes
+    """
+    dtype = dict([(column, 'category') for column, column_dtype in SCHEMA[table_name].iteritems() if column_dtype == 'category'])
+    dtype.update(kwargs.pop('dtype', {}))
+    table = pd.read_csv(path, index_col=index_col, dtype=dtype, **kwargs)
+    return apply_schema(table, table_name)
+
+
+def obtain_memory_usage(table):
+    """
+    Calculate the memory usage of a table including the strings
+
+    :param table: the dataframe
+    :return: the memory usage in bytes
+    """
+    return int(table.memory_usage(index=True, deep=True).sum())
+
+
+def memory_report(table_dict):
+    """
+    Compare the memory usage of the tables before and after applying the schema
+
+    :param table_dict: dictionary from the table name in the schema to the dataframe with the default dtypes, example: {'history': history, 'segment': segment_df}
+    :return: the dataframe of the report with the columns: table, rows, original_mb, compact_mb, saving
+    """
+    record_list = []
+    for table_name in sorted(table_dict.keys()):
+        table = table_dict[table_name]
+        original_usage = obtain_memory_usage(table)
+        compact_usage = obtain_memory_usage(apply_schema(table, table_name))
+        saving = 1.0 - float(compact_usage) / original_usage if original_usage > 0 else 0.0
+        record_list.append((table_name, len(table), original_usage / 1048576.0, compact_usage / 1048576.0, saving))
+    return pd.DataFrame(record_list, columns=['table', 'rows', 'original_mb', 'compact_mb', 'saving'])
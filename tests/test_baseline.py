@@ -0,0 +1,156 @@
+"""
+Check the actual arrival time of the baselines against the per-record loop of the previous version
+
+"""
+
+# import modules
+import pandas as pd
+import numpy as np
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'implementation'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'preprocess'))
+import baseline
+
+
+#################################################################################################################
+#                                           helper function                                                     #
+#################################################################################################################
+
+
+def reference_arrival_time(history, route_stop_dist, service_date, trip_id, shape_id, target_stop):
+    """
+    Calculate the actual arrival time of a target stop with the loop of the previous version of generate_actual_arrival_time
+
+    :param history: dataframe for the filtered history table
+    :param route_stop_dist: dataframe for the route_stop_dist table
+    :param service_date: the service date of the trip
+    :param trip_id: the trip id
+    :param shape_id: the shape id of the trip
+    :param target_stop: the target stop id
+    :return: the arrival time in epoch microseconds, None if it can't be calculated
+    """
+    single_history = history[(history.service_date == service_date) & (history.trip_id == trip_id)]
+    single_route_stop_dist = route_stop_dist[route_stop_dist.shape_id == shape_id]
+    stop_sequence = list(single_route_stop_dist.stop_id)
+    target_index = stop_sequence.index(target_stop)
+    dist_along_route = single_route_stop_dist[single_route_stop_dist.stop_id == target_stop].iloc[0]['dist_along_route']
+    stop_set = set(single_history.next_stop_id)
+    prev_index, next_index = target_index, target_index + 1
+    while stop_sequence[prev_index] not in stop_set:
+        prev_index -= 1
+        if prev_index == -1:
+            return None
+    while next_index < len(stop_sequence) and stop_sequence[next_index] not in stop_set:
+        next_index += 1
+    if next_index == len(stop_sequence):
+        return None
+    prev_stop = stop_sequence[prev_index]
+    next_stop = stop_sequence[next_index]
+    if prev_stop == next_stop:
+        return None
+    prev_record = single_history[single_history.next_stop_id == prev_stop].iloc[-1]
+    prev_time = int(prev_record.get('epoch_time')) * 1000000
+    if prev_record.dist_from_stop == 0 and prev_record.next_stop_id == target_stop:
+        return prev_time
+    next_record = single_history[single_history.next_stop_id == next_stop].iloc[-1]
+    next_time = int(next_record.get('epoch_time')) * 1000000
+    return baseline.calculate_arrival_time(dist_along_route, float(prev_record.get('total_distance')), float(next_record.get('total_distance')), prev_time, next_time)
+
+
+def generate_history(stop_list, dist_list, trip_count, seed):
+    """
+    Generate a random history table of several trips on one shape
+
+    :param stop_list: the stop sequence of the shape
+    :param dist_list: the dist_along_route of the stops
+    :param trip_count: number of the trips
+    :param seed: seed of the random number generator
+    :return: dataframe for the history table
+    """
+    random_state = np.random.RandomState(seed)
+    record_list = []
+    for i in xrange(trip_count):
+        current_time = 1451865600 + i * 3600
+        for stop_index in xrange(len(stop_list)):
+            if random_state.rand() < 0.3:
+                continue
+            current_time += random_state.randint(30, 120)
+            dist_from_stop = 0.0 if random_state.rand() < 0.3 else float(random_state.randint(1, 50))
+            record_list.append((20160104, 'TRIP_%d' % i, 'SHAPE_0', stop_list[stop_index], current_time, dist_list[stop_index] - dist_from_stop, dist_from_stop))
+    history = pd.DataFrame(record_list, columns=['service_date', 'trip_id', 'shape_id', 'next_stop_id', 'epoch_time', 'total_distance', 'dist_from_stop'])
+    history['seconds_of_day'] = history['epoch_time'] % 86400
+    return history
+
+
+#################################################################################################################
+#                                               test cases                                                      #
+#################################################################################################################
+
+
+class ActualArrivalTimeTest(unittest.TestCase):
+    def check_shape(self, stop_list, dist_list, trip_count, seed):
+        route_stop_dist = pd.DataFrame({'shape_id': 'SHAPE_0', 'stop_id': stop_list, 'dist_along_route': dist_list}, columns=['shape_id', 'stop_id', 'dist_along_route'])
+        history = generate_history(stop_list, dist_list, trip_count, seed)
+        api_table = pd.DataFrame([(20160104, 'TRIP_%d' % i, stop_id) for i in xrange(trip_count) for stop_id in sorted(set(stop_list))], columns=['service_date', 'trip_id', 'stop_id'])
+        api_table['route_id'] = 'ROUTE_0'
+        api_table['shape_id'] = 'SHAPE_0'
+        api_table['vehicle_id'] = 'VEHICLE_0'
+        api_table['time_of_day'] = '2016-01-04 00:00:00'
+        api_table['epoch_time'] = 1451865600
+        api_table['seconds_of_day'] = 0
+        api_table['dist_along_route'] = 0.0
+        api_table['stop_num_from_call'] = 1
+        api_table['estimated_arrival_time'] = 0.0
+        stop_arrival_table = baseline.generate_stop_arrival_table(history, route_stop_dist)
+        self.assertFalse(stop_arrival_table.duplicated(['service_date', 'trip_id', 'stop_id']).any())
+        result = baseline.generate_actual_arrival_time(history, api_table, route_stop_dist, stop_arrival_table)
+        result = result.set_index(['trip_id', 'stop_id'])['actual_arrival_time']
+        for _, record in api_table.iterrows():
+            timestamp = reference_arrival_time(history, route_stop_dist, record['service_date'], record['trip_id'], record['shape_id'], record['stop_id'])
+            key = (record['trip_id'], record['stop_id'])
+            if timestamp is None:
+                self.assertNotIn(key, result.index)
+            else:
+                self.assertAlmostEqual(result[key], (timestamp - 1451865600 * 1000000) / 1000000.0, places=6)
+
+    def test_simple_shape(self):
+        self.check_shape([1, 2, 3, 4, 5, 6], [0.0, 100.0, 200.0, 300.0, 400.0, 500.0], 20, 0)
+
+    def test_repeated_stop(self):
+        # a figure-8 shape passes the stop 2 twice
+        self.check_shape([1, 2, 3, 2, 4], [0.0, 100.0, 200.0, 300.0, 400.0], 20, 1)
+        self.check_shape([1, 2, 3, 4, 2, 5, 3, 6], [0.0, 100.0, 200.0, 300.0, 400.0, 500.0, 600.0, 700.0], 30, 2)
+
+
+class EvaluateBaselinesTest(unittest.TestCase):
+    def test_repeated_stop(self):
+        # a figure-8 shape passes the stop 2 twice
+        stop_list = [1, 2, 3, 2, 4]
+        dist_list = [100.0, 200.0, 300.0, 400.0, 500.0]
+        route_stop_dist = pd.DataFrame({'shape_id': 'SHAPE_0', 'stop_id': stop_list, 'dist_along_route': dist_list}, columns=['shape_id', 'stop_id', 'dist_along_route'])
+        history = generate_history(stop_list, dist_list, 10, 3)
+        history['dist_along_route'] = history['total_distance'] + history['dist_from_stop']
+        trips = pd.DataFrame({'trip_id': ['TRIP_%d' % i for i in xrange(10)], 'route_id': 'ROUTE_0', 'shape_id': 'SHAPE_0'})
+        random_state = np.random.RandomState(4)
+        segment_df = pd.DataFrame([(stop_list[j], stop_list[j + 1], float(random_state.randint(30, 120)), 20160104, 'TRIP_%d' % i) for i in xrange(10) for j in xrange(len(stop_list) - 1)],
+                                  columns=['segment_start', 'segment_end', 'travel_duration', 'service_date', 'trip_id'])
+        api_data = pd.DataFrame([('TRIP_%d' % i, 'VEHICLE_0', 'ROUTE_0', stop_id, '2016-01-04 00:00:00', 20160104, 150.0, 'SHAPE_0') for i in xrange(10) for stop_id in [2, 3, 4]],
+                                columns=['trip_id', 'vehicle_id', 'route_id', 'stop_id', 'time_of_day', 'date', 'dist_along_route', 'shape_id'])
+        result, summary = baseline.evaluate_baselines(segment_df, api_data, route_stop_dist, trips, history, baseline_list=['baseline1', 'baseline3'])
+        self.assertFalse(result.duplicated(['service_date', 'trip_id', 'stop_id']).any())
+        self.assertTrue(len(result) > 0)
+        # the shared actual arrival time gives the same result as each baseline alone
+        for baseline_name, function in [('baseline1', baseline.obtain_baseline1), ('baseline3', baseline.obtain_baseline3)]:
+            expected = function(segment_df, api_data, route_stop_dist, trips, history)
+            single_result = result[result[baseline_name].notnull()]
+            self.assertEqual(summary[summary.baseline == baseline_name]['count'].iloc[0], len(expected))
+            self.assertEqual(list(single_result['trip_id']), list(expected['trip_id']))
+            self.assertEqual(list(single_result['stop_id']), list(expected['stop_id']))
+            np.testing.assert_allclose(single_result[baseline_name].values, expected['estimated_arrival_time'].values.astype(float))
+            np.testing.assert_allclose(single_result['actual_arrival_time'].values, expected['actual_arrival_time'].values.astype(float))
+
+
+if __name__ == '__main__':
+    unittest.main()
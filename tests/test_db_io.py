@@ -0,0 +1,148 @@
+"""
+Check the export and the filtered read of the database tables against SQLite
+
+"""
+
+# import modules
+import pandas as pd
+import numpy as np
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine, inspect
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'preprocess'))
+import db_io
+import data_collection
+import partition_store
+
+
+#################################################################################################################
+#                                           helper function                                                     #
+#################################################################################################################
+
+
+def generate_history(row_count, seed):
+    """
+    Generate a random history table
+
+    :param row_count: number of the records
+    :param seed: seed of the random number generator
+    :return: dataframe for the history table
+    """
+    random_state = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'service_date': random_state.choice([20160104, 20160105, 20160106], row_count),
+        'trip_id': ['TRIP_%d' % i for i in random_state.randint(0, 20, row_count)],
+        'shape_id': random_state.choice(['SHAPE_0', 'SHAPE_1', 'SHAPE_2'], row_count),
+        'next_stop_id': random_state.randint(300000, 300100, row_count),
+        'dist_along_route': random_state.rand(row_count) * 1000.0,
+        'epoch_time': random_state.randint(1451865600, 1452124800, row_count)},
+        columns=['service_date', 'trip_id', 'shape_id', 'next_stop_id', 'dist_along_route', 'epoch_time'])
+
+
+def generate_chunks(table, chunksize, fail_after=None):
+    """
+    Yield the chunks of the table, and raise an error after the given number of chunks
+
+    :param table: the dataframe
+    :param chunksize: number of rows in each chunk
+    :param fail_after: number of chunks before the error. If it is None, no error is raised
+    :return: generator of the chunks
+    """
+    for chunk_index, start in enumerate(xrange(0, len(table), chunksize)):
+        if fail_after is not None and chunk_index == fail_after:
+            raise IOError('broken history file')
+        yield table.iloc[start:start + chunksize].copy()
+
+
+#################################################################################################################
+#                                               test cases                                                      #
+#################################################################################################################
+
+
+class SQLiteRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.path, 'bus.db'))
+        self.history = generate_history(1000, 0)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.path)
+
+    def check_table(self, result, expected):
+        self.assertEqual(list(result.index), list(expected.index))
+        for column in expected.columns:
+            if expected[column].dtype.kind == 'f':
+                np.testing.assert_allclose(result[column].values.astype(float), expected[column].values)
+            else:
+                self.assertEqual(list(np.asarray(result[column]).astype(expected[column].dtype)), list(expected[column].values))
+
+    def test_export_and_read(self):
+        db_io.export_table(self.history, 'history', self.engine)
+        self.check_table(db_io.read_table(self.engine, 'history', table_name=None), self.history)
+        self.assertNotIn(db_io.obtain_staging_name('history'), inspect(self.engine).get_table_names())
+
+    def test_read_filtered(self):
+        db_io.export_table(self.history, 'history', self.engine)
+        date_list = [20160104, 20160106]
+        shape_list = ['SHAPE_1']
+        expected = self.history[self.history.service_date.isin(date_list) & self.history.shape_id.isin(shape_list)]
+        result = db_io.read_table(self.engine, 'history', date_list=date_list, shape_list=shape_list, chunksize=50)
+        self.check_table(result, expected)
+        table = db_io.DatabaseTable(self.engine, 'history', chunksize=50)
+        self.check_table(table.select(date_list, shape_list), expected)
+        self.assertEqual(sorted(table.distinct('service_date')), [20160104, 20160105, 20160106])
+
+    def test_replace_table(self):
+        db_io.export_table(self.history, 'history', self.engine)
+        new_history = generate_history(300, 1)
+        db_io.export_table(new_history, 'history', self.engine)
+        self.check_table(db_io.read_table(self.engine, 'history', table_name=None), new_history)
+
+    def test_export_chunks(self):
+        row_count = data_collection.export_history_chunks(generate_chunks(self.history, 128), engine=self.engine)
+        self.assertEqual(row_count, len(self.history))
+        self.check_table(db_io.read_table(self.engine, 'history', table_name=None), self.history)
+
+    def test_failed_chunks(self):
+        db_io.export_table(self.history, 'history', self.engine)
+        with self.assertRaises(IOError):
+            data_collection.export_history_chunks(generate_chunks(generate_history(1000, 1), 128, fail_after=3), engine=self.engine)
+        # the staging table is removed and the old table is not changed
+        self.assertNotIn(db_io.obtain_staging_name('history'), inspect(self.engine).get_table_names())
+        self.check_table(db_io.read_table(self.engine, 'history', table_name=None), self.history)
+
+
+    def test_chunks_without_output(self):
+        # the chunks are not returned, so the history table should be exported somewhere
+        with self.assertRaises(ValueError):
+            data_collection.obtain_history(20160104, 20160106, pd.DataFrame({'trip_id': [], 'route_id': [], 'shape_id': []}), self.path, chunksize=128)
+
+
+class PartitionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.path, 'history')
+        self.history = generate_history(1000, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_date_range(self):
+        data_collection.export_history_chunks(generate_chunks(self.history, 128), store_path=self.store_path, date_range=(20160104, 20160104))
+        self.assertEqual(partition_store.obtain_date_list(self.store_path), [20160104])
+        expected = partition_store.read_partition(self.store_path)
+        # the records of the day before the date range don't replace its complete partition
+        new_history = generate_history(500, 1)
+        data_collection.export_history_chunks(generate_chunks(new_history, 128), store_path=self.store_path, date_range=(20160105, 20160106))
+        self.assertEqual(partition_store.obtain_date_list(self.store_path), [20160104, 20160105, 20160106])
+        pd.util.testing.assert_frame_equal(partition_store.read_partition(self.store_path, [20160104]), expected)
+        result = partition_store.read_partition(self.store_path, [20160105, 20160106])
+        self.assertEqual(list(result.index), list(new_history[new_history.service_date != 20160104].index))
+
+
+if __name__ == '__main__':
+    unittest.main()
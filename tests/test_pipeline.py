@@ -0,0 +1,91 @@
+"""
+Check that the cached results of the pipeline are reused when it is run again with the same inputs
+
+"""
+
+# import modules
+import pandas as pd
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'implementation'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'preprocess'))
+import pipeline
+
+
+#################################################################################################################
+#                                           helper function                                                     #
+#################################################################################################################
+
+
+def generate_gtfs():
+    """
+    Generate the trips and stop_times tables of two trips on one shape
+
+    :return: tuple of the dataframes for the trips table and the stop_times table
+    """
+    trips = pd.DataFrame({'trip_id': ['T1', 'T2'], 'route_id': ['R1', 'R1'], 'shape_id': ['S1', 'S1']})
+    stop_list = [1, 2, 3, 4]
+    stop_times = pd.DataFrame({'trip_id': ['T1'] * 4 + ['T2'] * 4, 'stop_id': stop_list * 2, 'stop_sequence': range(1, 5) * 2, 'shape_dist_traveled': [0.0, 0.1, 0.2, 0.3] * 2})
+    return trips, stop_times
+
+
+def generate_history():
+    """
+    Generate a history table which visits all the stops of the shape
+
+    :return: dataframe for the history table
+    """
+    return pd.DataFrame({'route_id': ['R1'] * 4, 'shape_id': ['S1'] * 4, 'next_stop_id': [1, 2, 3, 4], 'dist_along_route': [0.0, 100.0, 200.0, 300.0]})
+
+
+def obtain_stage_list(trips, stop_times, history):
+    """
+    :return: list of the Stage objects of the pipeline for the tables
+    """
+    return pipeline.obtain_pipeline(trips, stop_times, history, pd.DataFrame({'date': [20160104], 'weather': [0]}), [20160104], [20160104], ['12:00:00'], 1, ('17:00:00', '20:00:00'), 20160104)
+
+
+def obtain_key_dict(stage_list):
+    """
+    :return: dictionary from the name of the stage to its key
+    """
+    key_dict = {}
+    for stage in pipeline.sort_stage(stage_list):
+        key_dict[stage.name] = pipeline.obtain_stage_key(stage, key_dict)
+    return key_dict
+
+
+#################################################################################################################
+#                                           test case                                                           #
+#################################################################################################################
+
+
+class PipelineCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path)
+
+    def test_second_run(self):
+        trips, stop_times = generate_gtfs()
+        history = generate_history()
+        stop_times_copy = stop_times.copy()
+        stage_list = obtain_stage_list(trips, stop_times, history)
+        key_dict = obtain_key_dict(stage_list)
+        first_result = pipeline.run_pipeline(stage_list, self.cache_path, targets=['route_stop_dist'])
+        # the inputs are not changed by the stages
+        pd.util.testing.assert_frame_equal(stop_times, stop_times_copy)
+        # the same inputs give the same keys for all the stages, so everything is read from the cache
+        stage_list = obtain_stage_list(trips, stop_times, history)
+        self.assertEqual(obtain_key_dict(stage_list), key_dict)
+        second_result = pipeline.run_pipeline(stage_list, self.cache_path, targets=['route_stop_dist'])
+        self.assertEqual(os.listdir(os.path.join(self.cache_path, 'route_stop_dist')), [key_dict['route_stop_dist'] + '.pkl'])
+        pd.util.testing.assert_frame_equal(second_result['route_stop_dist'], first_result['route_stop_dist'])
+
+
+if __name__ == '__main__':
+    unittest.main()
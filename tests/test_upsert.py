@@ -0,0 +1,64 @@
+"""
+Check the replacement of the records of the service dates in the csv file
+
+"""
+
+# import modules
+import pandas as pd
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'preprocess'))
+import data_collection
+
+
+#################################################################################################################
+#                                           helper function                                                     #
+#################################################################################################################
+
+
+def generate_segment(service_date, trip_count):
+    """
+    Generate the segment records of a service date
+
+    :param service_date: the service date
+    :param trip_count: number of the trips
+    :return: dataframe for the segment records
+    """
+    return pd.DataFrame({'service_date': [service_date] * trip_count, 'trip_id': ['T%d' % i for i in xrange(trip_count)], 'travel_duration': [float(i * 10) for i in xrange(trip_count)]})
+
+
+#################################################################################################################
+#                                           test case                                                           #
+#################################################################################################################
+
+
+class UpsertCsvTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.save_path = os.path.join(self.temp_path, 'segment.csv')
+        data_collection.upsert_csv(generate_segment(20160104, 3), self.save_path, [20160104])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path)
+
+    def test_append(self):
+        data_collection.upsert_csv(generate_segment(20160105, 2), self.save_path, [20160105], append=True)
+        result = pd.read_csv(self.save_path, index_col=0)
+        self.assertEqual(list(result.index), range(5))
+        self.assertEqual(list(result.service_date), [20160104] * 3 + [20160105] * 2)
+
+    def test_append_again(self):
+        # the retry after a failure following the append doesn't write the records twice
+        data_collection.upsert_csv(generate_segment(20160105, 2), self.save_path, [20160105], append=True)
+        data_collection.upsert_csv(generate_segment(20160105, 2), self.save_path, [20160105], append=True)
+        result = pd.read_csv(self.save_path, index_col=0)
+        expected_path = os.path.join(self.temp_path, 'expected.csv')
+        data_collection.upsert_csv(pd.concat([generate_segment(20160104, 3), generate_segment(20160105, 2)], ignore_index=True), expected_path, [20160104, 20160105])
+        pd.util.testing.assert_frame_equal(result, pd.read_csv(expected_path, index_col=0))
+
+
+if __name__ == '__main__':
+    unittest.main()